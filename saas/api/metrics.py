@@ -35,8 +35,8 @@ from ..docs import extend_schema
 from ..filters import DateRangeFilter, OrderingFilter, SearchFilter
 from ..metrics.base import (abs_balances_by_period,
     aggregate_transactions_change_by_period, generate_periods)
-from ..metrics.subscriptions import (active_subscribers_by_period,
-    churn_subscribers_by_period, subscribers_age)
+from ..metrics.subscriptions import (churn_subscribers_by_period,
+    subscribers_age, subscribers_by_period)
 from ..metrics.transactions import lifetime_value, revenue_metrics
 from ..mixins import (CartItemSmartListMixin, CouponMixin,
     ProviderMixin, DateRangeContextMixin, BalancesDueMixin)
@@ -157,10 +157,13 @@ class PlanMetricsMixin(MetricsMixin):
     def get_data(self):
         table = []
         date_periods = self.calculate_date_periods()
-        for plan in Plan.objects.filter(
-                organization=self.provider).order_by('title'):
-            values = active_subscribers_by_period(
-                plans=[plan], date_periods=date_periods)
+        plans = Plan.objects.filter(
+            organization=self.provider).order_by('title')
+        subscribers = subscribers_by_period(
+            plans=plans, date_periods=date_periods)
+        for plan in plans:
+            values = subscribers.get(plan.pk, {}).get('active',
+                [[end_period, 0] for end_period in date_periods])
             table.append({
                 'slug': plan.slug,
                 'title': plan.title,
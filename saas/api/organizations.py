@@ -28,6 +28,7 @@ from dateutil.relativedelta import relativedelta
 from django.conf import settings as django_settings
 from django.contrib.auth import get_user_model, logout as auth_logout
 from django.db import transaction
+from django.db.models import Q
 from rest_framework import parsers, status
 from rest_framework.generics import (CreateAPIView, ListAPIView,
     RetrieveUpdateDestroyAPIView)
@@ -44,7 +45,7 @@ from ..helpers import datetime_or_now
 from ..mixins import (DateRangeContextMixin, OrganizationMixin,
     OrganizationSearchOrderListMixin, OrganizationSmartListMixin,
     ProviderMixin, OrganizationDecorateMixin)
-from ..models import Subscription
+from ..models import DueEvent, Subscription
 from ..utils import (get_organization_model, get_role_model,
     get_picture_storage)
 
@@ -228,6 +229,12 @@ class OrganizationDetailAPIView(OrganizationMixin, OrganizationQuerysetMixin,
             # Removes all roles on the organization such that the organization
             # is not picked up inadvertently.
             get_role_model().objects.filter(organization=obj).delete()
+            # ``update`` does not trigger the ``post_save`` signal which
+            # schedules renewals, expiration notices and charges, so we
+            # clear the events of the organization explicitly.
+            DueEvent.objects.filter(Q(organization=obj) |
+                Q(subscription__organization=obj) |
+                Q(subscription__plan__organization=obj)).delete()
             # Two queries instead of one because there might be subscriptions
             # that auto-renew with an ends_at date in the past (might be an
             # error, but still better to auto-correct when we can).
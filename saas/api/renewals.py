@@ -25,10 +25,11 @@ from __future__ import unicode_literals
 
 from rest_framework import generics, status, response as http
 
-from .serializers import AtTimeSerializer
+from .serializers import AtTimeSerializer, RenewalsJournalSerializer
 from ..docs import extend_schema
 from ..helpers import datetime_or_now
 from ..mixins import OrganizationMixin
+from ..models import Charge, RenewalsJournal
 from ..renewals import (create_charge_for_balance_organization,
     complete_charges, extend_subscriptions_organization)
 
@@ -77,8 +78,56 @@ class RenewalsAPIView(OrganizationMixin, generics.CreateAPIView):
         extend_subscriptions_organization(self.organization, at_time=at_time)
         nb_charges = create_charge_for_balance_organization(
             self.organization, until=at_time)
-        # We will wait until the charge settles, and create
-        # the `payment_successful` transactions.
-        complete_charges()
+        if nb_charges > 0:
+            # We will wait until the charge settles, and create
+            # the `payment_successful` transactions. A charge is only
+            # created when none was in flight for the organization so
+            # we do not poll charges for other requests.
+            complete_charges(initial_delay=0, timeout=30,
+                charges=Charge.objects.in_progress_for_customer(
+                    self.organization))
         return http.Response({}, status=(
             status.HTTP_201_CREATED if nb_charges > 0 else status.HTTP_200_OK))
+
+
+class RenewalsJournalListAPIView(generics.ListAPIView):
+    """
+    Lists progress of renewals runs
+
+    Returns a list of {{PAGE_SIZE}} phases of the renewals command runs,
+    most recent first, with the last organization processed, the number
+    of items processed and the time spent in each phase.
+
+    **Tags**: billing, list, broker
+
+    **Examples**
+
+    .. code-block:: http
+
+        GET /api/billing/renewals HTTP/1.1
+
+    responds
+
+    .. code-block:: json
+
+        {
+            "count": 1,
+            "next": null,
+            "previous": null,
+            "results": [{
+                "at_time": "2024-11-10T00:00:00Z",
+                "shard": "",
+                "phase": "create-charges",
+                "last_organization_id": 12,
+                "nb_processed": 3,
+                "created_at": "2024-11-10T00:00:04Z",
+                "completed_at": null,
+                "duration": "00:00:12.400000"
+            }]
+        }
+    """
+    serializer_class = RenewalsJournalSerializer
+
+    def get_queryset(self):
+        return RenewalsJournal.objects.all().order_by(
+            '-at_time', 'shard', 'created_at')
@@ -54,8 +54,8 @@ from ..decorators import _valid_manager
 from ..humanize import MONTHLY, as_money
 from ..mixins import as_html_description, product_url, read_agreement_file
 from ..models import (get_broker, AdvanceDiscount, Agreement, BalanceLine,
-    CartItem, Charge, Coupon, Plan, RoleDescription, Subscription, Transaction,
-    UseCharge)
+    CartItem, Charge, Coupon, Plan, RenewalsJournal, RoleDescription,
+    Subscription, Transaction, UseCharge)
 from ..utils import (build_absolute_uri, get_organization_model, get_role_model,
     get_user_serializer, get_user_detail_serializer, handle_uniq_error)
 
@@ -912,6 +912,18 @@ class ProvidedSubscriptionCreateSerializer(serializers.ModelSerializer):
         fields = ('profile', 'message')
 
 
+class TransactionListSerializer(serializers.ListSerializer):
+    """
+    Resolves the events of all transactions in a list at once before
+    they are serialized.
+    """
+
+    def to_representation(self, data):
+        return super(TransactionListSerializer, self).to_representation(
+            Transaction.objects.resolve_events(data.all()
+                if hasattr(data, 'all') else data))
+
+
 class TransactionSerializer(serializers.ModelSerializer):
     """
     A `Transaction` in the double-entry bookkeeping ledger.
@@ -963,6 +975,7 @@ class TransactionSerializer(serializers.ModelSerializer):
         fields = ('created_at', 'description', 'amount', 'is_debit',
             'orig_account', 'orig_profile', 'orig_amount', 'orig_unit',
             'dest_account', 'dest_profile', 'dest_amount', 'dest_unit')
+        list_serializer_class = TransactionListSerializer
 
 
 class ChargeItemSerializer(NoModelSerializer):
@@ -1018,6 +1031,17 @@ class ChargeSerializer(serializers.ModelSerializer):
             'state', 'detail')
 
 
+class RenewalsJournalSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = RenewalsJournal
+        fields = ('at_time', 'shard', 'phase', 'last_organization_id',
+            'nb_processed', 'created_at', 'completed_at', 'duration')
+        read_only_fields = ('at_time', 'shard', 'phase',
+            'last_organization_id', 'nb_processed', 'created_at',
+            'completed_at', 'duration')
+
+
 class CartItemSerializer(serializers.ModelSerializer):
     """
     serializer for a ``CartItem`` object.
@@ -679,11 +679,13 @@ class StatementBalanceAPIView(SmartTransactionListMixin,
         # the current balances.
         balances = Transaction.objects.get_statement_balances(
             self.organization, until=at_time)
+        subscriptions = {entry.event_id: entry.subscription
+            for entry in Transaction.objects.resolve_events([
+                Transaction(event_id=event_id) for event_id in balances])}
         if paid:
             if amount:
                 for sub_event_id, balance in six.iteritems(balances):
-                    subscription = Subscription.objects.get_by_event_id(
-                        sub_event_id)
+                    subscription = subscriptions.get(sub_event_id)
                     for dest_unit, avail_amount in six.iteritems(balance):
                         cancel_amount = min(avail_amount, amount)
                         if cancel_amount > 0:
@@ -693,8 +695,7 @@ class StatementBalanceAPIView(SmartTransactionListMixin,
                         amount -= cancel_amount
             else:
                 for sub_event_id, balance in six.iteritems(balances):
-                    subscription = Subscription.objects.get_by_event_id(
-                        sub_event_id)
+                    subscription = subscriptions.get(sub_event_id)
                     for dest_unit, cancel_amount in six.iteritems(balance):
                         if cancel_amount > 0:
                             Transaction.objects.offline_payment(
@@ -703,8 +704,7 @@ class StatementBalanceAPIView(SmartTransactionListMixin,
         else:
             if amount:
                 for sub_event_id, balance in six.iteritems(balances):
-                    subscription = Subscription.objects.get_by_event_id(
-                        sub_event_id)
+                    subscription = subscriptions.get(sub_event_id)
                     for dest_unit, avail_amount in six.iteritems(balance):
                         cancel_amount = min(avail_amount, amount)
                         if cancel_amount > 0:
@@ -715,8 +715,7 @@ class StatementBalanceAPIView(SmartTransactionListMixin,
                         amount -= cancel_amount
             else:
                 for sub_event_id, balance in six.iteritems(balances):
-                    subscription = Subscription.objects.get_by_event_id(
-                        sub_event_id)
+                    subscription = subscriptions.get(sub_event_id)
                     for dest_unit, cancel_amount in six.iteritems(balance):
                         if cancel_amount > 0:
                             self.organization.create_cancel_transactions(
@@ -1077,6 +1077,7 @@ class StripeBackend(object):
                     stripe_card.exp_month,
                     stripe_card.exp_year)
                 context.update({
+                    'brand': stripe_card.brand,
                     'last4': last4,
                     'exp_date': exp_date,
                     'card_name': billing_name
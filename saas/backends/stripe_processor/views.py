@@ -33,6 +33,7 @@ import stripe
 from ... import settings
 from ...compat import import_string
 from ...models import Charge, get_broker
+from ...utils import get_organization_model
 
 
 LOGGER = logging.getLogger(__name__)
@@ -67,6 +68,24 @@ class StripeProcessorRedirectView(RedirectView):
             request, *args, **kwargs)
 
 
+def _get_card(stripe_object):
+    """
+    Returns the card details of a Stripe ``Card``, ``Source``
+    or ``PaymentMethod`` formatted as ``StripeBackend.retrieve_card`` does.
+    """
+    stripe_card = stripe_object
+    if stripe_object.get('object') != 'card':
+        stripe_card = stripe_object.get('card')
+    if not stripe_card or not stripe_card.get('last4'):
+        return None
+    card = {'brand': stripe_card.get('brand'),
+        'last4': '***-%s' % str(stripe_card.get('last4'))}
+    if stripe_card.get('exp_month') and stripe_card.get('exp_year'):
+        card.update({'exp_date': "%02d/%04d" % (
+            stripe_card.get('exp_month'), stripe_card.get('exp_year'))})
+    return card
+
+
 class StripeWebhook(APIView):
     """
     Answers callback from Stripe.
@@ -127,5 +146,23 @@ class StripeWebhook(APIView):
             #pylint:disable=protected-access
             processor_backend._update_charge_state(
                 charge, event_type=event_type)
+        elif event_type in ['customer.source.updated',
+                'payment_method.updated',
+                'payment_method.automatically_updated']:
+            # The card on file was updated (ex: new expiration date).
+            # We refresh the local copy used to generate expiration notices
+            # from the event itself, without calling Stripe back.
+            customer = event.data.object.get('customer')
+            card = _get_card(event.data.object)
+            if customer and card:
+                organizations = get_organization_model().objects.filter(
+                    processor_card_key=customer)
+                for organization in organizations:
+                    organization.cache_card(card)
+                    organization.save(update_fields=[
+                        'card_brand', 'card_last4', 'card_exp_date'])
+                if not organizations:
+                    LOGGER.info("no organization for Stripe customer %s",
+                        customer)
 
         return Response("OK")
@@ -77,6 +77,9 @@ DESCRIBE_LIABILITY_START_PERIOD = \
 DESCRIBE_OFFLINE_PAYMENT = \
     "Off-line payment"
 
+DESCRIBE_OPENING_BALANCE = \
+    "Opening balance on %(date)s"
+
 DESCRIBE_RECOGNIZE_INCOME = \
     "Recognize %(subscription)s from %(period_start)s to %(period_end)s"
 
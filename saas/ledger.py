@@ -23,64 +23,497 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from django.db import connection
+from django.db import connections, router, transaction
+from django.db.models import Count, Sum
+from django.db.models.query import QuerySet
 
+from . import settings
+from .helpers import datetime_or_now
 from .humanize import as_money
+from .models import (AccountBalance, LedgerChecksum, RollupWatermark,
+    Transaction)
+from .utils import get_organization_model
 
 
-def read_balances(account, until=datetime.datetime.now()):
+def read_balances(account, until=None, unit=None, using=None):
     """Balances associated to customer accounts.
 
-    We are executing the following SQL to find the balance
-    of each customer.
+    Computes the balance of *account* for every organization in a single
+    grouped pass over ``saas_transaction``, as the sum of amounts deposited
+    into *account* minus the sum of amounts withdrawn from *account*,
+    for transactions in *unit* created strictly before *until*.
 
     The query returns a list of tuples (organization_id, amount in cents)
-    we use to create the invoices.
+    we use to create the invoices. Organizations whose balance is zero
+    are not returned.
     example:
         (2, 1200)
         (3, 1100)
 
     """
-    cursor = connection.cursor()
-    cursor.execute(
-"""select t1.dest_organization_id,
-     sum(t1.dest_amount - coalesce(t2.dest_amount, 0))
-from saas_transaction t1 left outer join saas_transaction t2
-on t1.dest_organization_id = t2.orig_organization_id
-   and t1.dest_account = t2.orig_account
-where t1.dest_account = '%s' and t1.created_at < '%s' and t2.created_at < '%s'
-group by t1.dest_organization_id
-""" % (account, until, until))
-    return cursor.fetchall()
+    until = datetime_or_now(until)
+    if not unit:
+        unit = settings.DEFAULT_UNIT
+    if not using:
+        using = router.db_for_read(Transaction)
+    table = Transaction._meta.db_table #pylint:disable=protected-access
+    # Each side of the union can be resolved with an index range scan
+    # on (account, created_at).
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+"""SELECT organization_id, SUM(amount) FROM (
+  SELECT dest_organization_id AS organization_id, dest_amount AS amount
+  FROM %(table)s
+  WHERE dest_account = %%s AND dest_unit = %%s AND created_at < %%s
+  UNION ALL
+  SELECT orig_organization_id AS organization_id, - orig_amount AS amount
+  FROM %(table)s
+  WHERE orig_account = %%s AND orig_unit = %%s AND created_at < %%s
+) AS balances
+GROUP BY organization_id
+HAVING SUM(amount) <> 0
+ORDER BY organization_id""" % {'table': table},
+            [account, unit, until, account, unit, until])
+        return cursor.fetchall()
 
 
-def export(output, transactions):
-    """
-    Export a set of Transaction in ledger format.
-    """
-    for transaction in transactions:
-        dest = ("\t\t%(dest_organization)s:%(dest_account)s"
-                % {'dest_organization': transaction.dest_organization,
-                   'dest_account': transaction.dest_account})
-        dest_amount = as_money(transaction.dest_amount,
-            transaction.dest_unit).rjust(60 - len(dest))
-        orig = ("\t\t%(orig_organization)s:%(orig_account)s"
-                % {'orig_organization': transaction.orig_organization,
-                   'orig_account': transaction.orig_account})
-        if transaction.dest_unit != transaction.orig_unit:
-            disp_orig_amount = "-%s" % as_money(transaction.orig_amount,
-                transaction.orig_unit)
-            orig_amount = disp_orig_amount.rjust(60 - len(orig))
-        else:
-            orig_amount = ''
-        output.write("""
+def _export_entry(output, created_at, event_id, descr,
+                  dest_organization, dest_account, dest_amount, dest_unit,
+                  orig_organization, orig_account, orig_amount, orig_unit):
+    #pylint:disable=too-many-arguments
+    dest = ("\t\t%(dest_organization)s:%(dest_account)s"
+            % {'dest_organization': dest_organization,
+               'dest_account': dest_account})
+    dest_amount = as_money(dest_amount, dest_unit).rjust(60 - len(dest))
+    orig = ("\t\t%(orig_organization)s:%(orig_account)s"
+            % {'orig_organization': orig_organization,
+               'orig_account': orig_account})
+    if dest_unit != orig_unit:
+        disp_orig_amount = "-%s" % as_money(orig_amount, orig_unit)
+        orig_amount = disp_orig_amount.rjust(60 - len(orig))
+    else:
+        orig_amount = ''
+    output.write("""
 %(created_at)s #%(reference)s - %(description)s
 %(dest)s%(dest_amount)s
 %(orig)s%(orig_amount)s
 """ % {'created_at': datetime.datetime.strftime(
-            transaction.created_at, '%Y/%m/%d %H:%M:%S'),
-        'reference': '%s' % transaction.event_id,
-        'description': transaction.descr,
-        'dest': dest, 'dest_amount': dest_amount,
-        'orig': orig, 'orig_amount': orig_amount})
+        created_at, '%Y/%m/%d %H:%M:%S'),
+    'reference': '%s' % event_id,
+    'description': descr,
+    'dest': dest, 'dest_amount': dest_amount,
+    'orig': orig, 'orig_amount': orig_amount})
+
+
+def export(output, transactions, chunk_size=2000):
+    """
+    Export a set of Transaction in ledger format.
+
+    When *transactions* is a ``QuerySet``, rows are streamed from
+    the database *chunk_size* at a time, and the organizations
+    are looked up in a slug map loaded once, instead of caching
+    every ``Transaction`` and querying its organizations one at a time.
+    """
+    if isinstance(transactions, QuerySet):
+        slugs = dict(get_organization_model().objects.using(
+            transactions.db).values_list('pk', 'slug'))
+        for (created_at, event_id, descr,
+             dest_organization_id, dest_account, dest_amount, dest_unit,
+             orig_organization_id, orig_account, orig_amount, orig_unit) in \
+            transactions.values_list('created_at', 'event_id', 'descr',
+                'dest_organization_id', 'dest_account', 'dest_amount',
+                'dest_unit', 'orig_organization_id', 'orig_account',
+                'orig_amount', 'orig_unit').iterator(chunk_size=chunk_size):
+            _export_entry(output, created_at, event_id, descr,
+                slugs.get(dest_organization_id), dest_account,
+                dest_amount, dest_unit,
+                slugs.get(orig_organization_id), orig_account,
+                orig_amount, orig_unit)
+        return
+    for entry in transactions:
+        _export_entry(output, entry.created_at, entry.event_id, entry.descr,
+            entry.dest_organization, entry.dest_account,
+            entry.dest_amount, entry.dest_unit,
+            entry.orig_organization, entry.orig_account,
+            entry.orig_amount, entry.orig_unit)
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def _sum_postings(transactions, by_event=False, organization_range=None):
+    """
+    Returns the sum of amounts deposited minus amounts withdrawn, and
+    the number of postings, in *transactions* as a dictionnary keyed
+    by (organization_id, account, unit, event_id) tuples. The event_id
+    is blank unless *by_event* is ``True``.
+    """
+    postings = {}
+    for side, sign in (('dest', 1), ('orig', -1)):
+        fields = ['%s_organization' % side, '%s_account' % side,
+            '%s_unit' % side]
+        queryset = transactions
+        if organization_range:
+            queryset = queryset.filter(**{
+                '%s_organization__pk__range' % side: organization_range})
+        if by_event:
+            queryset = queryset.exclude(event_id__isnull=True).exclude(
+                event_id="")
+            fields += ['event_id']
+        for row in queryset.values(*fields).annotate(
+                balance=Sum('%s_amount' % side),
+                nb_postings=Count('pk')).order_by():
+            key = (row[fields[0]], row[fields[1]], row[fields[2]],
+                row['event_id'] if by_event else "")
+            amount, nb_postings = postings.get(key, (0, 0))
+            postings[key] = (amount + sign * row['balance'],
+                nb_postings + row['nb_postings'])
+    return postings
+
+
+def _sum_pending(transactions, mark, **kwargs):
+    """
+    Returns the postings (see `_sum_postings`) of *transactions* visible
+    in the current snapshot but above *mark*. Such ``Transaction`` only
+    exist on PostgreSQL (see `TransactionManager.get_committed_mark`).
+    """
+    if connections[transactions.db].vendor != 'postgresql':
+        return {}
+    return _sum_postings(transactions.committed_between(mark), **kwargs)
+
+
+def _subtract_postings(postings, pending):
+    """
+    Returns *postings* minus *pending*, leaving out the keys
+    without postings left.
+    """
+    results = dict(postings)
+    for key, delta in pending.items():
+        amount, nb_postings = results.get(key, (0, 0))
+        results[key] = (amount - delta[0], nb_postings - delta[1])
+    return {key: val for key, val in results.items() if val[1]}
+
+
+def _load_balances(queryset):
+    return {(row['organization'], row['account'], row['unit'],
+        row['event_id']): row['amount'] for row in queryset.values(
+        'organization', 'account', 'unit', 'event_id', 'amount')}
+
+
+def _check_balances(expected, recorded, keys):
+    """
+    Returns the errors for running balances in *keys* which do not match
+    the *expected* ledger balance, or that leave a ``Payable`` account
+    negative.
+    """
+    errors = []
+    for key in sorted(keys, key=lambda item: tuple(str(field)
+            for field in item)):
+        amount = expected.get(key, (0, 0))[0]
+        if recorded.get(key, 0) != amount:
+            errors += [("running balance", key, amount, recorded.get(key))]
+        if key[1] == Transaction.PAYABLE and amount < 0:
+            errors += [("negative payable", key, ">= 0", amount)]
+    return errors
+
+
+def _check_statements(organization_ids, using=None):
+    """
+    Returns the errors for organizations in *organization_ids* whose
+    statement balances (see `TransactionQuerySet.get_statement_balances`)
+    do not match their running ``Payable`` balances, per event and
+    in total per currency unit (i.e. the balance `sum_balance_amount`
+    returns for the ``Payable`` account).
+    """
+    errors = []
+    for chunk in _chunks(sorted(organization_ids)):
+        recorded = {}
+        last_activity = {}
+        for row in AccountBalance.objects.using(using).filter(
+                organization_id__in=chunk,
+                account=Transaction.PAYABLE).exclude(amount=0).values(
+                'organization', 'unit', 'event_id', 'amount',
+                'last_activity_at'):
+            recorded.update({(row['organization'], Transaction.PAYABLE,
+                row['unit'], row['event_id']): row['amount']})
+            last_activity.update({row['organization']: max(
+                row['last_activity_at'], last_activity.get(
+                row['organization'], row['last_activity_at']))})
+        for organization_id in chunk:
+            # Statements only include ``Transaction`` created before
+            # a point in time while running balances include them all.
+            until = datetime_or_now()
+            if organization_id in last_activity:
+                until = max(until, last_activity[organization_id]
+                    + datetime.timedelta(microseconds=1))
+            expected = {}
+            for event_id, balances in Transaction.objects.using(
+                    using).get_statement_balances(
+                    organization_id, until=until).items():
+                for unit, amount in balances.items():
+                    if event_id:
+                        key = (organization_id, Transaction.PAYABLE, unit,
+                            event_id)
+                        expected.update({key: amount})
+                    total_key = (organization_id, Transaction.PAYABLE,
+                        unit, "")
+                    expected.update({total_key:
+                        expected.get(total_key, 0) + amount})
+            keys = set([key for key, amount in expected.items() if amount])
+            keys |= set([key for key in recorded
+                if key[0] == organization_id])
+            for key in sorted(keys, key=lambda item: tuple(str(field)
+                    for field in item)):
+                if expected.get(key, 0) != recorded.get(key, 0):
+                    errors += [("statement balance", key,
+                        expected.get(key, 0), recorded.get(key, 0))]
+    return errors
+
+
+def _verify_since(since_mark, mark, using=None):
+    """
+    Verifies the running balances touched by ``Transaction`` recorded
+    after *since_mark* using the checksums recorded up to *since_mark*.
+
+    Returns the errors and the checksums up to *mark*.
+    """
+    new_transactions = Transaction.objects.using(using).committed_between(
+        since_mark)
+    deltas = _sum_postings(new_transactions)
+    checksums = {}
+    recorded = {}
+    for organization_ids in _chunks(set([key[0] for key in deltas])):
+        for row in LedgerChecksum.objects.using(using).filter(
+                organization_id__in=organization_ids).values(
+                'organization', 'account', 'unit', 'amount',
+                'nb_transactions'):
+            checksums.update({(row['organization'], row['account'],
+                row['unit'], ""): (row['amount'], row['nb_transactions'])})
+        recorded.update(_load_balances(AccountBalance.objects.using(
+            using).filter(organization_id__in=organization_ids, event_id="")))
+    for key, delta in deltas.items():
+        amount, nb_transactions = checksums.get(key, (0, 0))
+        checksums[key] = (amount + delta[0], nb_transactions + delta[1])
+    errors = _check_balances(checksums, recorded, deltas.keys())
+    statement_organization_ids = set([key[0] for key in deltas
+        if key[1] == Transaction.PAYABLE])
+
+    # Balances per event are verified against the whole history
+    # of the events, which is retrieved through the `event_id` index.
+    event_ids = new_transactions.exclude(event_id__isnull=True).exclude(
+        event_id="").values_list('event_id', flat=True).distinct()
+    for chunk in _chunks(event_ids):
+        expected = _sum_postings(Transaction.objects.using(using).filter(
+            event_id__in=chunk), by_event=True)
+        recorded = _load_balances(AccountBalance.objects.using(using).filter(
+            event_id__in=chunk))
+        errors += _check_balances(expected, recorded,
+            set(expected.keys()) | set(recorded.keys()))
+        statement_organization_ids |= set([key[0] for key in expected
+            if key[1] == Transaction.PAYABLE])
+    errors += _check_statements(statement_organization_ids, using=using)
+    # ``Transaction`` above the mark are verified against the running
+    # balances but only added to the checksums once they are below it.
+    checksums = _subtract_postings(
+        {key: val for key, val in checksums.items() if key in deltas},
+        _sum_pending(new_transactions, mark))
+    return errors, checksums
+
+
+def _set_snapshot(using, snapshot_id):
+    """
+    Makes the database transaction started on *using* see the same
+    snapshot as the transaction that exported *snapshot_id*.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot_id])
+
+
+@contextmanager
+def _ledger_snapshot(using):
+    """
+    Starts a database transaction on *using* and yields a (mark,
+    snapshot_id) tuple such that the transaction sees all ``Transaction``
+    at or below mark (see `TransactionManager.get_committed_mark`)
+    and the running balances they were recorded into.
+
+    On PostgreSQL, the transaction is repeatable read and its snapshot
+    is exported (snapshot_id) for worker threads to import. Nothing is
+    locked, so writes proceed during the verification.
+
+    Otherwise, or when called inside an atomic block, all queries run
+    in the current database transaction and snapshot_id is ``None``.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql' or connection.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield Transaction.objects.get_committed_mark(using=using), None
+        return
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot_id = cursor.fetchone()[0]
+        # The mark is read in the snapshot just exported.
+        yield Transaction.objects.get_committed_mark(
+            using=using), snapshot_id
+
+
+def _verify_organization_range(organization_range, mark, using=None,
+                               snapshot_id=None):
+    """
+    Verifies the running balances of organizations whose primary key
+    falls in *organization_range* against the ledger history.
+
+    When *snapshot_id* is specified, the queries run in a new database
+    transaction that sees the snapshot exported as *snapshot_id*.
+    """
+    if not snapshot_id:
+        return _verify_organization_range_in_snapshot(
+            organization_range, mark, using=using)
+    try:
+        with transaction.atomic(using=using):
+            _set_snapshot(using, snapshot_id)
+            return _verify_organization_range_in_snapshot(
+                organization_range, mark, using=using)
+    finally:
+        # Each thread uses its own database connection.
+        connections.close_all()
+
+
+def _verify_organization_range_in_snapshot(organization_range, mark,
+                                           using=None):
+    transactions = Transaction.objects.using(using).all()
+    expected = _sum_postings(transactions,
+        organization_range=organization_range)
+    checksums = _subtract_postings(expected, _sum_pending(transactions, mark,
+        organization_range=organization_range))
+    expected.update(_sum_postings(transactions, by_event=True,
+        organization_range=organization_range))
+    recorded = _load_balances(AccountBalance.objects.using(using).filter(
+        organization__pk__range=organization_range))
+    errors = _check_balances(expected, recorded,
+        set(expected.keys()) | set(recorded.keys()))
+    errors += _check_statements(set([key[0]
+        for key in set(expected.keys()) | set(recorded.keys())
+        if key[1] == Transaction.PAYABLE]), using=using)
+    return errors, checksums
+
+
+def _verify_full(since_mark, mark, nb_workers=4, using=None,
+                 snapshot_id=None):
+    """
+    Verifies all running balances against the ledger history, scanning
+    organizations by ranges of primary keys in *nb_workers* threads
+    which import the snapshot exported as *snapshot_id*. Without
+    a *snapshot_id*, the ranges are scanned on the current connection.
+
+    The checksums recorded up to *since_mark* are also verified against
+    the history, to detect ``Transaction`` that were modified or deleted
+    after they were verified.
+    """
+    organization_ids = list(get_organization_model().objects.using(
+        using).order_by('pk').values_list('pk', flat=True))
+    size = max(1, -(-len(organization_ids) // max(1, nb_workers)))
+    organization_ranges = [(chunk[0], chunk[-1])
+        for chunk in _chunks(organization_ids, size=size)]
+    errors = []
+    checksums = {}
+    if snapshot_id and nb_workers > 1:
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            results = list(executor.map(lambda organization_range:
+                _verify_organization_range(organization_range, mark,
+                    using=using, snapshot_id=snapshot_id),
+                organization_ranges))
+    else:
+        results = [_verify_organization_range(organization_range, mark,
+            using=using) for organization_range in organization_ranges]
+    for range_errors, range_checksums in results:
+        errors += range_errors
+        checksums.update(range_checksums)
+
+    recorded = {(row['organization'], row['account'], row['unit'], ""):
+        (row['amount'], row['nb_transactions'])
+        for row in LedgerChecksum.objects.using(using).values(
+            'organization', 'account', 'unit', 'amount', 'nb_transactions')}
+    for key, delta in _sum_postings(Transaction.objects.using(
+            using).committed_between(since_mark, mark)).items():
+        amount, nb_transactions = recorded.get(key, (0, 0))
+        recorded[key] = (amount + delta[0], nb_transactions + delta[1])
+    if since_mark:
+        for key in sorted(set(checksums.keys()) | set(recorded.keys()),
+                key=lambda item: tuple(str(field) for field in item)):
+            if checksums.get(key, (0, 0)) != recorded.get(key, (0, 0)):
+                errors += [("checksum", key, recorded.get(key),
+                    checksums.get(key))]
+    return errors, checksums
+
+
+def verify_ledger(full=False, nb_workers=4, using=None):
+    """
+    Verifies the ledger is consistent with the running balances
+    (``AccountBalance``) the statements are derived from: balances per
+    account and per event match the ``Transaction`` history,
+    no ``Payable`` balance is negative, and the statement balances
+    agree with the ``Payable`` balances.
+
+    By default only the ``Transaction`` recorded since the last
+    verification are read. They are added to the per-account checksums
+    (``LedgerChecksum``) recorded at the high-water mark and compared
+    to the running balances they touched. The mark is moved forward
+    to the last ``Transaction`` that can no longer be committed
+    out of order (see `TransactionManager.get_committed_mark`).
+
+    When *full* is ``True``, the whole ledger is rescanned by ranges
+    of organizations in *nb_workers* threads. On PostgreSQL, each thread
+    reads through its own database connection but all see the same snapshot
+    of the ledger. Other databases rescan on a single connection.
+
+    The checksums and high-water mark are only moved forward when no
+    errors were found. Returns a list of (reason, key, expected, recorded)
+    tuples where key is a (organization_id, account, unit, event_id) tuple.
+    """
+    if not using:
+        using = router.db_for_write(Transaction)
+    with _ledger_snapshot(using) as (mark, snapshot_id):
+        watermark, _unused = RollupWatermark.objects.using(
+            using).select_for_update().get_or_create(
+            name=RollupWatermark.LEDGER)
+        mark = max(mark, watermark.last_id)
+        if not full and not Transaction.objects.using(
+                using).committed_between(watermark.last_id).exists():
+            return []
+        if full:
+            errors, checksums = _verify_full(watermark.last_id, mark,
+                nb_workers=nb_workers, using=using, snapshot_id=snapshot_id)
+        else:
+            errors, checksums = _verify_since(watermark.last_id, mark,
+                using=using)
+        if errors:
+            return errors
+        if full:
+            LedgerChecksum.objects.using(using).all().delete()
+            LedgerChecksum.objects.using(using).bulk_create([LedgerChecksum(
+                organization_id=key[0], account=key[1], unit=key[2],
+                amount=val[0], nb_transactions=val[1])
+                for key, val in checksums.items()])
+        else:
+            for key, val in checksums.items():
+                if not LedgerChecksum.objects.using(using).filter(
+                        organization_id=key[0], account=key[1],
+                        unit=key[2]).update(
+                        amount=val[0], nb_transactions=val[1]):
+                    LedgerChecksum.objects.using(using).create(
+                        organization_id=key[0], account=key[1],
+                        unit=key[2], amount=val[0], nb_transactions=val[1])
+        watermark.last_id = mark
+        watermark.last_at = datetime_or_now()
+        watermark.save()
+    return []
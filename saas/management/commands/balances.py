@@ -0,0 +1,101 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The balances command rebuilds, or checks the consistency of, the running
+balances (``AccountBalance``) against the ``Transaction`` ledger.
+
+It also closes accounting periods, recording the balances
+(``ClosingBalance``) at the end of the period such that historical balance
+queries only aggregate transactions recorded after it. By default, the period
+closes at the beginning of the current month.
+
+**Example**:
+
+.. code-block:: bash
+
+    $ python manage.py balances check
+    $ python manage.py balances rebuild --organization cowork
+    $ python manage.py balances close --at-time 2026-01-01T00:00:00Z
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...helpers import datetime_or_now
+from ...models import AccountBalance, ClosingBalance
+from ...utils import get_organization_model
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild or check the running balances against the ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='store',
+            dest='database', default='default',
+            help='connect to database specified.')
+        parser.add_argument('--organization', action='store',
+            dest='organization', default=None,
+            help='only process balances for the organization specified.')
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='end of the period to close (defaults to start of month)')
+        parser.add_argument('subcommand', metavar='subcommand',
+            help="subcommand: rebuild|check|close")
+
+    def handle(self, *args, **options):
+        subcommand = options['subcommand']
+        using = options['database']
+        organization = None
+        if options['organization']:
+            organization = get_organization_model().objects.using(using).get(
+                slug=options['organization'])
+        if subcommand == 'rebuild':
+            nb_balances = AccountBalance.objects.rebuild(
+                organization=organization, using=using)
+            self.stdout.write("%d running balances rebuilt" % nb_balances)
+        elif subcommand == 'check':
+            errors = AccountBalance.objects.check_consistency(
+                organization=organization, using=using)
+            for key, expected, recorded in errors:
+                self.stderr.write("error: %s: expected %s, recorded %s" % (
+                    ':'.join([str(field) for field in key]),
+                    expected, recorded))
+            self.stdout.write("%d inconsistent running balances" % len(errors))
+        elif subcommand == 'close':
+            if options['at_time']:
+                period_end = datetime_or_now(options['at_time'])
+            else:
+                period_end = datetime_or_now().replace(
+                    day=1, hour=0, minute=0, second=0, microsecond=0)
+            nb_balances = ClosingBalance.objects.close_period(
+                period_end, using=using)
+            self.stdout.write("%d closing balances recorded at %s" % (
+                nb_balances, period_end.isoformat()))
+        else:
+            self.stderr.write("error: unknown command: '%s'" % subcommand)
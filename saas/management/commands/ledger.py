@@ -22,10 +22,11 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import csv, datetime, logging, re, sys
+import bz2, csv, datetime, gzip, logging, lzma, re, sys, time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
+from django.db.models import Q
 
 from ... import settings as saas_settings
 from ...compat import timezone_or_utc
@@ -52,21 +53,77 @@ class Command(BaseCommand):
         parser.add_argument('--create-organizations', action='store_true',
             dest='create_organizations', default=False,
             help='Create organization if it does not exist.')
+        parser.add_argument('--start-at', action='store',
+            dest='start_at', default=None,
+            help='Export transactions created at or after this date/time')
+        parser.add_argument('--ends-at', action='store',
+            dest='ends_at', default=None,
+            help='Export transactions created before this date/time')
+        parser.add_argument('--organization', action='store',
+            dest='organization', default=None,
+            help='Export transactions to or from this organization (slug)')
+        parser.add_argument('--account', action='store',
+            dest='account', default=None,
+            help='Export transactions to or from this account')
+        parser.add_argument('--output', action='store',
+            dest='output', default=None,
+            help='Export to a file instead of stdout. The file is compressed'\
+            ' when its name ends with .gz, .bz2 or .xz')
+        parser.add_argument('--chunk-size', action='store', type=int,
+            dest='chunk_size', default=2000,
+            help='Number of transactions read from the database at a time')
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=1000,
+            help='Number of transactions inserted (and committed) at a time'\
+            ' on import')
+        parser.add_argument('--validate-only', action='store_true',
+            dest='validate_only', default=False,
+            help='Parse the input and look up organizations on import'\
+            ' but do not write to the database')
         parser.add_argument('subcommand', metavar='subcommand', nargs='+',
             help="subcommand: export|import")
 
     def handle(self, *args, **options):
-        #pylint: disable=too-many-locals
+        #pylint: disable=too-many-locals,too-many-branches,too-many-statements
         subcommand = options['subcommand'][0]
         filenames = options['subcommand'][1:]
         using = options['database']
         if subcommand == 'export':
-            export(self.stdout, Transaction.objects.using(using).all().order_by(
-                'created_at'))
+            transactions = Transaction.objects.using(using).all()
+            if options['start_at']:
+                transactions = transactions.filter(
+                    created_at__gte=datetime_or_now(options['start_at']))
+            if options['ends_at']:
+                transactions = transactions.filter(
+                    created_at__lt=datetime_or_now(options['ends_at']))
+            if options['organization']:
+                try:
+                    organization = get_organization_model().objects.using(
+                        using).get(slug=options['organization'])
+                except get_organization_model().DoesNotExist:
+                    raise CommandError("unknown organization '%s'" %
+                        options['organization'])
+                transactions = transactions.filter(
+                    Q(dest_organization=organization) |
+                    Q(orig_organization=organization))
+            if options['account']:
+                transactions = transactions.filter(
+                    Q(dest_account=options['account']) |
+                    Q(orig_account=options['account']))
+            transactions = transactions.order_by('created_at', 'pk')
+            if options['output']:
+                with _open_output(options['output']) as output:
+                    export(output, transactions,
+                        chunk_size=options['chunk_size'])
+            else:
+                export(self.stdout, transactions,
+                    chunk_size=options['chunk_size'])
 
         elif subcommand == 'import':
             broker = options.get('broker', None)
             create_organizations = options.get('create_organizations', False)
+            start_time = time.monotonic()
+            nb_imported = 0
             for arg in filenames:
                 if arg.endswith('.csv'):
                     with open(arg) as file_d:
@@ -76,17 +133,36 @@ class Command(BaseCommand):
                             csv_file, broker, using=using)
                 elif arg.endswith('.ledger'):
                     with open(arg) as filedesc:
-                        import_transactions(filedesc,
-                            create_organizations, broker, using=using)
+                        nb_imported += import_transactions(filedesc,
+                            create_organizations, broker, using=using,
+                            batch_size=options['batch_size'],
+                            validate_only=options['validate_only'])
                 elif arg == '-':
-                    import_transactions(sys.stdin,
-                        create_organizations, broker, using=using)
+                    nb_imported += import_transactions(sys.stdin,
+                        create_organizations, broker, using=using,
+                        batch_size=options['batch_size'],
+                        validate_only=options['validate_only'])
                 else:
                     self.stdout.write('warnning: skipping %s' % str(arg))
+            duration = time.monotonic() - start_time
+            self.stdout.write("%d transactions %s in %.1fs (%.0f rows/sec)" % (
+                nb_imported,
+                "validated" if options['validate_only'] else "imported",
+                duration, nb_imported / duration if duration else 0))
         else:
             self.stderr.write("error: unknown command: '%s'" % subcommand)
 
 
+def _open_output(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'wt')
+    if filename.endswith('.xz'):
+        return lzma.open(filename, 'wt')
+    return open(filename, 'w')
+
+
 def import_transactions_from_csv(csv_file, broker=None, using='default'):
     with transaction.atomic():
         for row in csv_file:
@@ -108,114 +184,182 @@ def import_transactions_from_csv(csv_file, broker=None, using='default'):
 
 
 def import_transactions(filedesc, create_organizations=False, broker=None,
-                        using='default'):
-    #pylint:disable=too-many-locals
-    with transaction.atomic():
-        line = filedesc.readline()
-        while line != '':
-            look = re.match(
-                r'(?P<created_at>\d\d\d\d/\d\d/\d\d( \d\d:\d\d:\d\d)?)'\
-                r'\s+(#(?P<reference>\S+) -)?(?P<descr>.*)', line)
-            if look:
-                # Start of a transaction
-                try:
-                    created_at = datetime.datetime.strptime(
-                        look.group('created_at'),
-                        '%Y/%m/%d %H:%M:%S').replace(tzinfo=timezone_or_utc())
-                except ValueError:
-                    created_at = datetime.datetime.strptime(
-                        look.group('created_at'),
-                        '%Y/%m/%d').replace(tzinfo=timezone_or_utc())
-                if look.group('reference'):
-                    reference = look.group('reference').strip()
-                else:
-                    reference = None
-                descr = look.group('descr').strip()
-                line = filedesc.readline()
-                dest_organization, dest_account, dest_amount, dest_unit \
-                    = parse_line(line, create_organizations,
-                        broker=broker, using=using)
-                line = filedesc.readline()
-                orig_organization, orig_account, orig_amount, orig_unit \
-                    = parse_line(line, create_organizations,
-                        broker=broker, using=using)
-                if dest_amount < 0:
-                    # Opening balances are shown as negative amounts
-                    tmp_organization = dest_organization
-                    tmp_account = dest_account
-                    tmp_amount = dest_amount
-                    tmp_unit = dest_unit
-                    dest_organization = orig_organization
-                    dest_account = orig_account
-                    dest_amount = orig_amount
-                    dest_unit = orig_unit
-                    orig_organization = tmp_organization
-                    orig_account = tmp_account
-                    orig_amount = tmp_amount
-                    orig_unit = tmp_unit
-                if dest_unit != 'usd' and orig_unit == 'usd':
-                    dest_amount = - orig_amount
-                    dest_unit = orig_unit
-                if not orig_amount:
-                    orig_amount = dest_amount
-                if not orig_unit:
-                    orig_unit = dest_unit
-                if dest_organization and orig_organization:
-                    # Assuming no errors, at this point we have
-                    # a full transaction.
-                    #pylint:disable=logging-not-lazy
-                    LOGGER.debug(
-                        "Transaction.objects.using('%(using)s').create("\
-                        "created_at='%(created_at)s',"\
-                        "descr='%(descr)s',"\
-                        "dest_unit='%(dest_unit)s',"\
-                        "dest_amount='%(dest_amount)s',"\
-                        "dest_organization='%(dest_organization)s',"\
-                        "dest_account='%(dest_account)s',"\
-                        "orig_amount='%(orig_amount)s',"\
-                        "orig_unit='%(orig_unit)s',"\
-                        "orig_organization='%(orig_organization)s',"\
-                        "orig_account='%(orig_account)s',"\
-                        "event_id=%(event_id)s)" % {
-                            'using': using,
-                            'created_at': created_at,
-                            'descr': descr,
-                            'dest_unit': dest_unit,
-                            'dest_amount': dest_amount,
-                            'dest_organization': dest_organization,
-                            'dest_account': dest_account,
-                            'orig_amount': dest_amount,
-                            'orig_unit': orig_unit,
-                            'orig_organization': orig_organization,
-                            'orig_account': orig_account,
-                            'event_id':
-                                "'%s'" % reference if reference else "None"
-                        })
-                    Transaction.objects.using(using).create(
-                        created_at=created_at,
-                        descr=descr,
-                        dest_unit=dest_unit,
-                        dest_amount=dest_amount,
-                        dest_organization=dest_organization,
-                        dest_account=dest_account,
-                        orig_amount=dest_amount,
-                        orig_unit=orig_unit,
-                        orig_organization=orig_organization,
-                        orig_account=orig_account,
-                        event_id=reference)
+                        using='default', batch_size=1000, validate_only=False):
+    """
+    Imports the transactions in ledger format read from *filedesc*.
+
+    Entries are parsed as a stream and inserted *batch_size* at a time,
+    each batch in its own database transaction. Organizations are looked up
+    (or created when *create_organizations* is ``True``) once per batch
+    and cached for the remainder of the import.
+
+    When *validate_only* is ``True``, the entries are parsed and
+    organizations looked up but nothing is written to the database.
+
+    Returns the number of transactions imported (or that would have been
+    imported when *validate_only* is ``True``).
+    """
+    organizations = {}
+    nb_imported = 0
+    batch = []
+    for entry in parse_ledger(filedesc, broker=broker):
+        batch += [entry]
+        if len(batch) >= batch_size:
+            nb_imported += _import_batch(batch, organizations,
+                create_organizations=create_organizations, using=using,
+                validate_only=validate_only)
+            batch = []
+    if batch:
+        nb_imported += _import_batch(batch, organizations,
+            create_organizations=create_organizations, using=using,
+            validate_only=validate_only)
+    return nb_imported
+
+
+def _import_batch(batch, organizations, create_organizations=False,
+                  using='default', validate_only=False):
+    _resolve_organizations(
+        set([entry['dest_organization'] for entry in batch] +
+            [entry['orig_organization'] for entry in batch]),
+        organizations, create_organizations=create_organizations,
+        using=using, validate_only=validate_only)
+    transactions = []
+    for entry in batch:
+        dest_organization = organizations.get(entry['dest_organization'])
+        orig_organization = organizations.get(entry['orig_organization'])
+        if dest_organization and orig_organization:
+            transactions += [Transaction(
+                created_at=entry['created_at'],
+                descr=entry['descr'],
+                dest_unit=entry['dest_unit'],
+                dest_amount=entry['dest_amount'],
+                dest_organization=dest_organization,
+                dest_account=entry['dest_account'],
+                orig_amount=entry['dest_amount'],
+                orig_unit=entry['orig_unit'],
+                orig_organization=orig_organization,
+                orig_account=entry['orig_account'],
+                event_id=entry['event_id'])]
+    if not validate_only:
+        with transaction.atomic(using=using):
+            Transaction.objects.bulk_record(transactions, using=using)
+        LOGGER.debug("imported %d transactions", len(transactions))
+    return len(transactions)
+
+
+def _resolve_organizations(slugs, organizations, create_organizations=False,
+                           using='default', validate_only=False):
+    """
+    Adds the organizations in *slugs* that are not yet in the *organizations*
+    cache with a single query, creating the missing ones
+    if *create_organizations* is ``True``.
+    """
+    organization_model = get_organization_model()
+    slugs = set([slug for slug in slugs
+        if slug and slug not in organizations])
+    if not slugs:
+        return
+    for organization in organization_model.objects.using(using).filter(
+            slug__in=slugs):
+        organizations[organization.slug] = organization
+        slugs.discard(organization.slug)
+    if slugs and create_organizations and not validate_only:
+        # Organizations are created one at a time through `save` (instead
+        # of `bulk_create`) such that the processor is created first when
+        # bootstrapping the database and `post_save` receivers run as they
+        # would for any other new organization.
+        for slug in sorted(slugs):
+            organization_model(slug=slug).save(using=using)
+        for organization in organization_model.objects.using(using).filter(
+                slug__in=slugs):
+            organizations[organization.slug] = organization
+            slugs.discard(organization.slug)
+    for slug in slugs:
+        if create_organizations:
+            # In validate-only mode, we only report the organizations
+            # that would have been created.
+            sys.stderr.write("info: would create Organization '%s'\n" % slug)
+            organizations[slug] = organization_model(slug=slug)
+        else:
+            sys.stderr.write("error: Cannot find Organization '%s'\n" % slug)
+            organizations[slug] = None
+
+
+def parse_ledger(filedesc, broker=None):
+    """
+    Generates the entries read from *filedesc* in ledger format
+    as dictionaries. Organizations are referenced by slug.
+
+    This function does not access the database.
+    """
+    line = filedesc.readline()
+    while line != '':
+        look = re.match(
+            r'(?P<created_at>\d\d\d\d/\d\d/\d\d( \d\d:\d\d:\d\d)?)'\
+            r'\s+(#(?P<reference>\S+) -)?(?P<descr>.*)', line)
+        if look:
+            # Start of a transaction
+            try:
+                created_at = datetime.datetime.strptime(
+                    look.group('created_at'),
+                    '%Y/%m/%d %H:%M:%S').replace(tzinfo=timezone_or_utc())
+            except ValueError:
+                created_at = datetime.datetime.strptime(
+                    look.group('created_at'),
+                    '%Y/%m/%d').replace(tzinfo=timezone_or_utc())
+            if look.group('reference'):
+                reference = look.group('reference').strip()
             else:
-                line = line.strip()
-                if line:
-                    sys.stderr.write("warning: skip line '%s'\n" % line)
+                reference = None
+            descr = look.group('descr').strip()
             line = filedesc.readline()
+            dest_organization, dest_account, dest_amount, dest_unit \
+                = parse_posting(line, broker=broker)
+            line = filedesc.readline()
+            orig_organization, orig_account, orig_amount, orig_unit \
+                = parse_posting(line, broker=broker)
+            if dest_amount < 0:
+                # Opening balances are shown as negative amounts
+                dest_organization, dest_account, dest_amount, dest_unit, \
+                orig_organization, orig_account, orig_amount, orig_unit = \
+                orig_organization, orig_account, orig_amount, orig_unit, \
+                dest_organization, dest_account, dest_amount, dest_unit
+            if dest_unit != 'usd' and orig_unit == 'usd':
+                dest_amount = - orig_amount
+                dest_unit = orig_unit
+            if not orig_amount:
+                orig_amount = dest_amount
+            if not orig_unit:
+                orig_unit = dest_unit
+            if dest_organization and orig_organization:
+                yield {
+                    'created_at': created_at,
+                    'descr': descr,
+                    'dest_unit': dest_unit,
+                    'dest_amount': dest_amount,
+                    'dest_organization': dest_organization,
+                    'dest_account': dest_account,
+                    'orig_amount': orig_amount,
+                    'orig_unit': orig_unit,
+                    'orig_organization': orig_organization,
+                    'orig_account': orig_account,
+                    'event_id': reference
+                }
+        else:
+            line = line.strip()
+            if line:
+                sys.stderr.write("warning: skip line '%s'\n" % line)
+        line = filedesc.readline()
 
 
 MONEY_PAT = r'(?P<prefix>\$?)(?P<value>-?((\d|,)+(.\d+)?))\s*(?P<suffix>(\w+)?)'
 
 
-def parse_line(line, create_organizations=False, broker=None, using='default'):
+def parse_posting(line, broker=None):
     """
-    Parse an (organization, account, amount) triplet.
+    Parse an (organization slug, account, amount, unit) tuple.
+
+    This function does not access the database.
     """
     unit = None
     amount = 0
@@ -242,16 +386,5 @@ def parse_line(line, create_organizations=False, broker=None, using='default'):
                     amount = int(float(value) * 100)
                 else:
                     amount = int(value)
-        organization_model = get_organization_model()
-        try:
-            if create_organizations:
-                organization, _ = organization_model.objects.using(
-                    using).get_or_create(slug=organization_slug)
-            else:
-                organization = organization_model.objects.using(using).get(
-                    slug=organization_slug)
-            return (organization, account, amount, unit)
-        except organization_model.DoesNotExist:
-            sys.stderr.write("error: Cannot find Organization '%s'\n"
-                % organization_slug)
+        return (organization_slug, account, amount, unit)
     return (None, None, amount, unit)
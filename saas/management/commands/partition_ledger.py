@@ -0,0 +1,102 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+The partition_ledger command manages the optional partitioning
+of the ``Transaction`` table by month of ``created_at`` on PostgreSQL.
+
+``partition`` converts the table of an existing install, ``create`` adds
+the partitions for the months ahead (it should run periodically), and
+``archive`` detaches the partitions older than ``--years`` into an archive
+table, replacing them by opening balances.
+
+**Example**:
+
+.. code-block:: bash
+
+    $ python manage.py partition_ledger partition
+    $ python manage.py partition_ledger create --months-ahead 3
+    $ python manage.py partition_ledger archive --years 7
+"""
+
+import logging
+
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+
+from ...helpers import datetime_or_now
+from ...partitions import (archive_transactions, create_partitions,
+    partition_transactions)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Partition, or archive partitions of, the transactions ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='store',
+            dest='database', default='default',
+            help='connect to database specified.')
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='date/time the partitions are created or archived from')
+        parser.add_argument('--months-ahead', action='store', type=int,
+            dest='months_ahead', default=3,
+            help='number of monthly partitions to create in advance')
+        parser.add_argument('--years', action='store', type=int,
+            dest='years', default=7,
+            help='archive the partitions older than this number of years')
+        parser.add_argument('--detach-only', action='store_true',
+            dest='detach_only', default=False,
+            help='leave the archived partitions as stand-alone tables'\
+            ' instead of moving them into the archive table')
+        parser.add_argument('subcommand', metavar='subcommand',
+            help="subcommand: partition|create|archive")
+
+    def handle(self, *args, **options):
+        subcommand = options['subcommand']
+        using = options['database']
+        at_time = datetime_or_now(options['at_time'])
+        try:
+            if subcommand == 'partition':
+                nb_partitions = partition_transactions(
+                    months_ahead=options['months_ahead'], using=using)
+                self.stdout.write("%d partitions created" % nb_partitions)
+            elif subcommand == 'create':
+                nb_partitions = create_partitions(until=at_time,
+                    months_ahead=options['months_ahead'], using=using)
+                self.stdout.write("%d partitions created" % nb_partitions)
+            elif subcommand == 'archive':
+                before = at_time - relativedelta(years=options['years'])
+                nb_partitions = archive_transactions(before,
+                    detach_only=options['detach_only'], using=using)
+                self.stdout.write("%d partitions archived before %s" % (
+                    nb_partitions, before.isoformat()))
+            else:
+                self.stderr.write("error: unknown command: '%s'" % subcommand)
+        except NotImplementedError as err:
+            raise CommandError(str(err))
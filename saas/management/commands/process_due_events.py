@@ -0,0 +1,94 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The process_due_events command is a long-running worker that renews
+subscriptions, sends expiration notices and charges organizations
+as these events become due, instead of scanning all subscriptions
+and organizations once a day as the ``renewals`` command does.
+
+The queue of due events (``DueEvent``) is maintained as subscriptions
+are created, extended or cancelled, and as the automated billing date
+of organizations changes. Events are locked with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so multiple workers can run
+concurrently. Each event is processed in its own db transaction, and
+an event that fails is retried with an exponential backoff up to
+``DueEvent.MAX_ATTEMPTS`` times. ``--rebuild`` recreates the queue from
+the active subscriptions (ex: after upgrading).
+
+Expiration notices are only sent by the workers when ``DUE_EVENTS_NOTICES``
+is set, in which case the ``renewals`` command does not send them.
+
+**Example**:
+
+.. code-block:: bash
+
+    $ python manage.py process_due_events --rebuild --once
+    $ python manage.py process_due_events --poll-interval 30
+"""
+
+import logging, time
+
+from django.core.management.base import BaseCommand
+
+from ...renewals import process_due_events, schedule_due_events
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Process renewals, notices and charges as they become due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', type=int,
+            dest='batch_size', default=100,
+            help='Number of events processed before checking for new ones')
+        parser.add_argument('--poll-interval', action='store', type=int,
+            dest='poll_interval', default=60,
+            help='Number of seconds to wait when no events are due')
+        parser.add_argument('--once', action='store_true',
+            dest='once', default=False,
+            help='Exit once all the events due are processed')
+        parser.add_argument('--rebuild', action='store_true',
+            dest='rebuild', default=False,
+            help='Recreate the queue of events from the active subscriptions')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        poll_interval = options['poll_interval']
+        if options['rebuild']:
+            schedule_due_events()
+        nb_events = 0
+        try:
+            while True:
+                nb_processed = process_due_events(batch_size=batch_size)
+                nb_events += nb_processed
+                if not nb_processed:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("%d events processed" % nb_events)
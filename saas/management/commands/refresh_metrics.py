@@ -0,0 +1,77 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The refresh_metrics command rolls up the ``Transaction`` and ``Subscription``
+recorded since the last refresh into the daily metrics rollups
+(``TransactionRollup``, ``SubscriptionRollup``).
+
+The metrics read full days from the rollups and only aggregate the current
+partial day (and transactions not yet rolled up) from the ledger.
+The ``renewals`` command also refreshes the rollups after it runs.
+
+**Example**:
+
+.. code-block:: bash
+
+    $ python manage.py refresh_metrics
+    $ python manage.py refresh_metrics --rebuild
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...helpers import datetime_or_now
+from ...metrics.base import refresh_transaction_rollups
+from ...metrics.subscriptions import refresh_subscription_rollups
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Refresh the daily metrics rollups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='store',
+            dest='database', default='default',
+            help='connect to database specified.')
+        parser.add_argument('--rebuild', action='store_true',
+            dest='rebuild', default=False,
+            help='recompute the rollups from scratch')
+        parser.add_argument('--at-time', action='store',
+            dest='at_time', default=None,
+            help='Specifies the time at which the command runs')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        rebuild = options['rebuild']
+        at_time = datetime_or_now(options['at_time'])
+        nb_transactions = refresh_transaction_rollups(
+            rebuild=rebuild, using=using)
+        self.stdout.write("%d transactions rolled up" % nb_transactions)
+        nb_days = refresh_subscription_rollups(
+            until=at_time, rebuild=rebuild, using=using)
+        self.stdout.write("%d days of subscriptions rolled up" % nb_days)
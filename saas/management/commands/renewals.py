@@ -29,13 +29,33 @@ run at least once a day. It will
 - recognize revenue for past periods (see :doc:`ledger <ledger>`).
 - extends active subscriptions
 - create charges for new periods
-- trigger expiration notices
+- trigger expiration notices (unless ``DUE_EVENTS_NOTICES`` is set, in which
+  case the ``process_due_events`` workers send them)
+- refresh the daily metrics rollups (see ``refresh_metrics``)
 
 Every functions part of the renewals script are explicitly written to be
 idempotent. Calling the scripts multiple times for the same timestamp
 (i.e. with the ``--at-time`` command line argument) will generate the
 appropriate ``Transaction`` and ``Charge`` only once.
 
+Progress is recorded per phase, and per organization while recognizing
+income and creating charges, in the ``RenewalsJournal``. A run interrupted
+halfway resumes from the last organization processed when the command
+is called again with the same ``--at-time`` (or with ``--resume``).
+Checkpoints are recorded per shard, so the run must be resumed with
+the same ``--workers`` and ``--shard`` arguments it was started with.
+
+With ``--dry-run``, the ledger entries touched by the run are loaded once
+and income recognition, renewals and charges are simulated in memory.
+The command then prints the transactions (with ``-v 2``), renewals
+and charges that would be created without writing to the database.
+
+The work can be partitioned by organization id, either across a pool
+of processes on the same host (``--workers N``) or across hosts
+(``--shard i/N`` with ``0 <= i < N``). Each organization is locked
+(``SELECT ... FOR UPDATE``) while it is processed, such that concurrent
+runners never process the same organization at the same time.
+
 **Example cron setup**:
 
 .. code-block:: bash
@@ -43,23 +63,148 @@ appropriate ``Transaction`` and ``Charge`` only once.
     $ cat /etc/cron.daily/renewals
     #!/bin/sh
 
-    cd /var/*mysite* && python manage.py renewals
+    cd /var/*mysite* && python manage.py renewals --workers 4
 """
 
 import logging, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
 
-from django.core.management.base import BaseCommand
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 from ... import settings
 from ...helpers import datetime_or_now
-from ...models import get_broker
+from ...metrics.base import refresh_transaction_rollups
+from ...metrics.subscriptions import refresh_subscription_rollups
+from ...models import RenewalsJournal
 from ...renewals import (create_charges_for_balance, complete_charges,
-    extend_subscriptions, recognize_income, trigger_expiration_notices)
+    extend_subscriptions, recognize_income, simulate_renewals,
+    trigger_expiration_notices)
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+def _init_worker():
+    # Worker processes might be spawned instead of forked.
+    django.setup()
+    connections.close_all()
+
+
+def _run_phase(results, phase, end_period, shard, func, journaled=True):
+    """
+    Runs *func* for *phase* unless the ``RenewalsJournal`` records
+    the phase as completed for the run at *end_period* on *shard*,
+    and adds the number of items processed and the time spent
+    to *results*.
+    """
+    #pylint:disable=too-many-arguments,broad-except
+    journal = None
+    nb_processed = 0
+    if journaled:
+        journal = RenewalsJournal.objects.get_or_start(
+            end_period, phase, shard=shard)
+        nb_processed = journal.nb_processed
+        if journal.completed_at:
+            LOGGER.info("SKIP   %s (completed at %s)",
+                journal, journal.completed_at)
+            results['phases'][phase] = {
+                'nb_processed': nb_processed,
+                'duration': journal.duration.total_seconds()}
+            return nb_processed
+        if journal.last_organization_id:
+            LOGGER.info("RESUME %s after organization %d",
+                journal, journal.last_organization_id)
+    started_at = time.monotonic()
+    try:
+        nb_processed += func(journal)
+        completed_at = datetime_or_now()
+    except Exception as err:
+        LOGGER.exception("%s: %s", phase, err)
+        completed_at = None
+        if journal:
+            # The items processed before the error were checkpointed.
+            journal.refresh_from_db(fields=['nb_processed'])
+            nb_processed = journal.nb_processed
+    duration = timedelta(seconds=time.monotonic() - started_at)
+    if journal:
+        journal.nb_processed = nb_processed
+        journal.completed_at = completed_at
+        journal.duration += duration
+        journal.save(update_fields=[
+            'nb_processed', 'completed_at', 'duration'])
+        duration = journal.duration
+    results['phases'][phase] = {
+        'nb_processed': nb_processed,
+        'duration': duration.total_seconds()}
+    return nb_processed
+
+
+def run_renewals(end_period, dry_run=False, no_charges=False, shard=None,
+                 charges_timeout=600):
+    """
+    Runs the renewals phases for the organizations in *shard*
+    and returns the number of renewals, charges (initiated and still
+    in progress after *charges_timeout* seconds) and notices per period
+    of ``EXPIRE_NOTICE_DAYS``, as well as the number of items processed
+    and the time spent per phase.
+
+    Unless *dry_run*, progress is recorded in the ``RenewalsJournal``
+    such that running again at the same *end_period* resumes
+    where a previous run was interrupted.
+    """
+    results = {'nb_renewals': 0, 'nb_charges': 0, 'nb_in_progress': 0,
+        'nb_notices': {}, 'phases': {}}
+    journaled = not dry_run
+    _run_phase(results, RenewalsJournal.RECOGNIZE_INCOME, end_period, shard,
+        lambda journal: recognize_income(end_period, dry_run=dry_run,
+            shard=shard, journal=journal), journaled=journaled)
+    results['nb_renewals'] = _run_phase(results,
+        RenewalsJournal.EXTEND_SUBSCRIPTIONS, end_period, shard,
+        lambda journal: extend_subscriptions(end_period, dry_run=dry_run,
+            shard=shard), journaled=journaled)
+    results['nb_charges'] = _run_phase(results,
+        RenewalsJournal.CREATE_CHARGES, end_period, shard,
+        lambda journal: create_charges_for_balance(end_period,
+            dry_run=dry_run or no_charges, shard=shard, journal=journal),
+        journaled=journaled and not no_charges)
+    if not (dry_run or no_charges):
+        # Let's complete the in flight charges as they settle.
+        def _complete_charges(journal): #pylint:disable=unused-argument
+            nb_completed, results['nb_in_progress'] = complete_charges(
+                shard=shard, timeout=charges_timeout)
+            return nb_completed
+        _run_phase(results, RenewalsJournal.COMPLETE_CHARGES, end_period,
+            shard, _complete_charges)
+
+    # Trigger 'expires soon' notifications, unless the ``process_due_events``
+    # workers send them.
+    expiration_periods = []
+    if not settings.DUE_EVENTS_NOTICES:
+        expiration_periods = settings.EXPIRE_NOTICE_DAYS
+    for period in expiration_periods:
+        results['nb_notices'][period] = _run_phase(results,
+            '%s-%d' % (RenewalsJournal.EXPIRATION_NOTICES, period),
+            end_period, shard,
+            #pylint:disable=cell-var-from-loop
+            lambda journal: trigger_expiration_notices(end_period,
+                nb_days=period, dry_run=dry_run, shard=shard),
+            journaled=journaled)
+    return results
+
+
+def _run_renewals_worker(args):
+    end_period, dry_run, no_charges, shard, charges_timeout = args
+    try:
+        return run_renewals(end_period, dry_run=dry_run,
+            no_charges=no_charges, shard=shard,
+            charges_timeout=charges_timeout)
+    finally:
+        connections.close_all()
+
+
 class Command(BaseCommand):
     help = """Recognized backlog, extends subscription and charge due balance
 on credit cards"""
@@ -74,43 +219,141 @@ on credit cards"""
         parser.add_argument('--at-time', action='store',
             dest='at_time', default=None,
             help='Specifies the time at which the command runs')
+        parser.add_argument('--workers', action='store', type=int,
+            dest='workers', default=1,
+            help='Number of processes the organizations are partitioned'\
+            ' across')
+        parser.add_argument('--shard', action='store',
+            dest='shard', default=None,
+            help='Only process the organizations in shard i/N'\
+            ' (i.e. organization id modulo N equals i)')
+        parser.add_argument('--resume', action='store_true',
+            dest='resume', default=False,
+            help='Resume the last renewals run that did not complete'\
+            ' (unless --at-time is specified)')
+        parser.add_argument('--charges-timeout', action='store', type=int,
+            dest='charges_timeout', default=600,
+            help='Number of seconds to wait for charges in progress'\
+            ' to settle')
+
+    @staticmethod
+    def _parse_shard(shard):
+        if not shard:
+            return None
+        try:
+            index, nb_shards = [int(part) for part in shard.split('/')]
+        except ValueError:
+            raise CommandError("shard '%s' should be formatted as i/N" % shard)
+        if nb_shards < 1 or index < 0 or index >= nb_shards:
+            raise CommandError("shard '%s' should verify 0 <= i < N" % shard)
+        return (index, nb_shards)
 
     def handle(self, *args, **options):
         #pylint:disable=broad-except
         dry_run = options['dry_run']
         no_charges = options['no_charges']
-        end_period = datetime_or_now(options['at_time'])
+        at_time = options['at_time']
+        if not at_time and options['resume']:
+            at_time = RenewalsJournal.objects.last_incomplete_at()
+            if at_time:
+                LOGGER.info("resume renewals run at %s", at_time)
+        end_period = datetime_or_now(at_time)
+        shard = self._parse_shard(options['shard'])
+        nb_workers = options['workers']
+        charges_timeout = options['charges_timeout']
         if dry_run:
             LOGGER.warning("dry_run: no changes will be committed.")
+            self.simulate(end_period, shard=shard,
+                verbosity=options['verbosity'])
+            return
         if no_charges:
             LOGGER.warning("no_charges: no charges will be submitted.")
+        # Organizations are assigned to journal entries by id modulo
+        # the number of shards. Resuming with a different number of shards
+        # would skip, or process twice, the organizations of a journal
+        # entry that checkpointed.
+        nb_shards = (shard[1] if shard else 1) * max(1, nb_workers)
+        journaled = RenewalsJournal.objects.get_nb_shards(end_period)
+        if journaled - set([nb_shards]):
+            raise CommandError("renewals run at %s was started across"\
+                " %s shard(s). It must be resumed with the same --workers"\
+                " and --shard arguments (%d shard(s) requested)." % (
+                end_period.isoformat(), ', '.join([str(nb_journaled)
+                for nb_journaled in sorted(journaled)]), nb_shards))
+        if nb_workers > 1:
+            # Each worker processes a sub-shard of the shard specified
+            # on the command line (or of all organizations).
+            index, nb_shards = shard if shard else (0, 1)
+            shards = [(index + nb_shards * idx, nb_shards * nb_workers)
+                for idx in range(0, nb_workers)]
+            # Connections must not be shared with the worker processes.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=nb_workers,
+                    initializer=_init_worker) as executor:
+                results = list(executor.map(_run_renewals_worker, [
+                    (end_period, dry_run, no_charges, worker_shard,
+                     charges_timeout)
+                    for worker_shard in shards]))
+        else:
+            results = [run_renewals(end_period, dry_run=dry_run,
+                no_charges=no_charges, shard=shard,
+                charges_timeout=charges_timeout)]
+
+        self.stdout.write("  %d subscriptions renewed" % sum(
+            [result['nb_renewals'] for result in results]))
+        self.stdout.write("  %d charges initiated" % sum(
+            [result['nb_charges'] for result in results]))
+        self.stdout.write("  %d charges still in progress" % sum(
+            [result['nb_in_progress'] for result in results]))
+        for period in settings.EXPIRE_NOTICE_DAYS:
+            self.stdout.write("  %d %d-days expiration notices sent" % (
+                sum([result['nb_notices'].get(period, 0)
+                    for result in results]), period))
+        phases = []
+        for result in results:
+            for phase in result['phases']:
+                if phase not in phases:
+                    phases += [phase]
+        for phase in phases:
+            # Workers run in parallel so we report the slowest one.
+            self.stdout.write("  %s: %d processed in %.1fs" % (phase,
+                sum([result['phases'][phase]['nb_processed']
+                    for result in results if phase in result['phases']]),
+                max([result['phases'][phase]['duration']
+                    for result in results if phase in result['phases']])))
+
         try:
-            recognize_income(end_period, dry_run=dry_run)
-        except Exception as err:
-            LOGGER.exception("recognize_income: %s", err)
-        try:
-            nb_renewals = extend_subscriptions(end_period, dry_run=dry_run)
-            self.stdout.write("  %d subscriptions renewed" % nb_renewals)
-        except Exception as err:
-            LOGGER.exception("extend_subscriptions: %s", err)
-        try:
-            nb_charges = create_charges_for_balance(
-                end_period, dry_run=dry_run or no_charges)
-            self.stdout.write("  %d charges initiated" % nb_charges)
+            refresh_transaction_rollups()
+            refresh_subscription_rollups(until=end_period)
         except Exception as err:
-            LOGGER.exception(
-                "Unable to create charges for balance on broker '%s'",
-                get_broker())
-        if not (dry_run or no_charges):
-            # Let's complete the in flight charges after we have given
-            # them time to settle.
-            time.sleep(30)
-            complete_charges()
-
-        # Trigger 'expires soon' notifications
-        expiration_periods = settings.EXPIRE_NOTICE_DAYS
-        for period in expiration_periods:
-            nb_notices = trigger_expiration_notices(
-                end_period, nb_days=period, dry_run=dry_run)
+            LOGGER.exception("refresh metrics rollups: %s", err)
+
+    def simulate(self, end_period, shard=None, verbosity=1):
+        """
+        Prints the transactions, renewals and charges the renewals would
+        create at *end_period*, as simulated against an in-memory ledger.
+        """
+        report = simulate_renewals(end_period, shard=shard)
+        if verbosity > 1:
+            for entry in report['transactions']:
+                self.stdout.write("%s %s\n    %s:%s %d %s\n    %s:%s" % (
+                    entry.created_at.isoformat(), entry.descr,
+                    entry.dest_organization, entry.dest_account,
+                    entry.dest_amount, entry.dest_unit,
+                    entry.orig_organization, entry.orig_account))
+        for subscription, ends_at in report['renewals']:
+            self.stdout.write("(dry-run) EXTENDS %s until %s" % (
+                subscription, ends_at.isoformat()))
+        for charge in report['charges']:
+            self.stdout.write("(dry-run) CHARGE %d %s to %s%s" % (
+                charge['amount'], charge['unit'], charge['organization'],
+                " (no payment method attached)"
+                if charge['card_absent'] else ""))
+        self.stdout.write("  %d transactions would be recorded" % len(
+            report['transactions']))
+        self.stdout.write("  %d subscriptions renewed" % len(
+            report['renewals']))
+        self.stdout.write("  %d charges initiated" % len(report['charges']))
+        for period in settings.EXPIRE_NOTICE_DAYS:
             self.stdout.write("  %d %d-days expiration notices sent" % (
-                nb_notices, period))
+                report['notices'].get(period, 0), period))
@@ -0,0 +1,81 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The verify_ledger command checks the double-entry ledger is consistent
+with the running balances (``AccountBalance``) statements are derived from,
+that no ``Payable`` balance is negative, and that the statement balances
+agree with the ``Payable`` balances.
+
+Only the transactions recorded since the last successful verification
+are read, and compared against checksums stored at that point. The ``--full``
+option rescans the whole ledger, in parallel by ranges of organizations
+on PostgreSQL.
+
+**Example**:
+
+.. code-block:: bash
+
+    $ python manage.py verify_ledger
+    $ python manage.py verify_ledger --full --workers 8
+"""
+
+import logging, time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...ledger import verify_ledger
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Verify the ledger is consistent with the running balances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='store',
+            dest='database', default='default',
+            help='connect to database specified.')
+        parser.add_argument('--full', action='store_true',
+            dest='full', default=False,
+            help='rescan the whole ledger instead of the transactions'\
+            ' recorded since the last verification')
+        parser.add_argument('--workers', action='store', type=int,
+            dest='workers', default=4,
+            help='number of threads rescanning the ledger with --full')
+
+    def handle(self, *args, **options):
+        start_time = time.monotonic()
+        errors = verify_ledger(full=options['full'],
+            nb_workers=options['workers'], using=options['database'])
+        for reason, key, expected, recorded in errors:
+            self.stderr.write("error: %s %s: expected %s, recorded %s" % (
+                reason, ':'.join([str(field) for field in key]),
+                expected, recorded))
+        duration = time.monotonic() - start_time
+        if errors:
+            raise CommandError("%d errors found in %.1fs" % (
+                len(errors), duration))
+        self.stdout.write("ledger verified in %.1fs" % duration)
@@ -22,19 +22,21 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from datetime import datetime
+from bisect import bisect_left
+from datetime import datetime, timedelta
 import logging
 
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth import get_user_model
-from django.db import router
-from django.db.models import Count, Sum
-from django.db.models.sql.query import RawQuery
+from django.db import transaction
+from django.db.models import (Case, Count, F, IntegerField, Sum,
+    Value, When)
+from django.db.models.functions import TruncDay
 
-from .. import humanize
+from .. import humanize, settings
 from ..compat import gettext_lazy as _, six, timezone_or_utc
 from ..helpers import datetime_or_now
-from ..models import Plan, Transaction
+from ..models import Plan, RollupWatermark, Transaction, TransactionRollup
 from ..utils import get_organization_model
 
 
@@ -194,43 +196,220 @@ def generate_periods(period, nb_periods=0, from_date=None, step_units=1,
         include_start_date=include_start_date)
 
 
+def _get_period_index(date_periods, field='created_at'):
+    """
+    Returns an expression evaluating to the index of the period
+    in *date_periods* a ``Transaction.created_at`` (or *field*) falls in.
+    """
+    # `date_periods` are in increasing order so the first `When` to match
+    # is the period a transaction falls in.
+    return Case(*[When(then=Value(idx), **{'%s__lt' % field: period_end})
+        for idx, period_end in enumerate(date_periods[1:])],
+        output_field=IntegerField())
+
+
+def start_of_day(at_time):
+    """
+    Returns the start of the day (UTC) *at_time* falls in, as used
+    by the daily metrics rollups.
+    """
+    return datetime_or_now(at_time).astimezone(timezone_or_utc()).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+
+
+def refresh_transaction_rollups(rebuild=False, using=None):
+    """
+    Adds the ``Transaction`` recorded since the last refresh
+    to the daily ``TransactionRollup``, and moves the high-water mark
+    past the last ``Transaction`` rolled up
+    (see `TransactionManager.get_committed_mark`).
+
+    When *rebuild* is ``True``, the rollups are recomputed from
+    the whole ledger. The rollups of days before transactions were
+    archived are kept as is since the transactions were replaced
+    by opening balances.
+
+    Returns the number of transactions rolled up.
+    """
+    fields = ['orig_organization', 'orig_account', 'orig_unit',
+        'dest_organization', 'dest_account', 'dest_unit']
+    nb_transactions = 0
+    # Only transactions that cannot be committed later on below the mark
+    # are rolled up, else they would never be once the mark moved past.
+    mark = Transaction.objects.get_committed_mark(using=using)
+    with transaction.atomic(using=using):
+        watermark, _unused = RollupWatermark.objects.using(
+            using).select_for_update().get_or_create(
+            name=RollupWatermark.TRANSACTIONS)
+        transactions = Transaction.objects.using(using).all()
+        if rebuild:
+            rollups = TransactionRollup.objects.using(using).all()
+            archive = RollupWatermark.objects.using(using).filter(
+                name=RollupWatermark.ARCHIVE, last_at__isnull=False).first()
+            if archive:
+                # Days that started before the archive cutoff are kept.
+                cutoff = start_of_day(archive.last_at)
+                if cutoff < archive.last_at:
+                    cutoff = start_of_day(
+                        archive.last_at + timedelta(days=1))
+                rollups = rollups.filter(day__gte=cutoff)
+                transactions = transactions.filter(created_at__gte=cutoff)
+            rollups.delete()
+            watermark.last_id = 0
+        # A concurrent refresh might have moved the mark further already.
+        mark = max(mark, watermark.last_id)
+        for row in transactions.committed_between(
+                watermark.last_id, mark).annotate(
+                day=TruncDay('created_at', tzinfo=timezone_or_utc())).values(
+                'day', *fields).annotate(
+                orig_total=Sum('orig_amount'),
+                dest_total=Sum('dest_amount'),
+                count=Count('pk')).order_by():
+            kwargs = {'%s_id' % field if field.endswith('organization')
+                else field: row[field] for field in fields}
+            if not TransactionRollup.objects.using(using).filter(
+                    day=row['day'], **kwargs).update(
+                    orig_amount=F('orig_amount') + row['orig_total'],
+                    dest_amount=F('dest_amount') + row['dest_total'],
+                    nb_transactions=F('nb_transactions') + row['count']):
+                TransactionRollup.objects.using(using).create(
+                    day=row['day'], orig_amount=row['orig_total'],
+                    dest_amount=row['dest_total'],
+                    nb_transactions=row['count'], **kwargs)
+            nb_transactions += row['count']
+        watermark.last_id = mark
+        watermark.save()
+    return nb_transactions
+
+
+def _split_at_rollups(start_at, ends_at, boundaries=None, **kwargs):
+    """
+    Returns a tuple (rollups, transactions) of querysets that together
+    cover the ``Transaction`` created in [*start_at*, *ends_at*[
+    and filtered by *kwargs*.
+
+    *rollups* is the ``TransactionRollup`` for the days before a cutoff date,
+    such that all *boundaries* before the cutoff fall at the start
+    of a day. *transactions* is the ``Transaction`` created
+    after the cutoff date (i.e. the current partial day) or not yet
+    rolled up. *rollups* is ``None`` when the rollups cannot be used.
+    """
+    if boundaries is None:
+        boundaries = []
+    transactions = Transaction.objects.filter(
+        created_at__gte=start_at, created_at__lt=ends_at, **kwargs)
+    watermark = RollupWatermark.objects.filter(
+        name=RollupWatermark.TRANSACTIONS).first()
+    if not watermark or not watermark.last_id:
+        return None, transactions
+    cutoff = start_of_day(ends_at)
+    for boundary in sorted(boundaries):
+        if start_of_day(boundary) != boundary:
+            cutoff = min(cutoff, start_of_day(boundary))
+            break
+    if cutoff <= start_at:
+        return None, transactions
+    rollups = TransactionRollup.objects.filter(
+        day__gte=start_at, day__lt=cutoff, **kwargs)
+    transactions = Transaction.objects.filter(
+        created_at__gte=cutoff, created_at__lt=ends_at, **kwargs) | \
+        Transaction.objects.committed_between(watermark.last_id).filter(
+        created_at__gte=start_at, created_at__lt=cutoff, **kwargs)
+    return rollups, transactions
+
+
 def aggregate_transactions_by_period(organization, account, date_periods,
                       orig='orig', dest='dest', **kwargs):
+    """
+    Returns the number of distinct *dest* organizations and the amounts
+    transfered from *organization* *account* in each period
+    of *date_periods*.
+
+    All periods are aggregated in a single query, bucketing transactions
+    by the period their ``created_at`` falls in. Days covered by the daily
+    rollups are aggregated from ``TransactionRollup`` instead.
+    """
     # pylint: disable=too-many-locals,too-many-arguments,invalid-name
     counts = []
     amounts = []
-    period_start = date_periods[0]
     unit = None
-    for period_end in date_periods[1:]:
-        # A bit ugly but it does the job ...
-        kwargs.update({'%s_organization' % orig: organization,
-            '%s_account' % orig: account})
-
+    # A bit ugly but it does the job ...
+    kwargs.update({'%s_organization' % orig: organization,
+        '%s_account' % orig: account})
+    by_periods = {}
+    if len(date_periods) > 1:
+        rollups, transactions = _split_at_rollups(
+            date_periods[0], date_periods[-1], boundaries=date_periods,
+            **kwargs)
+        querysets = [(transactions, 'created_at')]
+        if rollups is not None:
+            querysets += [(rollups, 'day')]
+        for queryset, field in querysets:
+            for row in queryset.annotate(
+                    period_index=_get_period_index(date_periods, field)).values(
+                    'period_index', '%s_organization' % dest,
+                    '%s_unit' % dest).annotate(
+                    sum=Sum('%s_amount' % dest)).order_by():
+                by_units = by_periods.setdefault(row['period_index'], {})
+                customers, amount = by_units.get(
+                    row['%s_unit' % dest], (set([]), 0))
+                customers.add(row['%s_organization' % dest])
+                by_units.update({row['%s_unit' % dest]: (
+                    customers, amount + (row['sum'] or 0))})
+    for idx, period_end in enumerate(date_periods[1:]):
         count, amount, _unit = 0, 0, None
-        query_result = Transaction.objects.filter(
-            created_at__gte=period_start,
-            created_at__lt=period_end, **kwargs).values(
-                '%s_unit' % dest).annotate(
-                    count=Count('%s_organization' % dest, distinct=True),
-                    sum=Sum('%s_amount' % dest))
-        if query_result:
-            count = query_result[0]['count']
-            amount = query_result[0]['sum']
-            _unit = query_result[0]['%s_unit' % dest]
+        by_units = by_periods.get(idx)
+        if by_units:
+            _unit = sorted(by_units)[0]
+            count = len(by_units[_unit][0])
+            amount = by_units[_unit][1]
             if _unit:
                 unit = _unit
         period = period_end
         counts += [(period, count)]
         amounts += [(period, int(amount or 0))]
-        period_start = period_end
 
     return (counts, amounts, unit)
 
 
+def _aggregate_transactions_in_window(buckets, start_idx, end_idx, unit,
+                                      excludes=None):
+    """
+    Returns a tuple (count, amount, customers) for the transactions
+    in *buckets* [*start_idx*, *end_idx*[ whose customer is not
+    in *excludes*.
+
+    *buckets* is a list of ``{customer: {unit: amount}}`` dictionnaries,
+    one for each interval between consecutive window boundaries. Only
+    customers and amounts in *unit* are counted while *customers* is
+    the set of all customers in the window, whatever the unit.
+    """
+    customers = set([])
+    amounts = {}
+    for bucket in buckets[start_idx:end_idx]:
+        for customer, by_units in six.iteritems(bucket):
+            customers.add(customer)
+            if excludes and customer in excludes:
+                continue
+            if unit in by_units:
+                amounts.update({
+                    customer: amounts.get(customer, 0) + by_units[unit]})
+    return len(amounts), sum(amounts.values()), customers
+
+
 def _aggregate_transactions_change_by_period(organization, account,
                             date_periods, orig='orig', dest='dest'):
     """
     Returns a table of records over *date_periods*.
+
+    All transactions in the periods (and the periods they are compared to)
+    are summed by customer and interval between window boundaries
+    in a single query, then the total, new and churned customers
+    are computed for each period from those sums.
+
+    When transactions are recorded in different units, only the unit
+    with the largest total amount (then the first in alphabetical order)
+    is reported.
     """
     #pylint:disable=too-many-locals,too-many-arguments,too-many-statements
     #pylint:disable=invalid-name
@@ -241,116 +420,72 @@ def _aggregate_transactions_change_by_period(organization, account,
     churn_customers = []
     churn_receivables = []
     unit = None
+    delta = Plan.get_natural_period(1, organization.natural_interval)
+    windows = []
     period_start = date_periods[0]
     for period_end in date_periods[1:]:
-        delta = Plan.get_natural_period(1, organization.natural_interval)
         prev_period_end = period_end - delta
         prev_period_start = prev_period_end - relativedelta(
             period_end, period_start)
-        LOGGER.debug(
-            "computes churn between periods ['%s', '%s'] and ['%s', '%s']",
-            prev_period_start.isoformat(), prev_period_end.isoformat(),
-            period_start.isoformat(), period_end.isoformat())
-        try:
-            churn_query = RawQuery(
-    """SELECT COUNT(DISTINCT(prev.%(dest)s_organization_id)),
-              SUM(prev.%(dest)s_amount),
-              prev.%(dest)s_unit
-           FROM saas_transaction prev
-           LEFT OUTER JOIN (
-             SELECT distinct(%(dest)s_organization_id), %(orig)s_unit
-               FROM saas_transaction
-               WHERE created_at >= '%(period_start)s'
-             AND created_at < '%(period_end)s'
-             AND %(orig)s_organization_id = '%(organization_id)s'
-             AND %(orig)s_account = '%(account)s'
-             ) curr
-             ON prev.%(dest)s_organization_id = curr.%(dest)s_organization_id
-           WHERE prev.created_at >= '%(prev_period_start)s'
-             AND prev.created_at < '%(prev_period_end)s'
-             AND prev.%(orig)s_organization_id = '%(organization_id)s'
-             AND prev.%(orig)s_account = '%(account)s'
-             AND curr.%(dest)s_organization_id IS NULL
-             GROUP BY prev.%(dest)s_unit
-             """ % {
-                    "orig": orig, "dest": dest,
-                    "prev_period_start": prev_period_start,
-                    "prev_period_end": prev_period_end,
-                    "period_start": period_start,
-                    "period_end": period_end,
-                    "organization_id": organization.id,
-                    "account": account}, router.db_for_read(Transaction))
-            churn_customer, churn_receivable, churn_receivable_unit = next(
-                iter(churn_query))
-            if churn_receivable_unit:
-                unit = churn_receivable_unit
-        except StopIteration:
-            churn_customer, churn_receivable, churn_receivable_unit = 0, 0, None
+        windows += [(prev_period_start, prev_period_end,
+            period_start, period_end)]
+        period_start = period_end
 
+    boundaries = sorted(set(
+        [boundary for window in windows for boundary in window]))
+    buckets = [{} for _unused in boundaries]
+    unit_amounts = {}
+    if windows:
         # A bit ugly but it does the job ...
-        if orig == 'orig':
-            kwargs = {'orig_organization': organization,
-                      'orig_account': account}
-        else:
-            kwargs = {'dest_organization': organization,
-                      'dest_account': account}
-
-        customer = 0
-        receivable = 0
-        receivable_unit = None
-        query_result = Transaction.objects.filter(
-            created_at__gte=period_start,
-            created_at__lt=period_end, **kwargs).values(
-                '%s_unit' % dest).annotate(
-                    count=Count('%s_organization' % dest, distinct=True),
-                    sum=Sum('%s_amount' % dest))
-        if query_result:
-            customer = query_result[0]['count']
-            receivable = query_result[0]['sum']
-            receivable_unit = query_result[0]['%s_unit' % dest]
-            if receivable_unit:
-                unit = receivable_unit
-
-        try:
-            new_query = RawQuery(
-    """SELECT count(distinct(curr.%(dest)s_organization_id)),
-              SUM(curr.%(dest)s_amount),
-              curr.%(dest)s_unit
-       FROM saas_transaction curr
-           LEFT OUTER JOIN (
-             SELECT distinct(%(dest)s_organization_id)
-               FROM saas_transaction
-               WHERE created_at >= '%(prev_period_start)s'
-             AND created_at < '%(prev_period_end)s'
-             AND %(orig)s_organization_id = '%(organization_id)s'
-             AND %(orig)s_account = '%(account)s') prev
-             ON curr.%(dest)s_organization_id = prev.%(dest)s_organization_id
-           WHERE curr.created_at >= '%(period_start)s'
-             AND curr.created_at < '%(period_end)s'
-             AND curr.%(orig)s_organization_id = '%(organization_id)s'
-             AND curr.%(orig)s_account = '%(account)s'
-             AND prev.%(dest)s_organization_id IS NULL
-             GROUP BY curr.%(dest)s_unit""" % {
-                    "orig": orig, "dest": dest,
-                    "prev_period_start": prev_period_start,
-                    "prev_period_end": prev_period_end,
-                    "period_start": period_start,
-                    "period_end": period_end,
-                    "organization_id": organization.id,
-                    "account": account}, router.db_for_read(Transaction))
-            new_customer, new_receivable, new_receivable_unit = next(
-                iter(new_query))
-            if new_receivable_unit:
-                unit = new_receivable_unit
-        except StopIteration:
-            new_customer, new_receivable, new_receivable_unit = 0, 0, None
-
-        units = get_different_units(churn_receivable_unit,
-            receivable_unit, new_receivable_unit)
-        if len(units) > 1:
+        kwargs = {'%s_organization' % orig: organization,
+                  '%s_account' % orig: account}
+        rollups, transactions = _split_at_rollups(
+            boundaries[0], boundaries[-1], boundaries=boundaries, **kwargs)
+        querysets = [(transactions, 'created_at')]
+        if rollups is not None:
+            # Each day rolled up falls in the same interval as
+            # the transactions it sums.
+            querysets += [(rollups, 'day')]
+        for queryset, field in querysets:
+            for row in queryset.annotate(
+                    bucket=_get_period_index(boundaries, field)).values(
+                    'bucket', '%s_organization' % dest,
+                    '%s_unit' % dest).annotate(
+                    amount=Sum('%s_amount' % dest)).order_by():
+                customer = row['%s_organization' % dest]
+                row_unit = row['%s_unit' % dest]
+                amount = row['amount'] or 0
+                by_units = buckets[row['bucket']].setdefault(customer, {})
+                by_units.update({row_unit: by_units.get(row_unit, 0) + amount})
+                unit_amounts.update({
+                    row_unit: unit_amounts.get(row_unit, 0) + amount})
+    if unit_amounts:
+        unit = sorted(six.iteritems(unit_amounts),
+            key=lambda item: (-item[1], item[0] or ""))[0][0]
+        if len(unit_amounts) > 1:
             LOGGER.error(
               "different units in _aggregate_transactions_change_by_period: %s",
-                units)
+                sorted(unit_amounts, key=lambda val: val or ""))
+
+    for prev_period_start, prev_period_end, period_start, period_end \
+        in windows:
+        LOGGER.debug(
+            "computes churn between periods ['%s', '%s'] and ['%s', '%s']",
+            prev_period_start.isoformat(), prev_period_end.isoformat(),
+            period_start.isoformat(), period_end.isoformat())
+        prev_start_idx = bisect_left(boundaries, prev_period_start)
+        prev_end_idx = bisect_left(boundaries, prev_period_end)
+        start_idx = bisect_left(boundaries, period_start)
+        end_idx = bisect_left(boundaries, period_end)
+        customer, receivable, curr_customers = \
+            _aggregate_transactions_in_window(buckets, start_idx, end_idx,
+                unit)
+        churn_customer, churn_receivable, prev_customers = \
+            _aggregate_transactions_in_window(buckets,
+                prev_start_idx, prev_end_idx, unit, excludes=curr_customers)
+        new_customer, new_receivable, _unused = \
+            _aggregate_transactions_in_window(buckets, start_idx, end_idx,
+                unit, excludes=prev_customers)
 
         period = period_end
         churn_customers += [(period, churn_customer)]
@@ -359,7 +494,6 @@ def _aggregate_transactions_change_by_period(organization, account,
         receivables += [(period, int(receivable or 0))]
         new_customers += [(period, new_customer)]
         new_receivables += [(period, int(new_receivable or 0))]
-        period_start = period_end
 
     return ((churn_customers, customers, new_customers),
             (churn_receivables, receivables, new_receivables), unit)
@@ -443,15 +577,69 @@ def abs_balances_by_period(organization=None, account=None, like_account=None,
 
 def balances_by_period(organization=None, account=None, like_account=None,
                        date_periods=None):
+    """
+    Returns the balance of *organization* and/or *account* at each
+    end of period in *date_periods*.
+
+    The balance at the first date is computed with
+    ``Transaction.objects.get_balance``. The amounts moved in and out
+    of the account during each period are then aggregated in a single query
+    per side (plus one on the daily rollups) and accumulated into running
+    balances.
+    """
+    #pylint:disable=too-many-locals
     values = []
     unit = None
-    for end_period in date_periods:
-        balance = Transaction.objects.get_balance(organization=organization,
-            account=account, like_account=like_account, ends_at=end_period)
-        values.append([end_period, balance['amount']])
-        _unit = balance.get('unit')
-        if _unit:
-            unit = _unit
+    if not date_periods:
+        return values, unit
+    balance = Transaction.objects.get_balance(organization=organization,
+        account=account, like_account=like_account, ends_at=date_periods[0])
+    balance_by_units = {}
+    if balance['amount']:
+        balance_by_units.update({balance['unit']: balance['amount']})
+
+    deltas_by_periods = {}
+    if len(date_periods) > 1:
+        for side, sign in (('dest', 1), ('orig', -1)):
+            kwargs = {}
+            if organization is not None:
+                kwargs.update({'%s_organization' % side: organization})
+            if account is not None:
+                kwargs.update({'%s_account' % side: account})
+            elif like_account is not None:
+                kwargs.update({'%s_account__icontains' % side: like_account})
+            rollups, transactions = _split_at_rollups(
+                date_periods[0], date_periods[-1], boundaries=date_periods,
+                **kwargs)
+            querysets = [(transactions, 'created_at')]
+            if rollups is not None:
+                querysets += [(rollups, 'day')]
+            for queryset, field in querysets:
+                for row in queryset.annotate(period_index=_get_period_index(
+                        date_periods, field)).values(
+                        'period_index', '%s_unit' % side).annotate(
+                        amount=Sum('%s_amount' % side)).order_by():
+                    deltas = deltas_by_periods.setdefault(
+                        row['period_index'], {})
+                    deltas.update({row['%s_unit' % side]: deltas.get(
+                        row['%s_unit' % side], 0) + sign * row['amount']})
+
+    for idx, end_period in enumerate(date_periods):
+        if idx > 0:
+            for _unit, amount in six.iteritems(
+                    deltas_by_periods.get(idx - 1, {})):
+                balance_by_units.update({
+                    _unit: balance_by_units.get(_unit, 0) + amount})
+        balances = [(_unit, amount)
+            for _unit, amount in six.iteritems(balance_by_units) if amount]
+        if len(balances) > 1:
+            raise ValueError(_("balances with multiple currency units (%s)") %
+                str(balances))
+        if balances:
+            unit, amount = balances[0]
+        else:
+            unit, amount = settings.DEFAULT_UNIT, 0
+        values.append([end_period, amount])
 
     return values, unit
 
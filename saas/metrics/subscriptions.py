@@ -23,77 +23,278 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
+from datetime import timedelta
 
-from django.db.models import F, Min, Max
+from django.db import transaction
+from django.db.models import Count, F, Min, Max, Q, Sum
 
-from ..compat import gettext_lazy as _
-from ..models import Subscription
+from ..compat import gettext_lazy as _, six
+from ..models import RollupWatermark, Subscription, SubscriptionRollup
+from .base import start_of_day
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def active_subscribers_by_period(plans=None, date_periods=None):
+def _count_subscribers_by_period(plans=None, date_periods=None, using=None):
     """
-    List of active subscribers for a set of *plans* for a specific time periods.
+    Counts of active, new and churned subscribers for each plan
+    in *plans* (or all plans) over *date_periods*, computed in a single
+    query on ``Subscription``.
     """
     if date_periods is None:
         date_periods = []
 
     kwargs = {}
-    if plans:
+    if plans is not None:
         kwargs = {'plan__in': plans}
 
-    values = []
-    for end_period in date_periods:
-        values.append([end_period,
-            Subscription.objects.active_at(end_period, **kwargs).count()])
+    annotations = {}
+    for idx, end_period in enumerate(date_periods):
+        annotations.update({'active_%d' % idx: Count('pk', filter=Q(
+            created_at__lte=end_period, ends_at__gt=end_period))})
+        if idx > 0:
+            start_period = date_periods[idx - 1]
+            annotations.update({
+                'new_%d' % idx: Count('pk', filter=Q(
+                    created_at__gte=start_period, created_at__lt=end_period)),
+                'churn_%d' % idx: Count('pk', filter=Q(
+                    ends_at__gte=start_period, ends_at__lt=end_period))})
 
-    return values
+    results = {}
+    if not annotations:
+        return results
+    for row in Subscription.objects.db_manager(using).valid_for(
+            **kwargs).values('plan').annotate(**annotations).order_by():
+        results.update({row['plan']: {
+            'active': [[end_period, row['active_%d' % idx]]
+                for idx, end_period in enumerate(date_periods)],
+            'new': [[end_period, row['new_%d' % idx]]
+                for idx, end_period in enumerate(date_periods) if idx > 0],
+            'churn': [[end_period, row['churn_%d' % idx]]
+                for idx, end_period in enumerate(date_periods) if idx > 0]}})
+    return results
 
 
-def new_subscribers_by_period(plans=None, date_periods=None):
+def _rollup_subscribers_by_period(plans=None, date_periods=None):
     """
-    List of churn subscribers from the previous period for a set of *plans*
-    for a specific time periods.
+    Counts of active, new and churned subscribers for each plan
+    in *plans* (or all plans) over *date_periods*, computed in a single
+    query on the daily ``SubscriptionRollup``.
+
+    All dates in *date_periods* must fall at the start of a day
+    before the rollups high-water mark.
     """
     if date_periods is None:
         date_periods = []
 
     kwargs = {}
-    if plans:
+    if plans is not None:
         kwargs = {'plan__in': plans}
 
-    values = []
-    start_period = date_periods[0]
-    for end_period in date_periods[1:]:
-        values.append([end_period, Subscription.objects.new_in_period(
-            start_period, end_period, **kwargs).count()])
-        start_period = end_period
+    annotations = {}
+    for idx, end_period in enumerate(date_periods):
+        annotations.update({'active_%d' % idx: Sum('nb_active', filter=Q(
+            day=end_period))})
+        if idx > 0:
+            start_period = date_periods[idx - 1]
+            annotations.update({
+                'new_%d' % idx: Sum('nb_new', filter=Q(
+                    day__gte=start_period, day__lt=end_period)),
+                'churn_%d' % idx: Sum('nb_churned', filter=Q(
+                    day__gte=start_period, day__lt=end_period))})
+
+    results = {}
+    if not annotations:
+        return results
+    for row in SubscriptionRollup.objects.filter(
+            day__gte=date_periods[0], day__lte=date_periods[-1],
+            **kwargs).values('plan').annotate(**annotations).order_by():
+        results.update({row['plan']: {
+            'active': [[end_period, row['active_%d' % idx] or 0]
+                for idx, end_period in enumerate(date_periods)],
+            'new': [[end_period, row['new_%d' % idx] or 0]
+                for idx, end_period in enumerate(date_periods) if idx > 0],
+            'churn': [[end_period, row['churn_%d' % idx] or 0]
+                for idx, end_period in enumerate(date_periods) if idx > 0]}})
+    return results
+
+
+def subscribers_by_period(plans=None, date_periods=None):
+    """
+    Counts of active, new and churned subscribers for each plan in *plans*
+    (or all plans) over *date_periods*.
+
+    Returns a dictionnary keyed by plan id as such:
+
+        {
+            plan_id: {
+                'active': [[end_period, count], ...],
+                'new': [[end_period, count], ...],
+                'churn': [[end_period, count], ...]
+            }
+        }
+
+    Active subscribers are counted at each date in *date_periods* while
+    new and churned subscribers are counted in each period between two
+    consecutive dates.
+
+    Days covered by the daily rollups are counted from ``SubscriptionRollup``
+    while the current partial day is counted from ``Subscription``.
+    """
+    #pylint:disable=too-many-locals
+    if date_periods is None:
+        date_periods = []
+
+    watermark = RollupWatermark.objects.filter(
+        name=RollupWatermark.SUBSCRIPTIONS).first()
+    if not watermark or not watermark.last_at or len(date_periods) < 2:
+        return _count_subscribers_by_period(
+            plans=plans, date_periods=date_periods)
+    cutoff = min(start_of_day(date_periods[-1]), watermark.last_at)
+    if (cutoff <= date_periods[0] or
+        any([start_of_day(end_period) != end_period
+            for end_period in date_periods if end_period <= cutoff])):
+        return _count_subscribers_by_period(
+            plans=plans, date_periods=date_periods)
+
+    # We count over the dates in `date_periods` plus the cutoff date,
+    # then merge the period split by the cutoff date back together.
+    dates = sorted(set(date_periods) | set([cutoff]))
+    rollups = _rollup_subscribers_by_period(plans=plans,
+        date_periods=[end_period for end_period in dates
+            if end_period <= cutoff])
+    counts = _count_subscribers_by_period(plans=plans,
+        date_periods=[end_period for end_period in dates
+            if end_period >= cutoff])
+    results = {}
+    for plan_id in set(rollups.keys()) | set(counts.keys()):
+        by_dates = {}
+        for source in (rollups, counts):
+            by_plan = source.get(plan_id)
+            if not by_plan:
+                continue
+            for end_period, count in by_plan['active']:
+                if end_period < cutoff or source is counts:
+                    by_dates.setdefault(end_period, {}).update({
+                        'active': count})
+            for key in ('new', 'churn'):
+                for end_period, count in by_plan[key]:
+                    by_dates.setdefault(end_period, {}).update({key: count})
+        active, new, churn = [], [], []
+        nb_new, nb_churn = 0, 0
+        for idx, end_period in enumerate(dates):
+            counts_at = by_dates.get(end_period, {})
+            nb_new += counts_at.get('new', 0)
+            nb_churn += counts_at.get('churn', 0)
+            if end_period in date_periods:
+                active += [[end_period, counts_at.get('active', 0)]]
+                if idx > 0:
+                    new += [[end_period, nb_new]]
+                    churn += [[end_period, nb_churn]]
+                nb_new, nb_churn = 0, 0
+        results.update({plan_id: {
+            'active': active, 'new': new, 'churn': churn}})
+    return results
+
+
+def refresh_subscription_rollups(until=None, rebuild=False, using=None):
+    """
+    Adds the ``SubscriptionRollup`` for all days since the last refresh
+    until the start of the day *until* falls in, and moves the high-water
+    mark to that date.
+
+    When *rebuild* is ``True``, the rollups are recomputed starting
+    from the first subscription created (or ended).
+
+    Returns the number of days rolled up.
+    """
+    until = start_of_day(until)
+    nb_days = 0
+    with transaction.atomic(using=using):
+        watermark, _unused = RollupWatermark.objects.using(
+            using).select_for_update().get_or_create(
+            name=RollupWatermark.SUBSCRIPTIONS)
+        if rebuild:
+            SubscriptionRollup.objects.using(using).all().delete()
+            watermark.last_at = None
+        start_at = watermark.last_at
+        if not start_at:
+            first_dates = Subscription.objects.using(using).aggregate(
+                Min('created_at'), Min('ends_at'))
+            start_at = until
+            for first_date in six.itervalues(first_dates):
+                if first_date:
+                    start_at = min(start_at, start_of_day(first_date))
+        while start_at < until:
+            days = [start_at + timedelta(days=idx)
+                for idx in range(0, min(31, (until - start_at).days) + 1)]
+            counts = _count_subscribers_by_period(
+                date_periods=days, using=using)
+            rollups = []
+            for plan_id, by_plan in six.iteritems(counts):
+                for idx, day in enumerate(days[:-1]):
+                    nb_active = by_plan['active'][idx][1]
+                    nb_new = by_plan['new'][idx][1]
+                    nb_churned = by_plan['churn'][idx][1]
+                    if nb_active or nb_new or nb_churned:
+                        rollups += [SubscriptionRollup(day=day,
+                            plan_id=plan_id, nb_active=nb_active,
+                            nb_new=nb_new, nb_churned=nb_churned)]
+            SubscriptionRollup.objects.using(using).bulk_create(
+                rollups, batch_size=1000)
+            nb_days += len(days) - 1
+            start_at = days[-1]
+        watermark.last_at = max(start_at, until)
+        watermark.save()
+    return nb_days
+
 
+def _sum_subscribers_by_period(subscribers, key, date_periods):
+    """
+    Sums the *key* counts in *subscribers*, as returned by
+    `subscribers_by_period`, over all plans.
+    """
+    if key == 'active':
+        values = [[end_period, 0] for end_period in date_periods]
+    else:
+        values = [[end_period, 0] for end_period in date_periods[1:]]
+    for by_plan in subscribers.values():
+        for value, plan_value in zip(values, by_plan[key]):
+            value[1] += plan_value[1]
     return values
 
 
-def churn_subscribers_by_period(plans=None, date_periods=None):
+def active_subscribers_by_period(plans=None, date_periods=None):
+    """
+    List of active subscribers for a set of *plans* for a specific time periods.
+    """
+    if date_periods is None:
+        date_periods = []
+    return _sum_subscribers_by_period(subscribers_by_period(
+        plans=plans, date_periods=date_periods), 'active', date_periods)
+
+
+def new_subscribers_by_period(plans=None, date_periods=None):
     """
     List of churn subscribers from the previous period for a set of *plans*
     for a specific time periods.
     """
     if date_periods is None:
         date_periods = []
+    return _sum_subscribers_by_period(subscribers_by_period(
+        plans=plans, date_periods=date_periods), 'new', date_periods)
 
-    kwargs = {}
-    if plans:
-        kwargs = {'plan__in': plans}
 
-    values = []
-    start_period = date_periods[0]
-    for end_period in date_periods[1:]:
-        values.append([end_period, Subscription.objects.churn_in_period(
-            start_period, end_period, **kwargs).count()])
-        start_period = end_period
-
-    return values
+def churn_subscribers_by_period(plans=None, date_periods=None):
+    """
+    List of churn subscribers from the previous period for a set of *plans*
+    for a specific time periods.
+    """
+    if date_periods is None:
+        date_periods = []
+    return _sum_subscribers_by_period(subscribers_by_period(
+        plans=plans, date_periods=date_periods), 'churn', date_periods)
 
 
 def subscribers_age(provider=None):
@@ -175,13 +376,14 @@ def subscribers_metrics(provider, date_periods):
         ]
     }
     """
-    plans = provider.plans.all()
-    active_subscribers = active_subscribers_by_period(
-        plans=plans, date_periods=date_periods)
-    new_subscribers = new_subscribers_by_period(
-        plans=plans, date_periods=date_periods)
-    churned_subscribers = churn_subscribers_by_period(
-        plans=plans, date_periods=date_periods)
+    subscribers = subscribers_by_period(
+        plans=provider.plans.all(), date_periods=date_periods)
+    active_subscribers = _sum_subscribers_by_period(
+        subscribers, 'active', date_periods)
+    new_subscribers = _sum_subscribers_by_period(
+        subscribers, 'new', date_periods)
+    churned_subscribers = _sum_subscribers_by_period(
+        subscribers, 'churn', date_periods)
 
     resp = {
         'title': "Subscribers",
@@ -30,7 +30,7 @@ from django.db.models.sql.query import RawQuery
 
 from .. import settings
 from ..compat import gettext_lazy as _, six
-from ..models import Transaction, is_sqlite3
+from ..models import Transaction
 from .base import (aggregate_transactions_by_period,
     aggregate_transactions_change_by_period, get_different_units)
 
@@ -127,14 +127,6 @@ GROUP BY saas_organization.slug, matched_transfers_payments.dest_unit""" % {
                 by_profiles[organization_slug][unit].update({account: amount})
 
     # deferred revenue
-    if is_sqlite3(router.db_for_read(Transaction)):
-        extract_number = 'substr(saas_transaction.event_id, 5)'
-    else:
-        # We would use `substr(saas_transaction.event_id, 5)` which is syntax-
-        # compatible if it were not for Postgresql to through an execption on
-        # the trailing '/' character.
-        extract_number = (
-            r"substring(saas_transaction.event_id from 'sub_(\d+)/')")
     deferred_revenues_query = """
 SELECT saas_organization.slug, saas_transaction.dest_unit,
   SUM(saas_transaction.dest_amount)
@@ -144,13 +136,11 @@ INNER JOIN saas_subscription
 INNER JOIN saas_plan
   ON saas_subscription.plan_id = saas_plan.id
 INNER JOIN saas_transaction
-  ON cast(%(extract_number)s AS integer)
-     = saas_subscription.id
+  ON saas_transaction.event_subscription_id = saas_subscription.id
 WHERE saas_transaction.dest_account = '%(backlog)s'
 %(provider_clause)s
 GROUP BY saas_organization.slug, saas_transaction.dest_unit
 """ % {'backlog': Transaction.BACKLOG,
-       'extract_number': extract_number,
        'provider_clause': ("AND saas_plan.organization_id = %d" % provider.pk
             if provider else "")}
     for row in RawQuery(deferred_revenues_query,
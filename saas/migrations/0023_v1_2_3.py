@@ -0,0 +1,324 @@
+# Generated by Django 4.2.29 on 2026-10-17 09:12
+
+import datetime, re
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Max, Q, Sum
+
+
+def populate_account_balances(apps, schema_editor):
+    #pylint:disable=unused-argument
+    transaction_model = apps.get_model('saas', 'Transaction')
+    account_balance_model = apps.get_model('saas', 'AccountBalance')
+    balances = {}
+    for side, sign in (('dest', 1), ('orig', -1)):
+        fields = ['%s_organization' % side, '%s_account' % side,
+            '%s_unit' % side]
+        for by_event in (False, True):
+            if by_event:
+                rows = transaction_model.objects.exclude(
+                    event_id__isnull=True).exclude(event_id="").values(
+                    *(fields + ['event_id']))
+            else:
+                rows = transaction_model.objects.values(*fields)
+            for row in rows.annotate(balance=Sum('%s_amount' % side),
+                    last_activity=Max('created_at')).order_by():
+                key = (row[fields[0]], row[fields[1]], row[fields[2]],
+                    row['event_id'] if by_event else "")
+                if key not in balances:
+                    balances[key] = [0, row['last_activity']]
+                balances[key][0] += sign * row['balance']
+                balances[key][1] = max(balances[key][1], row['last_activity'])
+    account_balance_model.objects.bulk_create([account_balance_model(
+        organization_id=key[0], account=key[1], unit=key[2], event_id=key[3],
+        amount=val[0], last_activity_at=val[1])
+        for key, val in balances.items()], batch_size=1000)
+
+
+def populate_event_refs(apps, schema_editor):
+    #pylint:disable=unused-argument
+    transaction_model = apps.get_model('saas', 'Transaction')
+    coupon_model = apps.get_model('saas', 'Coupon')
+    coupons = {}
+    for coupon in coupon_model.objects.all().values(
+            'pk', 'code', 'organization_id'):
+        coupons.update({(coupon['organization_id'], coupon['code']):
+            coupon['pk']})
+        coupons.setdefault((None, coupon['code']), coupon['pk'])
+    batch = []
+    for entry in transaction_model.objects.filter(
+            Q(event_id__startswith='sub_') | Q(event_id__startswith='cha_')
+            | Q(event_id__startswith='cpn_')).iterator(chunk_size=1000):
+        look = re.match(r'^sub_(\d+)/((\d+)/)?', entry.event_id)
+        if look:
+            entry.event_subscription_id = int(look.group(1)) or None
+            if look.group(3):
+                entry.event_use_charge_id = int(look.group(3))
+        look = re.match(r'^cha_(\d+)/', entry.event_id)
+        if look:
+            entry.event_charge_id = int(look.group(1))
+        if entry.event_id.startswith('cpn_'):
+            code = entry.event_id
+            entry.event_coupon_id = coupons.get(
+                (entry.dest_organization_id, code), coupons.get(
+                (entry.orig_organization_id, code), coupons.get(
+                (None, code))))
+        batch += [entry]
+        if len(batch) >= 1000:
+            transaction_model.objects.bulk_update(batch, ['event_subscription',
+                'event_use_charge', 'event_charge', 'event_coupon'])
+            batch = []
+    if batch:
+        transaction_model.objects.bulk_update(batch, ['event_subscription',
+            'event_use_charge', 'event_charge', 'event_coupon'])
+
+
+def partition_transactions(apps, schema_editor):
+    #pylint:disable=unused-argument
+    from saas import settings as saas_settings
+    if (saas_settings.TRANSACTION_PARTITIONS and
+        schema_editor.connection.vendor == 'postgresql'):
+        from saas.partitions import partition_transactions as partition
+        partition(using=schema_editor.connection.alias)
+
+
+def create_xid_trigger(apps, schema_editor):
+    #pylint:disable=unused-argument
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # Rows written before the trigger existed are older than any mark.
+    schema_editor.execute("UPDATE saas_transaction SET xid = 0")
+    schema_editor.execute("CREATE FUNCTION saas_transaction_xid()"\
+        " RETURNS trigger AS $$ BEGIN"\
+        " IF NEW.xid IS NULL THEN NEW.xid := txid_current(); END IF;"\
+        " RETURN NEW; END; $$ LANGUAGE plpgsql")
+    schema_editor.execute("CREATE TRIGGER saas_transaction_xid"\
+        " BEFORE INSERT ON saas_transaction"\
+        " FOR EACH ROW EXECUTE PROCEDURE saas_transaction_xid()")
+
+
+def drop_xid_trigger(apps, schema_editor):
+    #pylint:disable=unused-argument
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "DROP TRIGGER IF EXISTS saas_transaction_xid ON saas_transaction")
+    schema_editor.execute("DROP FUNCTION IF EXISTS saas_transaction_xid()")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0022_v1_2_0'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(help_text='Account the balance is computed for', max_length=255)),
+                ('unit', models.CharField(default='usd', help_text='Three-letter ISO 4217 code for currency unit (ex: usd)', max_length=3)),
+                ('event_id', models.SlugField(blank=True, default='', help_text='Event the balance is restricted to (blank for all)')),
+                ('amount', models.BigIntegerField(default=0, help_text='Sum of amounts deposited minus sum of amounts withdrawn')),
+                ('last_activity_at', models.DateTimeField(help_text='Date/time of the most recent Transaction in the balance (in ISO format)', null=True)),
+                ('organization', models.ForeignKey(help_text='Billing profile the balance is computed for', on_delete=django.db.models.deletion.CASCADE, related_name='account_balances', to=settings.SAAS_ORGANIZATION_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['event_id', 'account'], name='saas_accoun_event_i_d4f2da_idx')],
+                'unique_together': {('organization', 'account', 'unit', 'event_id')},
+            },
+        ),
+        migrations.RunPython(populate_account_balances,
+            migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='transaction',
+            name='event_charge',
+            field=models.ForeignKey(db_constraint=False, help_text='Charge refered to by event_id', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='transactions', to='saas.charge'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='event_coupon',
+            field=models.ForeignKey(db_constraint=False, help_text='Coupon refered to by event_id', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='transactions', to='saas.coupon'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='event_subscription',
+            field=models.ForeignKey(db_constraint=False, help_text='Subscription refered to by event_id', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='transactions', to='saas.subscription'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='event_use_charge',
+            field=models.ForeignKey(db_constraint=False, help_text='UseCharge refered to by event_id', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='transactions', to='saas.usecharge'),
+        ),
+        migrations.RunPython(populate_event_refs,
+            migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ClosingBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(help_text='Account the balance is computed for', max_length=255)),
+                ('unit', models.CharField(default='usd', help_text='Three-letter ISO 4217 code for currency unit (ex: usd)', max_length=3)),
+                ('period_end', models.DateTimeField(help_text='Date/time at which the period was closed (in ISO format)')),
+                ('amount', models.BigIntegerField(default=0, help_text='Sum of amounts deposited minus sum of amounts withdrawn before the end of the period')),
+                ('organization', models.ForeignKey(help_text='Billing profile the balance is computed for', on_delete=django.db.models.deletion.CASCADE, related_name='closing_balances', to=settings.SAAS_ORGANIZATION_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period_end', 'account'], name='saas_closin_period__15211d_idx')],
+                'unique_together': {('organization', 'account', 'unit', 'period_end')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(help_text='Rollup the high-water mark is recorded for', unique=True)),
+                ('last_id', models.BigIntegerField(default=0, help_text='Mark of the last Transaction rolled up')),
+                ('last_at', models.DateTimeField(help_text='Rollups are complete for days before this date/time (in ISO format)', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TransactionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateTimeField(help_text='Start of the day (UTC) the transactions were created')),
+                ('orig_account', models.CharField(help_text='Source account from which funds are withdrawn', max_length=255)),
+                ('orig_unit', models.CharField(default='usd', help_text='Three-letter ISO 4217 code for source currency unit (ex: usd)', max_length=3)),
+                ('orig_amount', models.BigIntegerField(default=0, help_text='Sum of amounts withdrawn from the source')),
+                ('dest_account', models.CharField(help_text='Target account to which funds are deposited', max_length=255)),
+                ('dest_unit', models.CharField(default='usd', help_text='Three-letter ISO 4217 code for target currency unit (ex: usd)', max_length=3)),
+                ('dest_amount', models.BigIntegerField(default=0, help_text='Sum of amounts deposited into the target')),
+                ('nb_transactions', models.PositiveIntegerField(default=0, help_text='Number of transactions rolled up')),
+                ('dest_organization', models.ForeignKey(help_text='Billing profile to which funds are deposited', on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.SAAS_ORGANIZATION_MODEL)),
+                ('orig_organization', models.ForeignKey(help_text='Billing profile from which funds are withdrawn', on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.SAAS_ORGANIZATION_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['orig_organization', 'orig_account', 'day'], name='saas_transa_orig_or_4e63c9_idx'), models.Index(fields=['dest_organization', 'dest_account', 'day'], name='saas_transa_dest_or_132536_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubscriptionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateTimeField(help_text='Start of the day (UTC) the counts are computed for')),
+                ('nb_active', models.PositiveIntegerField(default=0, help_text='Number of active subscriptions at the start of the day')),
+                ('nb_new', models.PositiveIntegerField(default=0, help_text='Number of subscriptions created during the day')),
+                ('nb_churned', models.PositiveIntegerField(default=0, help_text='Number of subscriptions ended during the day')),
+                ('plan', models.ForeignKey(help_text='Plan the counts are computed for', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='saas.plan')),
+            ],
+            options={
+                'unique_together': {('plan', 'day')},
+            },
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='income_recognized_until',
+            field=models.DateTimeField(blank=True, help_text='Income was recognized for all periods before this date/time (in ISO format)', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['auto_renew', 'ends_at'], name='saas_subscr_auto_re_d9eed8_idx'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='card_brand',
+            field=models.CharField(blank=True, help_text='Brand of the card on file', max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='card_exp_date',
+            field=models.DateField(blank=True, help_text='Expiration date of the card on file (first day of the month)', null=True),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='card_last4',
+            field=models.CharField(blank=True, help_text='Last 4 digits of the card on file', max_length=4, null=True),
+        ),
+        migrations.CreateModel(
+            name='RenewalsJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('at_time', models.DateTimeField(help_text='Date/time the renewals run for (in ISO format)')),
+                ('shard', models.CharField(blank=True, default='', help_text='Shard of organizations (i/N) the run processes', max_length=20)),
+                ('phase', models.SlugField(help_text='Phase of the renewals run')),
+                ('last_organization_id', models.BigIntegerField(help_text='Last organization fully processed in the phase', null=True)),
+                ('nb_processed', models.PositiveIntegerField(default=0, help_text='Number of items (renewals, charges, notices, etc.) processed in the phase')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Date/time the phase first started (in ISO format)')),
+                ('completed_at', models.DateTimeField(help_text='Date/time the phase completed (in ISO format)', null=True)),
+                ('duration', models.DurationField(default=datetime.timedelta, help_text='Time spent running the phase, across resumes')),
+            ],
+            options={
+                'unique_together': {('at_time', 'shard', 'phase')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DueEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_at', models.DateTimeField(db_index=True, help_text='Date/time at which the event is due (in ISO format)')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'renewal'), (2, 'expiration-notice'), (3, 'charge')], help_text='Kind of work to do when the event is due')),
+                ('nb_days', models.PositiveSmallIntegerField(help_text='Number of days before the end of the subscription (expiration notices)', null=True)),
+                ('nb_attempts', models.PositiveSmallIntegerField(default=0, help_text='Number of times processing the event failed')),
+                ('organization', models.ForeignKey(help_text='Billing profile the event applies to', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.SAAS_ORGANIZATION_MODEL)),
+                ('subscription', models.ForeignKey(help_text='Subscription the event applies to', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='saas.subscription')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['dest_account', 'created_at'], name='saas_transa_dest_ac_2daaf0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['orig_account', 'created_at'], name='saas_transa_orig_ac_268650_idx'),
+        ),
+        migrations.CreateModel(
+            name='LedgerChecksum',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(help_text='Account the checksum is computed for', max_length=255)),
+                ('unit', models.CharField(default='usd', help_text='Three-letter ISO 4217 code for currency unit (ex: usd)', max_length=3)),
+                ('amount', models.BigIntegerField(default=0, help_text='Sum of amounts deposited minus sum of amounts withdrawn')),
+                ('nb_transactions', models.PositiveIntegerField(default=0, help_text='Number of transactions to or from the account')),
+                ('organization', models.ForeignKey(help_text='Billing profile the checksum is computed for', on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.SAAS_ORGANIZATION_MODEL)),
+            ],
+            options={
+                'unique_together': {('organization', 'account', 'unit')},
+            },
+        ),
+        # Foreign keys referencing a partitioned table must include
+        # the partition key, so they are not enforced by the database.
+        migrations.AlterField(
+            model_name='chargeitem',
+            name='invoiced',
+            field=models.ForeignKey(db_constraint=False, help_text='Transaction invoiced through this charge', on_delete=django.db.models.deletion.PROTECT, related_name='invoiced_item', to='saas.transaction'),
+        ),
+        migrations.AlterField(
+            model_name='chargeitem',
+            name='invoiced_broker_fee',
+            field=models.ForeignKey(db_constraint=False, help_text='Fee transaction to broker in order to process the transaction invoiced through this charge', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='invoiced_broker_fee_item', to='saas.transaction'),
+        ),
+        migrations.AlterField(
+            model_name='chargeitem',
+            name='invoiced_distribute',
+            field=models.ForeignKey(db_constraint=False, help_text='Transaction recording the distribution from processor to provider.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='invoiced_distribute', to='saas.transaction'),
+        ),
+        migrations.AlterField(
+            model_name='chargeitem',
+            name='invoiced_processor_fee',
+            field=models.ForeignKey(db_constraint=False, help_text='Fee transaction to processor in order to process the transaction invoiced through this charge', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='invoiced_processor_fee_item', to='saas.transaction'),
+        ),
+        migrations.RunPython(partition_transactions,
+            migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='transaction',
+            name='xid',
+            field=models.BigIntegerField(editable=False, help_text='Database transaction the row was inserted in', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['xid'], name='saas_transa_xid_aed4b3_idx'),
+        ),
+        migrations.RunPython(create_xid_trigger, drop_xid_trigger),
+    ]
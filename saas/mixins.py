@@ -77,13 +77,16 @@ class BalanceDueMixin(object):
         at_time = datetime_or_now(at_time)
         balances = Transaction.objects.get_statement_balances(
             customer, until=at_time)
+        subscriptions = {entry.event_id: entry.subscription
+            for entry in Transaction.objects.resolve_events([
+                Transaction(event_id=event_id) for event_id in balances])}
         for event_id, amount_by_units in six.iteritems(balances):
             if not (event_id and event_id.startswith('sub_')):
                 # XXX Not showing balance due on group buy events.
                 LOGGER.error("Looking at a balance %s on event_id '%s'",
                     amount_by_units, event_id)
                 continue
-            subscription = Subscription.objects.get_by_event_id(event_id)
+            subscription = subscriptions.get(event_id)
             last_unpaid_orders = customer.last_unpaid_orders(
                 subscription=subscription, at_time=at_time)
             order_balances = sum_orig_amount(last_unpaid_orders)
@@ -788,11 +791,11 @@ class InvoicablesMixin(OrganizationMixin):
     def invoicables_provider(self):
         if not hasattr(self, '_invoicables_provider'):
             organization_model = get_organization_model()
-            providers = set([])
+            invoiced_items = []
             for invoicable in self.invoicables:
-                providers |= set(
-                    organization_model.objects.receivable_providers(
-                        invoicable['lines']))
+                invoiced_items += invoicable['lines']
+            providers = set(organization_model.objects.receivable_providers(
+                invoiced_items))
             if len(providers) == 1:
                 self._invoicables_provider = list(providers)[0]
             else:
@@ -1386,7 +1389,8 @@ class MetricsDownloadMixin(object):
 
 def _as_html_description(transaction_descr,
                          orig_organization=None, dest_organization=None,
-                         dest_account=None, request=None, force_links=False):
+                         dest_account=None, request=None, force_links=False,
+                         event=None):
     #pylint:disable=too-many-arguments,too-many-locals
     active_links = force_links or (request is not None)
     result = transaction_descr
@@ -1436,10 +1440,17 @@ def _as_html_description(transaction_descr,
 
             plan = groups.get('plan')
             if (plan and provider and subscriber):
-                try:
-                    plan_title = Plan.objects.get(slug=plan).title
-                except Plan.DoesNotExist:
-                    plan_title = plan
+                # The plan of an event resolved ahead of time
+                # (see `TransactionManager.resolve_events`) saves a query.
+                event_plan = getattr(getattr(event, 'subscription', event),
+                    'plan', None)
+                if event_plan and event_plan.slug == plan:
+                    plan_title = event_plan.title
+                else:
+                    try:
+                        plan_title = Plan.objects.get(slug=plan).title
+                    except Plan.DoesNotExist:
+                        plan_title = plan
                 if active_links:
                     groups.update({'plan':
                         ('<a href="%s">%s</a>' % (
@@ -1467,13 +1478,18 @@ def as_html_description(transaction_model, request=None, force_links=False):
     """
     Add hyperlinks into a transaction description.
     """
+    event = None
+    if hasattr(transaction_model, '_event'):
+        # Only use the event if it was already resolved.
+        event = transaction_model.get_event()
     return _as_html_description(
         transaction_model.descr,
         transaction_model.orig_organization,
         transaction_model.dest_organization,
         transaction_model.dest_account,
         request=request,
-        force_links=force_links)
+        force_links=force_links,
+        event=event)
 
 
 def get_charge_context(charge):
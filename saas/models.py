@@ -65,12 +65,14 @@ import datetime, logging, re
 
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.exceptions import (ObjectDoesNotExist,
+    ValidationError as DjangoValidationError)
 from django.db import (DatabaseError, IntegrityError, connections, models,
-    transaction)
-from django.db.models import F, Max, Q, Sum
+    router, transaction)
+from django.db.models import Case, F, Max, Q, Sum, Value, When
+from django.db.models.functions import Greatest
 from django.db.models.query import QuerySet
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save, pre_save
 from django.db.utils import DEFAULT_DB_ALIAS
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
@@ -219,14 +221,19 @@ class OrganizationManager(models.Manager):
         Returns a list of unique providers referenced by *invoiced_items*.
         """
         results = set([])
-        for invoiced_item in invoiced_items:
+        orig_organization_ids = set([])
+        for invoiced_item in Transaction.objects.resolve_events(
+                invoiced_items):
             assert invoiced_item.orig_account in (Transaction.RECEIVABLE,
                 Transaction.SETTLED)
-            results |= set([invoiced_item.orig_organization])
+            orig_organization_ids |= set([invoiced_item.orig_organization_id])
             event = invoiced_item.get_event() # Subscription,
                                               # or Coupon (i.e. Group buy)
             if event:
                 results |= set([event.provider])
+        orig_organization_ids -= set([result.pk for result in results])
+        if orig_organization_ids:
+            results |= set(self.filter(pk__in=orig_organization_ids))
         return list(results)
 
 
@@ -328,6 +335,15 @@ class AbstractOrganization(models.Model):
         settings.ORGANIZATION_MODEL, null=True, blank=True,
         on_delete=models.SET_NULL, related_name='processes',)
     processor_card_key = models.SlugField(max_length=255, null=True, blank=True)
+    # Local copy of the payment method on file such that expiration notices
+    # can be generated without calling the processor.
+    card_brand = models.CharField(max_length=20, null=True, blank=True,
+        help_text=_("Brand of the card on file"))
+    card_last4 = models.CharField(max_length=4, null=True, blank=True,
+        help_text=_("Last 4 digits of the card on file"))
+    card_exp_date = models.DateField(null=True, blank=True,
+        help_text=_("Expiration date of the card on file (first day"\
+        " of the month)"))
     processor_deposit_key = models.SlugField(max_length=255, null=True,
         blank=True,
         help_text=_("Used to deposit funds to the organization bank account"))
@@ -768,10 +784,40 @@ class AbstractOrganization(models.Model):
                     'processor_deposit_key': self.processor_deposit_key})
         signals.bank_updated.send(self)
 
+    def cache_card(self, card):
+        """
+        Keeps a local copy of the brand, last 4 digits and expiration date
+        of *card* (as returned by ``retrieve_card``).
+
+        The caller is responsible to ``save`` the organization.
+        """
+        self.card_brand = card.get('brand') if card else None
+        self.card_last4 = None
+        self.card_exp_date = None
+        if not card:
+            return
+        # `last4` is formatted as '***-4242' by some processors. We keep
+        # the digits as a string, such that leading zeros are preserved.
+        last4 = str(card.get('last4') or '').split('-')[-1]
+        if last4:
+            self.card_last4 = last4[-4:]
+        exp_date = card.get('exp_date')
+        if isinstance(exp_date, datetime.date):
+            self.card_exp_date = exp_date.replace(day=1)
+            return
+        try:
+            exp_month, exp_year = exp_date.split('/')
+            self.card_exp_date = datetime.date(
+                int(exp_year), int(exp_month), 1)
+        except (AttributeError, ValueError):
+            # exp info is missing or the format is incorrect
+            pass
+
     def delete_card(self):
         broker = get_broker()
         broker.processor_backend.delete_card(self, broker=broker)
         self.processor_card_key = None
+        self.cache_card(None)
         self.save()
         LOGGER.info("Processor debit key for %s was deleted.",
             self, extra={'event': 'delete-debit', 'organization': self.slug})
@@ -781,6 +827,7 @@ class AbstractOrganization(models.Model):
         new_card = broker.processor_backend.create_or_update_card(
             self, card_token, user=user, provider=provider, broker=broker)
         self.nb_renewal_attempts = 0  # reset off-session failures counter
+        self.cache_card(new_card)
         # The following ``save`` will be rolled back in ``checkout``
         # if there is any ProcessorError.
         self.save()
@@ -1894,7 +1941,7 @@ class Charge(models.Model):
         are returned is not guarenteed by SQL.
         This is important when identifying line items by an index.
         """
-        return self.charge_items.order_by('id')
+        return self.charge_items.order_by('id').select_related('invoiced')
 
     @property
     def line_items_grouped_by_subscription(self):
@@ -1904,7 +1951,11 @@ class Charge(models.Model):
         #pylint:disable=attribute-defined-outside-init
         if not hasattr(self, '_line_items_grouped_by_subscription'):
             by_subscriptions = {}
-            for line in self.charge_items.order_by('invoiced__event_id'):
+            lines = list(self.charge_items.order_by(
+                'invoiced__event_id').select_related('invoiced'))
+            Transaction.objects.resolve_events(
+                [line.invoiced for line in lines])
+            for line in lines:
                 subscription = line.subscription
                 if subscription:
                     lines = by_subscriptions.get(subscription, [])
@@ -2003,7 +2054,8 @@ class Charge(models.Model):
         #pylint: disable=no-member
         organization_model = get_organization_model()
         providers = organization_model.objects.receivable_providers([
-            charge_item.invoiced for charge_item in self.charge_items.all()])
+            charge_item.invoiced for charge_item in self.charge_items.all(
+            ).select_related('invoiced')])
         nb_providers = len(providers)
         assert nb_providers <= 1
         if nb_providers == 1:
@@ -2353,7 +2405,11 @@ class Charge(models.Model):
 
             # Once we have created a transaction for the charge, let's
             # redistribute the funds to their rightful owners.
-            for charge_item in self.charge_items.all():
+            charge_items = list(self.charge_items.all().select_related(
+                'invoiced'))
+            Transaction.objects.resolve_events([
+                charge_item.invoiced for charge_item in charge_items])
+            for charge_item in charge_items:
                 invoiced_item = charge_item.invoiced
                 item_orig_total = invoiced_item.dest_amount
                 item_orig_unit = invoiced_item.dest_unit
@@ -2691,21 +2747,24 @@ class ChargeItem(models.Model):
     charge = models.ForeignKey(Charge, on_delete=models.PROTECT,
         related_name='charge_items')
     # XXX could be a ``Subscription`` or a balance.
+    # Foreign keys to ``Transaction`` are not enforced by the database
+    # because foreign keys referencing a partitioned table must include
+    # the partition key (see `saas.partitions`).
     invoiced = models.ForeignKey('Transaction', on_delete=models.PROTECT,
-        related_name='invoiced_item',
+        db_constraint=False, related_name='invoiced_item',
         help_text=_("Transaction invoiced through this charge"))
     invoiced_processor_fee = models.ForeignKey('Transaction', null=True,
-        on_delete=models.PROTECT,
+        on_delete=models.PROTECT, db_constraint=False,
         related_name='invoiced_processor_fee_item',
         help_text=_("Fee transaction to processor in order to process"\
             " the transaction invoiced through this charge"))
     invoiced_broker_fee = models.ForeignKey('Transaction', null=True,
-        on_delete=models.PROTECT,
+        on_delete=models.PROTECT, db_constraint=False,
         related_name='invoiced_broker_fee_item',
         help_text=_("Fee transaction to broker in order to process"\
             " the transaction invoiced through this charge"))
     invoiced_distribute = models.ForeignKey('Transaction', null=True,
-        on_delete=models.PROTECT,
+        on_delete=models.PROTECT, db_constraint=False,
         related_name='invoiced_distribute',
         help_text=_("Transaction recording the distribution from processor"\
 " to provider."))
@@ -2760,10 +2819,10 @@ class ChargeItem(models.Model):
         """
         #pylint:disable=attribute-defined-outside-init
         if not hasattr(self, '_subscription'):
-            self._subscription = Subscription.objects.get_by_event_id(
-                self.invoiced.event_id)
+            self._subscription = self.invoiced.subscription
             if not self._subscription:
-                coupon = Coupon.objects.get_by_event_id(self.invoiced.event_id)
+                #pylint:disable=protected-access
+                coupon = self.invoiced._get_event_ref('event_coupon')
                 if coupon:
                     organization_model = get_organization_model()
                     self._subscription = Subscription.objects.new_instance(
@@ -3664,6 +3723,9 @@ class SubscriptionQuerySet(models.QuerySet):
 
     def unsubscribe(self, at_time=None):
         at_time = datetime_or_now(at_time)
+        # ``update`` does not trigger the ``post_save`` signal
+        # which schedules renewals and expiration notices.
+        DueEvent.objects.filter(subscription__in=self.values('pk')).delete()
         self.update(ends_at=at_time, auto_renew=False)
 
 
@@ -3812,6 +3874,14 @@ class Subscription(models.Model):
         help_text=_("Unique key generated when a grant is initiated"))
     extra = get_extra_field_class()(null=True,
         help_text=_("Extra meta data (can be stringify JSON)"))
+    income_recognized_until = models.DateTimeField(null=True, blank=True,
+        help_text=_("Income was recognized for all periods before this"\
+        " date/time (in ISO format)"))
+
+    class Meta:
+        # `extend_subscriptions` selects renewal candidates by a range
+        # on `ends_at`.
+        indexes = [models.Index(fields=['auto_renew', 'ends_at'])]
 
     def __str__(self):
         return '%s%s%s' % (str(self.organization), Subscription.SEP,
@@ -4069,7 +4139,25 @@ class TransactionQuerySet(models.QuerySet):
     Custom ``QuerySet`` for ``Transaction`` that provides useful queries.
     """
 
-    def get_statement_balances(self, organization, until=None):
+    def committed_between(self, since_mark, until_mark=None):
+        """
+        Returns ``Transaction`` recorded after *since_mark* and, when
+        *until_mark* is specified, at or before *until_mark*
+        (see `TransactionManager.get_committed_mark`).
+
+        A zero *since_mark* does not filter anything out such that rows
+        written before marks were recorded are included.
+        """
+        key = 'xid' if connections[self.db].vendor == 'postgresql' else 'pk'
+        kwargs = {}
+        if since_mark:
+            kwargs.update({'%s__gt' % key: since_mark})
+        if until_mark is not None:
+            kwargs.update({'%s__lte' % key: until_mark})
+        return self.filter(**kwargs)
+
+    def get_statement_balances(self, organization, until=None,
+                               subscription=None):
         """
         Returns a dictionnary keyed by event_id of dictionnaries keyed by
         currency unit.
@@ -4090,48 +4178,15 @@ class TransactionQuerySet(models.QuerySet):
                 'sub_437/': {'usd': 3490},
                 None:  {'usd': 2500}
             }
+
+        When *subscription* is specified, only the events on that subscription
+        (i.e. the subscription itself and its use charges) are considered.
         """
-        #pylint:disable=too-many-locals
         until = datetime_or_now(until)
         # We use the fact that all orders (and only orders) will have
         # a destination of `subscriber:Payable`.
-        dest_balances = self.filter(
-            Q(dest_account=Transaction.PAYABLE),
-            dest_organization=organization,
-            created_at__lt=until).values(
-                'event_id', 'dest_unit').annotate(
-                dest_balance=Sum('dest_amount'),
-                last_activity_at=Max('created_at')).order_by(
-                    'last_activity_at')
-        dest_balance_per_events = {}
-        for dest_balance in dest_balances:
-            event_id = dest_balance['event_id']
-            if event_id not in dest_balance_per_events:
-                dest_balance_per_events.update({event_id: {}})
-            dest_balance_per_events[event_id].update({
-                dest_balance['dest_unit']: dest_balance['dest_balance']})
-
-        # If the subscription is extended by a group buyer, `dest_organization`
-        # will be the group buyer, not the final subscriber. On the other hand
-        # `orig_balances` (BACKLOG to RECEIVABLE) references the provider.
-        groupbuy_dest_balances = self.filter(
-            Q(dest_account=Transaction.PAYABLE),
-            event_id__in=dest_balance_per_events.keys(),
-            created_at__lt=until).exclude(
-                dest_organization=organization).values(
-                'event_id', 'dest_unit').annotate(
-                dest_balance=Sum('dest_amount'),
-                last_activity_at=Max('created_at')).order_by(
-                    'last_activity_at')
-        for dest_balance in groupbuy_dest_balances:
-            event_id = dest_balance['event_id']
-            by_units = dest_balance_per_events.get(event_id, {})
-            balance_amount = (by_units.get(dest_balance['dest_unit'], 0) +
-                dest_balance['dest_balance'])
-            by_units.update({dest_balance['dest_unit']: balance_amount})
-            if event_id not in dest_balance_per_events:
-                dest_balance_per_events.update({event_id: by_units})
-
+        payables = Q(dest_account=Transaction.PAYABLE)
+        own_payables = payables & Q(dest_organization=organization)
         # Then all payments for these orders will either be of the form:
         #     yyyy/mm/dd sub_***** distribution to provider (backlog accounting)
         #        provider:Receivable                      plan_amount
@@ -4141,36 +4196,49 @@ class TransactionQuerySet(models.QuerySet):
         #        subscriber:Canceled                        liability_amount
         #        provider:Receivable
         # (create_cancel_transactions).
-        orig_balances = self.filter(
-            (Q(orig_account=Transaction.BACKLOG)
+        offsets = ((Q(orig_account=Transaction.BACKLOG)
              & Q(dest_account=Transaction.RECEIVABLE)) |
             (Q(orig_account=Transaction.RECEIVABLE)
-             & Q(dest_account=Transaction.CANCELED)),
-            event_id__in=dest_balance_per_events.keys(),
-            created_at__lt=until).values(
-                'event_id', 'dest_unit').annotate(
-                orig_balance=Sum('dest_amount'),
-                last_activity_at=Max('created_at')).order_by(
-                    'last_activity_at', '-event_id')
-        for orig_balance in orig_balances:
-            orig_amount = orig_balance['orig_balance']
-            orig_unit = orig_balance['dest_unit']
-            event_id = orig_balance['event_id']
-            # We could have subscription or group-buy (coupon codes) events
-            # in both dest_balances and orig_balances.
-            balance_by_units = dest_balance_per_events.get(event_id, {})
-            if orig_unit in balance_by_units:
-                balance_by_units.update({
-                    orig_unit: balance_by_units[orig_unit] - orig_amount})
+             & Q(dest_account=Transaction.CANCELED)))
+
+        queryset = self.filter(created_at__lt=until)
+        if subscription is not None:
+            if not subscription.pk:
+                return {}
+            queryset = queryset.filter(event_subscription=subscription)
+        # If the subscription is extended by a group buyer, `dest_organization`
+        # will be the group buyer, not the final subscriber. On the other hand
+        # offsets (BACKLOG to RECEIVABLE) references the provider. Hence
+        # we pick all payables and offsets on the events the organization
+        # placed an order for.
+        events = queryset.filter(own_payables).values('event_id')
+        balances_by_events = queryset.filter(
+            (payables | offsets) & Q(event_id__in=events)
+            | own_payables & Q(event_id__isnull=True)).values(
+            'event_id', 'dest_unit').annotate(
+            dest_balance=Sum(Case(When(payables, then=F('dest_amount')),
+                default=Value(0), output_field=models.BigIntegerField())),
+            orig_balance=Sum(Case(When(offsets, then=F('dest_amount')),
+                default=Value(0), output_field=models.BigIntegerField())),
+            nb_payables=Sum(Case(When(payables, then=Value(1)),
+                default=Value(0), output_field=models.IntegerField())),
+            last_activity_at=Max(Case(When(own_payables, then=F('created_at')),
+                output_field=models.DateTimeField()))).order_by(
+                F('last_activity_at').asc(nulls_last=True))
 
         balances = {}
-        for event_id, balance in six.iteritems(dest_balance_per_events):
-            amount_by_units = {}
-            for unit, amount in six.iteritems(balance):
-                if amount != 0:
-                    amount_by_units.update({unit: amount})
-            if amount_by_units:
-                balances.update({event_id: amount_by_units})
+        for balance in balances_by_events:
+            # We could have subscription or group-buy (coupon codes) events
+            # in both payables and offsets. Offsets only apply to a currency
+            # unit an order was placed in.
+            if not balance['nb_payables']:
+                continue
+            amount = balance['dest_balance'] - balance['orig_balance']
+            if amount != 0:
+                event_id = balance['event_id']
+                if event_id not in balances:
+                    balances.update({event_id: {}})
+                balances[event_id].update({balance['dest_unit']: amount})
         return balances
 
     def get_statement_balance(self, organization, until=None):
@@ -4383,6 +4451,36 @@ class TransactionManager(models.Manager):
                     for val in self.all().values('dest_account').distinct()})
 
 
+    def get_committed_mark(self, using=None):
+        """
+        Returns a high-water mark such that all ``Transaction`` at or below
+        it (see `committed_between`) were committed and no ``Transaction``
+        at or below it can still be committed later on.
+
+        Ids are allocated when a row is inserted, not when the database
+        transaction commits, so the highest id visible might be greater
+        than the id of a row that is still being written. On PostgreSQL,
+        marks are thus the ids of the database transactions the rows were
+        inserted in (see ``Transaction.xid``). All database transactions
+        older than the oldest one still running are complete, something
+        we know without waiting on the writes in flight. On SQLite, writes
+        are serialized already so marks are ``Transaction`` ids.
+        """
+        if not using:
+            using = router.db_for_write(self.model)
+        if connections[using].vendor == 'postgresql':
+            with connections[using].cursor() as cursor:
+                cursor.execute(
+                    "SELECT txid_snapshot_xmin(txid_current_snapshot()) - 1")
+                return cursor.fetchone()[0]
+        return self.using(using).aggregate(Max('pk'))['pk__max'] or 0
+
+
+    def committed_between(self, since_mark, until_mark=None):
+        return self.get_queryset().committed_between(
+            since_mark, until_mark=until_mark)
+
+
     def get_invoiceables(self, organization, until=None):
         """
         Returns a set of payable or liability ``Transaction`` since
@@ -4425,6 +4523,22 @@ class TransactionManager(models.Manager):
         a selector pattern.
         """
         #pylint:disable=too-many-locals,too-many-arguments
+        if not starts_at and (not kwargs or (
+                list(kwargs.keys()) == ['event_id'] and kwargs['event_id'])):
+            # We can answer from the running balances instead of scanning
+            # the ledger history.
+            balance = AccountBalance.objects.db_manager(self._db).get_balance(
+                organization=organization, account=account,
+                like_account=like_account, ends_at=ends_at, **kwargs)
+            if balance is not None:
+                return balance
+        closing_balances = []
+        if ends_at and not starts_at and not kwargs:
+            # We only aggregate the ledger history since the most recent
+            # closed period.
+            starts_at, closing_balances = ClosingBalance.objects.db_manager(
+                self._db).get_balance(organization=organization,
+                account=account, like_account=like_account, ends_at=ends_at)
         dest_params = {}
         orig_params = {}
         dest_params.update(kwargs)
@@ -4446,11 +4560,17 @@ class TransactionManager(models.Manager):
             orig_params.update({'orig_account__icontains': like_account})
         dest_balances = sum_dest_amount(self.filter(**dest_params))
         orig_balances = sum_orig_amount(self.filter(**orig_params))
+        for closing_balance in closing_balances:
+            # `sum_balance_amount` accumulates amounts on `orig_balances`.
+            orig_balances += [{'amount': - closing_balance['amount'],
+                'unit': closing_balance['unit'],
+                'created_at': closing_balance['created_at']}]
         return sum_balance_amount(dest_balances, orig_balances)
 
-    def get_statement_balances(self, organization, until=None):
+    def get_statement_balances(self, organization, until=None,
+                               subscription=None):
         return self.get_queryset().get_statement_balances(
-            organization, until=until)
+            organization, until=until, subscription=subscription)
 
     def get_statement_balance(self, organization, until=None):
         return self.get_queryset().get_statement_balance(
@@ -4467,29 +4587,25 @@ class TransactionManager(models.Manager):
         a subscription is locked (balance due) or unlocked (no balance).
         """
         balances = self.get_statement_balances(
-            subscription.organization, until=until)
-        subscription_event_id = get_sub_event_id(subscription)
+            subscription.organization, until=until, subscription=subscription)
         dest_amount = 0
         dest_unit = None
-        for event_id, balance in six.iteritems(balances):
-            # subscription_event_id endswith a '/' which is garenteed
-            # to be a terminal character.
-            if event_id and event_id.startswith(subscription_event_id):
-                if len(balance) > 1:
+        for balance in six.itervalues(balances):
+            if len(balance) > 1:
+                raise ValueError(
+                    _("balance with multiple currency units (%s)") %
+                    str(balance))
+            try:
+                balance_unit, balance_amount = next(six.iteritems(balance))
+                dest_amount += balance_amount
+                if dest_unit and balance_unit != dest_unit:
                     raise ValueError(
-                        _("balance with multiple currency units (%s)") %
-                        str(balance))
-                try:
-                    balance_unit, balance_amount = next(six.iteritems(balance))
-                    dest_amount += balance_amount
-                    if dest_unit and balance_unit != dest_unit:
-                        raise ValueError(
-                            _("balances with multiple currency units"\
-                              " (%(dest_unit)s, %(balance_unit)s)") % (
-                                dest_unit, balance_unit))
-                    dest_unit = balance_unit
-                except StopIteration:
-                    pass
+                        _("balances with multiple currency units"\
+                          " (%(dest_unit)s, %(balance_unit)s)") % (
+                            dest_unit, balance_unit))
+                dest_unit = balance_unit
+            except StopIteration:
+                pass
         if not dest_unit:
             dest_unit = settings.DEFAULT_UNIT
         return dest_amount, dest_unit
@@ -4561,7 +4677,8 @@ class TransactionManager(models.Manager):
         until = datetime_or_now(until)
         return self.filter(
             orig_account=Transaction.RECEIVABLE,
-            event_id=get_sub_event_id(subscription),
+            event_subscription=subscription,
+            event_use_charge__isnull=True,
             created_at__lt=until, **kwargs).order_by('created_at')
 
     def new_use_charge(self, subscription, use_charge, quantity,
@@ -4749,7 +4866,8 @@ class TransactionManager(models.Manager):
 
     def create_income_recognized(self, subscription,
         amount=0, starts_at=None, ends_at=None, descr=None,
-        event_id=None, dry_run=False):
+        event_id=None, backlog_amount=None, receivable_amount=None,
+        dry_run=False):
         """
         When a period ends and we either have a ``Backlog`` (payment
         was made before the period starts) or a ``Receivable`` (invoice
@@ -4769,6 +4887,11 @@ class TransactionManager(models.Manager):
             2014/09/10 recognized income for period 2014/09/10 to 2014/10/10
                 cowork:Backlog                         $179.99
                 cowork:Income
+
+        The Backlog and Receivable available on the event at *ends_at* are
+        queried unless *backlog_amount* and *receivable_amount* are
+        specified. With *dry_run*, the ``Transaction`` are returned
+        but not saved.
         """
         #pylint:disable=unused-argument,too-many-arguments,too-many-locals
         created_transactions = []
@@ -4779,12 +4902,14 @@ class TransactionManager(models.Manager):
         # so we do not include the newly created transaction
         # in the subsequent period.
         created_at = ends_at - relativedelta(seconds=1)
-        balance = self.get_event_balance(event_id,
-            account=Transaction.BACKLOG, ends_at=ends_at)
-        backlog_amount = - balance['amount'] # def. balance must be negative
-        balance = self.get_event_balance(event_id,
-            account=Transaction.RECEIVABLE, ends_at=ends_at)
-        receivable_amount = - balance['amount'] # def. balance must be negative
+        if backlog_amount is None:
+            balance = self.get_event_balance(event_id,
+                account=Transaction.BACKLOG, ends_at=ends_at)
+            backlog_amount = - balance['amount'] # def. balance must be neg.
+        if receivable_amount is None:
+            balance = self.get_event_balance(event_id,
+                account=Transaction.RECEIVABLE, ends_at=ends_at)
+            receivable_amount = - balance['amount'] # def. balance must be neg.
         LOGGER.debug("recognize %dc(%s) with %dc(%s) backlog available,"\
             " %dc(%s) receivable available at %s",
             amount, amount.__class__, backlog_amount, backlog_amount.__class__,
@@ -4848,15 +4973,115 @@ class TransactionManager(models.Manager):
                 subscription._state.db, amount, subscription.pk))
         return created_transactions
 
-    @staticmethod
-    def by_processor_key(invoiced_items):
+    def bulk_record(self, transactions, using=None):
+        """
+        Inserts *transactions* in the ledger with a single ``bulk_create``,
+        keeping the event references and running balances up-to-date
+        as ``Transaction.save`` would.
+        """
+        if not transactions:
+            return []
+        if not using:
+            using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            for entry in transactions:
+                entry.populate_event_refs()
+            created = self.using(using).bulk_create(transactions)
+            _record_transactions(created, using=using)
+        return created
+
+    def resolve_events(self, transactions):
+        """
+        Resolves the 'event' (SubscriptionUse, Subscription, Charge,
+        or Coupon) associated to each ``Transaction`` in *transactions*
+        in a constant number of queries, and caches it on the instance
+        such that subsequent calls to `get_event` do not hit the database.
+
+        Returns the list of transactions.
+        """
+        #pylint:disable=protected-access,too-many-locals
+        transactions = list(transactions)
+        using = self._db
+        if not using and transactions:
+            using = transactions[0]._state.db
+        if not using:
+            using = DEFAULT_DB_ALIAS
+
+        # Transactions that were not yet saved do not have their typed
+        # references populated. We look up coupon codes in bulk here.
+        coupon_codes = set([transaction.event_id
+            for transaction in transactions
+            if transaction.pk is None and transaction.event_id
+            and transaction.event_id.startswith('cpn_')])
+        coupons_by_code = {}
+        if coupon_codes:
+            for coupon in Coupon.objects.using(using).filter(
+                    code__in=coupon_codes):
+                coupons_by_code.setdefault(coupon.code, []).append(coupon)
+        for transaction in transactions:
+            if transaction.pk is None:
+                transaction.populate_event_refs(coupons=coupons_by_code)
+
+        subscription_ids = set([])
+        use_charge_ids = set([])
+        charge_ids = set([])
+        coupon_ids = set([])
+        for transaction in transactions:
+            if transaction.event_subscription_id:
+                subscription_ids |= set([transaction.event_subscription_id])
+                if transaction.event_use_charge_id:
+                    use_charge_ids |= set([transaction.event_use_charge_id])
+            if transaction.event_charge_id:
+                charge_ids |= set([transaction.event_charge_id])
+            if transaction.event_coupon_id:
+                coupon_ids |= set([transaction.event_coupon_id])
+
+        subscriptions = {}
+        if subscription_ids:
+            subscriptions = {subscription.pk: subscription
+                for subscription in Subscription.objects.using(using).filter(
+                    pk__in=subscription_ids).select_related(
+                    'organization', 'plan__organization')}
+        usages = {}
+        if use_charge_ids:
+            for usage in SubscriptionUse.objects.using(using).filter(
+                    subscription_id__in=subscription_ids,
+                    use_id__in=use_charge_ids).select_related('use'):
+                usage.subscription = subscriptions[usage.subscription_id]
+                usages[(usage.subscription_id, usage.use_id)] = usage
+        charges = {}
+        if charge_ids:
+            charges = {charge.pk: charge
+                for charge in Charge.objects.using(using).filter(
+                    pk__in=charge_ids)}
+        coupons = {}
+        if coupon_ids:
+            coupons = {coupon.pk: coupon
+                for coupon in Coupon.objects.using(using).filter(
+                    pk__in=coupon_ids).select_related('organization')}
+
+        for transaction in transactions:
+            subscription = subscriptions.get(transaction.event_subscription_id)
+            event = usages.get((transaction.event_subscription_id,
+                transaction.event_use_charge_id))
+            if not event:
+                event = subscription
+            if not event:
+                event = charges.get(transaction.event_charge_id)
+            if not event:
+                event = coupons.get(transaction.event_coupon_id)
+            transaction._subscription = subscription
+            transaction._event = (transaction.event_id, event)
+        return transactions
+
+    def by_processor_key(self, invoiced_items):
         """
         Returns a dictionnary {processor_key: [invoiced_item ...]}
         such that all invoiced_items appear under a processor_key.
         """
         results = {}
         default_processor_key = get_broker().processor_backend.pub_key
-        for invoiced_item in invoiced_items:
+        for invoiced_item in self.resolve_events(invoiced_items):
             event = invoiced_item.get_event() # Subscription, SubscriptionUse,
                                               # or Coupon (i.e. Group buy)
             if event:
@@ -4944,9 +5169,59 @@ class Transaction(models.Model):
         help_text=_("Event at the origin of this transaction"\
         " (ex. subscription, charge, etc.)"))
 
+    # Implementation Note:
+    # The typed references below are derived from ``event_id`` when
+    # the ``Transaction`` is saved such that queries can use indexed joins
+    # instead of parsing ``event_id``. ``event_id`` remains the reference
+    # (ex: a subscription might have been deleted) hence we do not enforce
+    # foreign key constraints.
+    event_subscription = models.ForeignKey('Subscription', null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        related_name='transactions',
+        help_text=_("Subscription refered to by event_id"))
+    event_use_charge = models.ForeignKey('UseCharge', null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        related_name='transactions',
+        help_text=_("UseCharge refered to by event_id"))
+    event_charge = models.ForeignKey('Charge', null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        related_name='transactions',
+        help_text=_("Charge refered to by event_id"))
+    event_coupon = models.ForeignKey('Coupon', null=True,
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        related_name='transactions',
+        help_text=_("Coupon refered to by event_id"))
+
+    # Implementation Note:
+    # On PostgreSQL, a trigger sets ``xid`` to the id of the database
+    # transaction the row is inserted in such that rollups and ledger
+    # verification can process rows in commit order without locking
+    # the table (see `TransactionManager.get_committed_mark`).
+    xid = models.BigIntegerField(null=True, editable=False,
+        help_text=_("Database transaction the row was inserted in"))
+
+    class Meta:
+        # `read_balances` sums each side of an account up to a point in time.
+        indexes = [
+            models.Index(fields=['dest_account', 'created_at']),
+            models.Index(fields=['orig_account', 'created_at']),
+            models.Index(fields=['xid'])]
+
     def __str__(self):
         return str(self.id)
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        # The running balances (see ``AccountBalance``) are updated
+        # in the `post_save` signal handler. We want both the ledger entry
+        # and the running balances to be committed in the same db transaction.
+        if using is None:
+            using = router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            super(Transaction, self).save(force_insert=force_insert,
+                force_update=force_update, using=using,
+                update_fields=update_fields)
+
     @property
     def dest_price(self):
         return Price(self.dest_amount, self.dest_unit)
@@ -4978,10 +5253,67 @@ class Transaction(models.Model):
         """
         #pylint:disable=attribute-defined-outside-init
         if not hasattr(self, '_subscription'):
-            self._subscription = Subscription.objects.get_by_event_id(
-                self.event_id)
+            if self.pk is None:
+                self.populate_event_refs()
+            self._subscription = self._get_event_ref('event_subscription')
         return self._subscription
 
+    def _get_event_ref(self, field_name):
+        if not getattr(self, '%s_id' % field_name):
+            return None
+        try:
+            return getattr(self, field_name)
+        except ObjectDoesNotExist:
+            return None
+
+    def populate_event_refs(self, coupons=None):
+        """
+        Sets the typed references to the event (``Subscription``,
+        ``UseCharge``, ``Charge`` or ``Coupon``) from ``event_id``.
+
+        *coupons*, when specified, is a dictionnary {code: [coupon ...]}
+        used instead of querying the database to find a ``Coupon``.
+        """
+        self.event_subscription_id = None
+        self.event_use_charge_id = None
+        self.event_charge_id = None
+        self.event_coupon_id = None
+        if not self.event_id:
+            return
+        look = re.match(r'^sub_(\d+)/((\d+)/)?', self.event_id)
+        if look:
+            # 'sub_0/' prefixes subscriptions not yet recorded in the db.
+            sub_id = int(look.group(1))
+            if sub_id:
+                self.event_subscription_id = sub_id
+                if look.group(3):
+                    self.event_use_charge_id = int(look.group(3))
+            return
+        look = re.match(r'^cha_(\d+)/', self.event_id)
+        if look:
+            self.event_charge_id = int(look.group(1))
+            return
+        if self.event_id.startswith('cpn_'):
+            # Coupon codes are only unique per provider.
+            if coupons is not None:
+                candidates = coupons.get(self.event_id, [])
+                for coupon in candidates:
+                    if coupon.organization_id in (
+                        self.orig_organization_id, self.dest_organization_id):
+                        self.event_coupon_id = coupon.pk
+                        break
+                if not self.event_coupon_id and candidates:
+                    self.event_coupon_id = candidates[0].pk
+                return
+            coupons = Coupon.objects.filter(code=self.event_id)
+            self.event_coupon_id = coupons.filter(
+                organization_id__in=[
+                    self.orig_organization_id, self.dest_organization_id]
+            ).values_list('pk', flat=True).first()
+            if not self.event_coupon_id:
+                self.event_coupon_id = coupons.values_list(
+                    'pk', flat=True).first()
+
     def is_debit(self, organization):
         '''
         Return True if this transaction is a debit (negative ledger entry).
@@ -4998,21 +5330,790 @@ class Transaction(models.Model):
         """
         if not self.event_id:
             return None
-        usage = SubscriptionUse.objects.get_by_event_id(self.event_id)
-        if usage:
-            return usage
-        subscription = Subscription.objects.get_by_event_id(self.event_id)
-        if subscription:
-            return subscription
-        charge = Charge.objects.get_by_event_id(self.event_id)
+        if hasattr(self, '_event') and self._event[0] == self.event_id:
+            # cached by `TransactionManager.resolve_events`.
+            return self._event[1]
+        if self.pk is None:
+            self.populate_event_refs()
+        if self.event_subscription_id:
+            if self.event_use_charge_id:
+                usage = SubscriptionUse.objects.filter(
+                    subscription_id=self.event_subscription_id,
+                    use_id=self.event_use_charge_id).first()
+                if usage:
+                    return usage
+            subscription = self._get_event_ref('event_subscription')
+            if subscription:
+                return subscription
+        charge = self._get_event_ref('event_charge')
         if charge:
             return charge
-        coupon = Coupon.objects.get_by_event_id(self.event_id)
+        coupon = self._get_event_ref('event_coupon')
         if coupon:
             return coupon
         return None
 
 
+def _add_amounts(manager, key_fields, deltas, using=None):
+    """
+    Adds amounts to the rows of the *manager* model, creating the rows
+    that do not exist yet, in a constant number of queries.
+
+    *deltas* is a dictionnary keyed by tuples of values for *key_fields*
+    of (amount, last_activity_at) pairs. last_activity_at is ``None``
+    for models without a ``last_activity_at`` field.
+    """
+    if not deltas:
+        return
+    def _get_updates(amount, last_activity_at):
+        updates = {'amount': F('amount') + amount}
+        if last_activity_at:
+            updates.update({'last_activity_at': Greatest(
+                'last_activity_at', Value(last_activity_at))})
+        return updates
+
+    queryset = manager.using(using)
+    keys = list(deltas.keys())
+    existing = []
+    for idx in range(0, len(keys), 500):
+        filter_args = Q()
+        for key in keys[idx:idx + 500]:
+            filter_args |= Q(**dict(zip(key_fields, key)))
+        existing += list(queryset.filter(filter_args))
+    fields = set([])
+    for row in existing:
+        updates = _get_updates(*deltas.pop(tuple(
+            [getattr(row, field) for field in key_fields])))
+        for field, value in six.iteritems(updates):
+            setattr(row, field, value)
+        fields |= set(updates.keys())
+    if existing:
+        queryset.bulk_update(existing, list(fields), batch_size=500)
+    if not deltas:
+        return
+    missing = []
+    for key, (amount, last_activity_at) in six.iteritems(deltas):
+        row = manager.model(amount=amount, **dict(zip(key_fields, key)))
+        if last_activity_at:
+            row.last_activity_at = last_activity_at
+        missing += [row]
+    try:
+        with transaction.atomic(using=using):
+            queryset.bulk_create(missing, batch_size=500)
+    except IntegrityError:
+        # Another db transaction created some of the rows in the meantime.
+        for row in missing:
+            if not queryset.filter(**{field: getattr(row, field)
+                    for field in key_fields}).update(**_get_updates(
+                    row.amount, getattr(row, 'last_activity_at', None))):
+                row.save(using=using, force_insert=True)
+
+
+class AccountBalanceManager(models.Manager):
+
+    def get_balance(self, organization=None, account=None, like_account=None,
+                    event_id=None, ends_at=None):
+        """
+        Returns the balance for an *organization* and/or *account*, optionally
+        restricted to an *event_id*, as a dictionnary with the same format
+        as ``TransactionManager.get_balance``.
+
+        This method returns ``None`` when *ends_at* falls before the last
+        activity on the running balances, in which case the caller must fall
+        back to aggregating the ledger history.
+        """
+        #pylint:disable=too-many-arguments
+        kwargs = {'event_id': event_id if event_id else ""}
+        if organization is not None:
+            kwargs.update({'organization': organization})
+        if account is not None:
+            kwargs.update({'account': account})
+        elif like_account is not None:
+            kwargs.update({'account__icontains': like_account})
+        balances = []
+        for row in self.filter(**kwargs).values('unit').annotate(
+                balance=Sum('amount'),
+                last_activity=Max('last_activity_at')).order_by():
+            if ends_at and row['last_activity'] >= ends_at:
+                return None
+            balances += [{'amount': row['balance'], 'unit': row['unit'],
+                'created_at': row['last_activity']}]
+        return sum_balance_amount(balances, [])
+
+    def record_transaction(self, entry, using=None):
+        """
+        Updates the running balances with the amounts moved by *entry*.
+        """
+        self.record_transactions([entry], using=using)
+
+    def record_transactions(self, entries, using=None):
+        """
+        Updates the running balances with the amounts moved by *entries*.
+
+        Amounts are added up per running balance first such that a batch
+        is recorded in a constant number of queries.
+        """
+        deltas = {}
+        for entry in entries:
+            event_ids = [""]
+            if entry.event_id:
+                event_ids += [entry.event_id]
+            for organization_id, account, unit, amount in [
+                    (entry.dest_organization_id, entry.dest_account,
+                     entry.dest_unit, entry.dest_amount),
+                    (entry.orig_organization_id, entry.orig_account,
+                     entry.orig_unit, - entry.orig_amount)]:
+                for event_id in event_ids:
+                    key = (organization_id, account, unit, event_id)
+                    total, last_activity_at = deltas.get(key,
+                        (0, entry.created_at))
+                    deltas[key] = (total + amount,
+                        max(last_activity_at, entry.created_at))
+        _add_amounts(self, ('organization_id', 'account', 'unit', 'event_id'),
+            deltas, using=using)
+
+    def compute_balances(self, organization=None, using=None):
+        """
+        Returns the running balances, as they should be, computed from
+        the ledger history.
+
+        The result is a dictionnary keyed by (organization_id, account, unit,
+        event_id) tuples of [amount, last_activity_at] pairs.
+        """
+        balances = {}
+        transactions = Transaction.objects.using(using)
+        for side, sign in (('dest', 1), ('orig', -1)):
+            fields = ['%s_organization' % side, '%s_account' % side,
+                '%s_unit' % side]
+            queryset = transactions.all()
+            if organization is not None:
+                queryset = queryset.filter(**{
+                    '%s_organization' % side: organization})
+            for by_event in (False, True):
+                if by_event:
+                    rows = queryset.exclude(event_id__isnull=True).exclude(
+                        event_id="").values(*(fields + ['event_id']))
+                else:
+                    rows = queryset.values(*fields)
+                for row in rows.annotate(
+                        balance=Sum('%s_amount' % side),
+                        last_activity=Max('created_at')).order_by():
+                    key = (row[fields[0]], row[fields[1]], row[fields[2]],
+                        row['event_id'] if by_event else "")
+                    if key not in balances:
+                        balances[key] = [0, row['last_activity']]
+                    balances[key][0] += sign * row['balance']
+                    balances[key][1] = max(
+                        balances[key][1], row['last_activity'])
+        return balances
+
+    def rebuild(self, organization=None, using=None, batch_size=1000):
+        """
+        Recomputes the running balances from the ledger history.
+        """
+        with transaction.atomic(using=using):
+            queryset = self.using(using).all()
+            if organization is not None:
+                queryset = queryset.filter(organization=organization)
+            queryset.delete()
+            balances = self.compute_balances(
+                organization=organization, using=using)
+            self.using(using).bulk_create([AccountBalance(
+                organization_id=key[0], account=key[1], unit=key[2],
+                event_id=key[3], amount=val[0], last_activity_at=val[1])
+                for key, val in six.iteritems(balances)],
+                batch_size=batch_size)
+        return len(balances)
+
+    def check_consistency(self, organization=None, using=None):
+        """
+        Returns a list of (key, expected, recorded) tuples for all running
+        balances which do not match the ledger history.
+        """
+        expected = self.compute_balances(organization=organization, using=using)
+        queryset = self.using(using).all()
+        if organization is not None:
+            queryset = queryset.filter(organization=organization)
+        recorded = {}
+        for row in queryset.values('organization', 'account', 'unit',
+                'event_id', 'amount', 'last_activity_at'):
+            recorded.update({(row['organization'], row['account'], row['unit'],
+                row['event_id']): [row['amount'], row['last_activity_at']]})
+        results = []
+        for key in sorted(set(expected.keys()) | set(recorded.keys()),
+                key=lambda item: tuple(str(field) for field in item)):
+            if expected.get(key) != recorded.get(key):
+                results += [(key, expected.get(key), recorded.get(key))]
+        return results
+
+
+@python_2_unicode_compatible
+class AccountBalance(models.Model):
+    """
+    Running balance of an (organization, account, unit) triplet, updated
+    in the same db transaction as each ``Transaction`` is inserted
+    in the ledger.
+
+    Rows with a blank ``event_id`` hold the balance over all events
+    while rows with an ``event_id`` hold the balance restricted to that event.
+    """
+    objects = AccountBalanceManager()
+
+    organization = models.ForeignKey(settings.ORGANIZATION_MODEL,
+        on_delete=models.CASCADE, related_name='account_balances',
+        help_text=_("Billing profile the balance is computed for"))
+    account = models.CharField(max_length=255,
+        help_text=_("Account the balance is computed for"))
+    unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT,
+        help_text=_("Three-letter ISO 4217 code for currency unit (ex: usd)"))
+    event_id = models.SlugField(default="", blank=True,
+        help_text=_("Event the balance is restricted to (blank for all)"))
+    amount = models.BigIntegerField(default=0,
+        help_text=_("Sum of amounts deposited minus sum of amounts withdrawn"))
+    last_activity_at = models.DateTimeField(null=True,
+        help_text=_("Date/time of the most recent Transaction"\
+        " in the balance (in ISO format)"))
+
+    class Meta:
+        unique_together = ('organization', 'account', 'unit', 'event_id')
+        indexes = [models.Index(fields=['event_id', 'account'])]
+
+    def __str__(self):
+        return '%s:%s' % (self.organization_id, self.account)
+
+
+class ClosingBalanceManager(models.Manager):
+
+    def get_balance(self, organization=None, account=None, like_account=None,
+                    ends_at=None):
+        """
+        Returns a tuple (period_end, balances) where *period_end* is the end
+        of the most recent closed period at or before *ends_at*, and
+        *balances* the closing balances for an *organization* and/or
+        *account* at that date, in the same format as ``sum_dest_amount``.
+
+        Returns ``(None, [])`` when no period was closed before *ends_at*.
+        """
+        kwargs = {}
+        if ends_at:
+            kwargs.update({'period_end__lte': ends_at})
+        if organization is not None:
+            kwargs.update({'organization': organization})
+        if account is not None:
+            kwargs.update({'account': account})
+        elif like_account is not None:
+            kwargs.update({'account__icontains': like_account})
+        period_end = self.filter(**kwargs).aggregate(
+            Max('period_end'))['period_end__max']
+        if not period_end:
+            return None, []
+        kwargs.update({'period_end': period_end})
+        balances = []
+        for row in self.filter(**kwargs).values('unit').annotate(
+                balance=Sum('amount')).order_by():
+            balances += [{'amount': row['balance'], 'unit': row['unit'],
+                'created_at': period_end}]
+        return period_end, balances
+
+    def close_period(self, period_end, using=None):
+        """
+        Records the closing balances of all (organization, account, unit)
+        at *period_end*, starting from the previous closed period.
+
+        Returns the number of closing balances recorded.
+        """
+        if not using:
+            using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            self.using(using).filter(period_end=period_end).delete()
+            previous_end = self.using(using).filter(
+                period_end__lt=period_end).aggregate(
+                Max('period_end'))['period_end__max']
+            balances = {}
+            kwargs = {'created_at__lt': period_end}
+            if previous_end:
+                kwargs.update({'created_at__gte': previous_end})
+                for row in self.using(using).filter(
+                        period_end=previous_end).values(
+                        'organization', 'account', 'unit', 'amount'):
+                    balances.update({(row['organization'], row['account'],
+                        row['unit']): row['amount']})
+            for side, sign in (('dest', 1), ('orig', -1)):
+                fields = ['%s_organization' % side, '%s_account' % side,
+                    '%s_unit' % side]
+                for row in Transaction.objects.using(using).filter(
+                        **kwargs).values(*fields).annotate(
+                        balance=Sum('%s_amount' % side)).order_by():
+                    key = (row[fields[0]], row[fields[1]], row[fields[2]])
+                    balances.update({
+                        key: balances.get(key, 0) + sign * row['balance']})
+            self.using(using).bulk_create([self.model(
+                organization_id=key[0], account=key[1], unit=key[2],
+                period_end=period_end, amount=amount)
+                for key, amount in six.iteritems(balances)], batch_size=1000)
+        return len(balances)
+
+    def record_transaction(self, entry, using=None):
+        """
+        Updates the closing balances of periods ending after
+        a back-dated *entry*.
+        """
+        self.record_transactions([entry], using=using)
+
+    def record_transactions(self, entries, using=None):
+        """
+        Updates the closing balances of periods ending after
+        back-dated *entries*, in a constant number of queries.
+        """
+        if not entries:
+            return
+        period_ends = list(self.using(using).filter(
+            period_end__gt=min([entry.created_at for entry in entries])
+            ).values_list('period_end', flat=True).order_by().distinct())
+        if not period_ends:
+            return
+        deltas = {}
+        for entry in entries:
+            for organization_id, account, unit, amount in [
+                    (entry.dest_organization_id, entry.dest_account,
+                     entry.dest_unit, entry.dest_amount),
+                    (entry.orig_organization_id, entry.orig_account,
+                     entry.orig_unit, - entry.orig_amount)]:
+                for period_end in period_ends:
+                    if period_end <= entry.created_at:
+                        continue
+                    key = (organization_id, account, unit, period_end)
+                    deltas[key] = (deltas.get(key, (0, None))[0] + amount,
+                        None)
+        _add_amounts(self,
+            ('organization_id', 'account', 'unit', 'period_end'),
+            deltas, using=using)
+
+
+@python_2_unicode_compatible
+class ClosingBalance(models.Model):
+    """
+    Balance of an (organization, account, unit) triplet at the end
+    of a closed period, such that balance queries only have to aggregate
+    the ``Transaction`` recorded after it.
+
+    Closing balances are kept up-to-date when a back-dated ``Transaction``
+    lands in a closed period.
+    """
+    objects = ClosingBalanceManager()
+
+    organization = models.ForeignKey(settings.ORGANIZATION_MODEL,
+        on_delete=models.CASCADE, related_name='closing_balances',
+        help_text=_("Billing profile the balance is computed for"))
+    account = models.CharField(max_length=255,
+        help_text=_("Account the balance is computed for"))
+    unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT,
+        help_text=_("Three-letter ISO 4217 code for currency unit (ex: usd)"))
+    period_end = models.DateTimeField(
+        help_text=_("Date/time at which the period was closed"\
+        " (in ISO format)"))
+    amount = models.BigIntegerField(default=0,
+        help_text=_("Sum of amounts deposited minus sum of amounts withdrawn"\
+        " before the end of the period"))
+
+    class Meta:
+        unique_together = ('organization', 'account', 'unit', 'period_end')
+        indexes = [models.Index(fields=['period_end', 'account'])]
+
+    def __str__(self):
+        return '%s:%s@%s' % (self.organization_id, self.account,
+            self.period_end.isoformat())
+
+
+@python_2_unicode_compatible
+class LedgerChecksum(models.Model):
+    """
+    Sum of amounts and number of postings on an (organization, account, unit)
+    triplet for the ``Transaction`` up to the ``RollupWatermark.LEDGER``
+    high-water mark, as last verified by ``verify_ledger``.
+    """
+    organization = models.ForeignKey(settings.ORGANIZATION_MODEL,
+        on_delete=models.CASCADE, related_name='+',
+        help_text=_("Billing profile the checksum is computed for"))
+    account = models.CharField(max_length=255,
+        help_text=_("Account the checksum is computed for"))
+    unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT,
+        help_text=_("Three-letter ISO 4217 code for currency unit (ex: usd)"))
+    amount = models.BigIntegerField(default=0,
+        help_text=_("Sum of amounts deposited minus sum of amounts withdrawn"))
+    nb_transactions = models.PositiveIntegerField(default=0,
+        help_text=_("Number of transactions to or from the account"))
+
+    class Meta:
+        unique_together = ('organization', 'account', 'unit')
+
+    def __str__(self):
+        return '%s:%s' % (self.organization_id, self.account)
+
+
+@python_2_unicode_compatible
+class RollupWatermark(models.Model):
+    """
+    High-water mark up to which a daily metrics rollup
+    (``TransactionRollup``, ``SubscriptionRollup``) was refreshed.
+
+    The ``ARCHIVE`` mark records the date before which ``Transaction``
+    were archived and replaced by opening balances (see `saas.partitions`).
+    """
+    TRANSACTIONS = 'transactions'
+    SUBSCRIPTIONS = 'subscriptions'
+    LEDGER = 'ledger'
+    ARCHIVE = 'archive'
+
+    name = models.SlugField(unique=True,
+        help_text=_("Rollup the high-water mark is recorded for"))
+    last_id = models.BigIntegerField(default=0,
+        help_text=_("Mark of the last Transaction rolled up"))
+    last_at = models.DateTimeField(null=True,
+        help_text=_("Rollups are complete for days before this date/time"\
+        " (in ISO format)"))
+
+    def __str__(self):
+        return str(self.name)
+
+
+@python_2_unicode_compatible
+class TransactionRollup(models.Model):
+    """
+    Amounts transfered between two (organization, account, unit) triplets
+    during a day (UTC), aggregated from the ``Transaction`` ledger
+    for the metrics.
+    """
+    day = models.DateTimeField(
+        help_text=_("Start of the day (UTC) the transactions were created"))
+    orig_organization = models.ForeignKey(settings.ORGANIZATION_MODEL,
+        on_delete=models.CASCADE, related_name='+',
+        help_text=_("Billing profile from which funds are withdrawn"))
+    orig_account = models.CharField(max_length=255,
+        help_text=_("Source account from which funds are withdrawn"))
+    orig_unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT,
+        help_text=_("Three-letter ISO 4217 code for source currency unit"\
+        " (ex: usd)"))
+    orig_amount = models.BigIntegerField(default=0,
+        help_text=_("Sum of amounts withdrawn from the source"))
+    dest_organization = models.ForeignKey(settings.ORGANIZATION_MODEL,
+        on_delete=models.CASCADE, related_name='+',
+        help_text=_("Billing profile to which funds are deposited"))
+    dest_account = models.CharField(max_length=255,
+        help_text=_("Target account to which funds are deposited"))
+    dest_unit = models.CharField(max_length=3, default=settings.DEFAULT_UNIT,
+        help_text=_("Three-letter ISO 4217 code for target currency unit"\
+        " (ex: usd)"))
+    dest_amount = models.BigIntegerField(default=0,
+        help_text=_("Sum of amounts deposited into the target"))
+    nb_transactions = models.PositiveIntegerField(default=0,
+        help_text=_("Number of transactions rolled up"))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['orig_organization', 'orig_account', 'day']),
+            models.Index(fields=['dest_organization', 'dest_account', 'day'])]
+
+    def __str__(self):
+        return '%s:%s->%s:%s@%s' % (
+            self.orig_organization_id, self.orig_account,
+            self.dest_organization_id, self.dest_account, self.day.isoformat())
+
+
+@python_2_unicode_compatible
+class SubscriptionRollup(models.Model):
+    """
+    Number of subscribers to a plan active at the start of a day (UTC),
+    and the number of subscriptions created and ended during that day.
+    """
+    day = models.DateTimeField(
+        help_text=_("Start of the day (UTC) the counts are computed for"))
+    plan = models.ForeignKey(Plan, on_delete=models.CASCADE, related_name='+',
+        help_text=_("Plan the counts are computed for"))
+    nb_active = models.PositiveIntegerField(default=0,
+        help_text=_("Number of active subscriptions at the start of the day"))
+    nb_new = models.PositiveIntegerField(default=0,
+        help_text=_("Number of subscriptions created during the day"))
+    nb_churned = models.PositiveIntegerField(default=0,
+        help_text=_("Number of subscriptions ended during the day"))
+
+    class Meta:
+        unique_together = ('plan', 'day')
+
+    def __str__(self):
+        return '%s@%s' % (self.plan_id, self.day.isoformat())
+
+
+class RenewalsJournalManager(models.Manager):
+
+    def get_or_start(self, at_time, phase, shard=None):
+        """
+        Returns the journal entry for *phase* of the renewals run
+        at *at_time* on *shard*, creating it when the phase never started.
+        """
+        entry, _ = self.get_or_create(at_time=at_time, phase=phase,
+            shard=RenewalsJournal.format_shard(shard))
+        return entry
+
+    def last_incomplete_at(self):
+        """
+        Returns the ``at_time`` of the most recent renewals run that
+        did not complete all its phases, or ``None``.
+        """
+        entry = self.filter(completed_at__isnull=True).order_by(
+            '-at_time').first()
+        return entry.at_time if entry else None
+
+    def get_nb_shards(self, at_time):
+        """
+        Returns the set of the number of shards the phases of the renewals
+        run at *at_time* were journaled with (i.e. N in i/N, or 1 when
+        the run was not sharded).
+        """
+        return set([int(shard.split('/')[1]) if shard else 1
+            for shard in self.filter(at_time=at_time).values_list(
+            'shard', flat=True).distinct()])
+
+
+@python_2_unicode_compatible
+class RenewalsJournal(models.Model):
+    """
+    Progress of a phase of the renewals run at ``at_time`` for a shard
+    of organizations, such that a run interrupted halfway can resume
+    from the last organization processed.
+    """
+    RECOGNIZE_INCOME = 'recognize-income'
+    EXTEND_SUBSCRIPTIONS = 'extend-subscriptions'
+    CREATE_CHARGES = 'create-charges'
+    COMPLETE_CHARGES = 'complete-charges'
+    EXPIRATION_NOTICES = 'expiration-notices'
+
+    objects = RenewalsJournalManager()
+
+    at_time = models.DateTimeField(
+        help_text=_("Date/time the renewals run for (in ISO format)"))
+    shard = models.CharField(max_length=20, blank=True, default="",
+        help_text=_("Shard of organizations (i/N) the run processes"))
+    phase = models.SlugField(
+        help_text=_("Phase of the renewals run"))
+    last_organization_id = models.BigIntegerField(null=True,
+        help_text=_("Last organization fully processed in the phase"))
+    nb_processed = models.PositiveIntegerField(default=0,
+        help_text=_("Number of items (renewals, charges, notices, etc.)"\
+        " processed in the phase"))
+    created_at = models.DateTimeField(auto_now_add=True,
+        help_text=_("Date/time the phase first started (in ISO format)"))
+    completed_at = models.DateTimeField(null=True,
+        help_text=_("Date/time the phase completed (in ISO format)"))
+    duration = models.DurationField(default=datetime.timedelta,
+        help_text=_("Time spent running the phase, across resumes"))
+
+    class Meta:
+        unique_together = ('at_time', 'shard', 'phase')
+
+    def __str__(self):
+        return '%s@%s%s' % (self.phase, self.at_time.isoformat(),
+            (':%s' % self.shard) if self.shard else "")
+
+    @staticmethod
+    def format_shard(shard):
+        if not shard:
+            return ""
+        return '%d/%d' % shard
+
+    def checkpoint(self, organization_id, nb_processed=0):
+        """
+        Records that all items for *organization_id* (and organizations
+        with a lower id) were processed.
+        """
+        self.last_organization_id = organization_id
+        self.nb_processed += nb_processed
+        self.save(update_fields=['last_organization_id', 'nb_processed'])
+
+
+class DueEventManager(models.Manager):
+
+    def schedule_subscription(self, subscription, at_time=None, using=None):
+        """
+        Replaces the pending events for *subscription* by its renewal
+        (when it auto-renews) and its expiration notices
+        (see ``EXPIRE_NOTICE_DAYS``).
+        """
+        self.schedule_subscriptions([subscription], at_time=at_time,
+            using=using)
+
+    def schedule_subscriptions(self, subscriptions, at_time=None,
+                               using=None):
+        """
+        Replaces the pending events for each subscription in *subscriptions*
+        (see `schedule_subscription`) in a constant number of queries.
+        """
+        #pylint:disable=protected-access
+        at_time = datetime_or_now(at_time)
+        queryset = self.using(using)
+        queryset.filter(subscription__in=[subscription.pk
+            for subscription in subscriptions]).delete()
+        events = []
+        for subscription in subscriptions:
+            if subscription.auto_renew:
+                # The renewal happens during the last day of the last period.
+                events += [self.model(kind=DueEvent.RENEWAL,
+                    subscription=subscription,
+                    due_at=subscription.ends_at - relativedelta(seconds=1))]
+            for nb_days in settings.EXPIRE_NOTICE_DAYS:
+                due_at = subscription.ends_at - relativedelta(days=nb_days)
+                if due_at >= at_time and due_at >= subscription.created_at:
+                    events += [self.model(kind=DueEvent.EXPIRATION_NOTICE,
+                        subscription=subscription, nb_days=nb_days,
+                        due_at=due_at)]
+            subscription._scheduled_state = (subscription.ends_at,
+                subscription.auto_renew)
+        queryset.bulk_create(events)
+
+    def schedule_charge(self, organization, due_at=None, using=None):
+        """
+        Replaces the pending charge for *organization*. By default,
+        the charge is due when its ``billing_start`` enters the renewal
+        window (see ``MAX_RENEWAL_ATTEMPTS``).
+        """
+        queryset = self.using(using)
+        queryset.filter(kind=DueEvent.CHARGE,
+            organization=organization).delete()
+        if not due_at and organization.billing_start:
+            due_at = datetime_or_now(organization.billing_start) - \
+                relativedelta(days=settings.MAX_RENEWAL_ATTEMPTS)
+        if due_at:
+            queryset.create(kind=DueEvent.CHARGE, organization=organization,
+                due_at=due_at)
+
+
+@python_2_unicode_compatible
+class DueEvent(models.Model):
+    """
+    Work (renewal, expiration notice, charge) scheduled on a subscription
+    or an organization, such that workers process only what is due
+    instead of scanning all subscriptions and organizations.
+    """
+    RENEWAL = 1
+    EXPIRATION_NOTICE = 2
+    CHARGE = 3
+    KINDS = [
+        (RENEWAL, 'renewal'),
+        (EXPIRATION_NOTICE, 'expiration-notice'),
+        (CHARGE, 'charge'),
+    ]
+
+    # Number of times an event is attempted before it is dropped.
+    MAX_ATTEMPTS = 5
+
+    objects = DueEventManager()
+
+    due_at = models.DateTimeField(db_index=True,
+        help_text=_("Date/time at which the event is due (in ISO format)"))
+    kind = models.PositiveSmallIntegerField(choices=KINDS,
+        help_text=_("Kind of work to do when the event is due"))
+    subscription = models.ForeignKey(Subscription, null=True,
+        on_delete=models.CASCADE, related_name='+',
+        help_text=_("Subscription the event applies to"))
+    organization = models.ForeignKey(settings.ORGANIZATION_MODEL, null=True,
+        on_delete=models.CASCADE, related_name='+',
+        help_text=_("Billing profile the event applies to"))
+    nb_days = models.PositiveSmallIntegerField(null=True,
+        help_text=_("Number of days before the end of the subscription"\
+        " (expiration notices)"))
+    nb_attempts = models.PositiveSmallIntegerField(default=0,
+        help_text=_("Number of times processing the event failed"))
+
+    def __str__(self):
+        return '%s-%s@%s' % (self.get_kind_display(),
+            self.subscription_id or self.organization_id,
+            self.due_at.isoformat())
+
+
+@receiver(post_init, sender=Subscription)
+def on_subscription_post_init(sender, instance, **kwargs):
+    #pylint:disable=unused-argument,protected-access
+    instance._scheduled_state = (instance.__dict__.get('ends_at'),
+        instance.__dict__.get('auto_renew'))
+
+
+@receiver(post_save, sender=Subscription)
+def on_subscription_post_save(sender, instance, created, raw, using,
+                              **kwargs):
+    #pylint:disable=unused-argument,protected-access
+    if raw:
+        return
+    state = (instance.__dict__.get('ends_at'),
+        instance.__dict__.get('auto_renew'))
+    if created or state != getattr(instance, '_scheduled_state', None):
+        DueEvent.objects.schedule_subscription(instance, using=using)
+
+
+@receiver(post_init, sender=settings.ORGANIZATION_MODEL)
+def on_organization_post_init(sender, instance, **kwargs):
+    #pylint:disable=unused-argument,protected-access
+    instance._scheduled_billing_start = instance.__dict__.get('billing_start')
+
+
+@receiver(post_save, sender=settings.ORGANIZATION_MODEL)
+def on_organization_post_save(sender, instance, created, raw, using,
+                              **kwargs):
+    #pylint:disable=unused-argument,protected-access
+    if raw or 'billing_start' not in instance.__dict__:
+        return
+    if (instance.billing_start !=
+        getattr(instance, '_scheduled_billing_start', None)):
+        DueEvent.objects.schedule_charge(instance, using=using)
+        instance._scheduled_billing_start = instance.billing_start
+
+
+@receiver(pre_save, sender=Transaction)
+def on_transaction_pre_save(sender, instance, raw, **kwargs):
+    #pylint:disable=unused-argument
+    instance.populate_event_refs()
+
+
+@receiver(post_save, sender=Transaction)
+def on_transaction_post_save(sender, instance, created, raw, using, **kwargs):
+    #pylint:disable=unused-argument
+    # The ledger is append-only so we only need to account for new entries.
+    if created:
+        _record_transaction(instance, using=using)
+
+
+def _record_transaction(entry, using=None):
+    """
+    Updates the tables derived from the ledger after *entry* was inserted.
+    """
+    _record_transactions([entry], using=using)
+
+
+def _record_transactions(entries, using=None):
+    """
+    Updates the tables derived from the ledger after *entries* were inserted,
+    in a constant number of queries.
+    """
+    AccountBalance.objects.record_transactions(entries, using=using)
+    ClosingBalance.objects.record_transactions(entries, using=using)
+    ordered_at = {}
+    for entry in entries:
+        if (entry.event_subscription_id and
+            entry.orig_account == Transaction.RECEIVABLE and
+            entry.dest_account == Transaction.PAYABLE):
+            ordered_at[entry.event_subscription_id] = min(entry.created_at,
+                ordered_at.get(entry.event_subscription_id, entry.created_at))
+    if ordered_at:
+        # A back-dated order or use charge must be picked up
+        # by the next `recognize_income`.
+        Subscription.objects.using(using).filter(
+            pk__in=list(ordered_at.keys())).update(
+            income_recognized_until=Case(*[When(pk=subscription_id,
+                income_recognized_until__gt=created_at,
+                then=Value(created_at))
+                for subscription_id, created_at in six.iteritems(ordered_at)],
+            default=F('income_recognized_until')))
+
+
 @python_2_unicode_compatible
 class BalanceLine(models.Model):
     """
@@ -5141,7 +6242,7 @@ def get_period_usage(subscription, use_charge, starts_at, ends_at):
         orig_account=Transaction.RECEIVABLE,
         dest_account=Transaction.PAYABLE, created_at__lt=ends_at,
         created_at__gte=starts_at,
-        event_id=get_sub_event_id(subscription, use_charge)))
+        event_subscription=subscription, event_use_charge=use_charge))
 
 
 def record_use_charge(subscription, use_charge, quantity=1, created_at=None):
@@ -0,0 +1,439 @@
+# Copyright (c) 2026, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Optional range partitioning of the ``Transaction`` table by month
+of ``created_at`` on PostgreSQL.
+
+Metrics and balances queries filter transactions on ``created_at``.
+Once the table is partitioned, PostgreSQL only scans the partitions
+overlapping the date range of a query.
+
+Partitions older than a cutoff can be detached and their transactions
+moved into an archive table. The transactions are replaced by opening
+balance rows, stored in an opening partition, such that account
+and event balances stay the same. Transactions referenced by other tables
+(ex: ``ChargeItem.invoiced``) are kept as-is in the opening partition.
+
+Foreign keys referencing a partitioned table must include the partition
+key. Hence foreign keys referencing ``Transaction`` are not enforced
+by the database (``db_constraint=False``).
+"""
+import datetime, logging, re
+
+from dateutil.relativedelta import relativedelta
+from django.db import connections, router, transaction
+
+from . import humanize
+from .helpers import datetime_or_now
+from .metrics.base import refresh_transaction_rollups
+from .models import (ClosingBalance, LedgerChecksum, RollupWatermark,
+    Transaction)
+
+
+LOGGER = logging.getLogger(__name__)
+
+MONTH_PARTITION_SUFFIX_RE = r'_p(?P<year>\d\d\d\d)(?P<month>\d\d)$'
+
+# Largest value a `PositiveIntegerField` can hold on PostgreSQL.
+MAX_AMOUNT = 2147483647
+
+
+def _get_table():
+    return Transaction._meta.db_table #pylint:disable=protected-access
+
+
+def _get_using(using=None):
+    if not using:
+        using = router.db_for_write(Transaction)
+    if connections[using].vendor != 'postgresql':
+        raise NotImplementedError("partitioning of %s is only supported"\
+            " on PostgreSQL" % _get_table())
+    return using
+
+
+def _month_start(at_time):
+    return at_time.astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def month_partitions(start_at, ends_at, table=None):
+    """
+    Returns a list of (name, starts_at, ends_at) tuples for the monthly
+    partitions of *table* covering [*start_at*, *ends_at*[.
+    """
+    if not table:
+        table = _get_table()
+    partitions = []
+    period_start = _month_start(start_at)
+    while period_start < ends_at:
+        period_end = period_start + relativedelta(months=1)
+        partitions += [('%s_p%04d%02d' % (
+            table, period_start.year, period_start.month),
+            period_start, period_end)]
+        period_start = period_end
+    return partitions
+
+
+def is_partitioned(using=None):
+    """
+    Returns ``True`` if the ``Transaction`` table is partitioned.
+    """
+    using = _get_using(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table"\
+            " WHERE partrelid = %s::regclass", [_get_table()])
+        return cursor.fetchone() is not None
+
+
+def get_partitions(using=None):
+    """
+    Returns the names of the partitions of the ``Transaction`` table.
+    """
+    using = _get_using(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT child.relname FROM pg_inherits"\
+            " INNER JOIN pg_class AS child"\
+            " ON child.oid = pg_inherits.inhrelid"\
+            " WHERE pg_inherits.inhparent = %s::regclass", [_get_table()])
+        return sorted([row[0] for row in cursor.fetchall()])
+
+
+def _create_month_partition(cursor, name, start_at, ends_at, using=None):
+    """
+    Attaches a partition for [*start_at*, *ends_at*[, moving the rows
+    in that range out of the default partition.
+    """
+    table = _get_table()
+    quote_name = connections[using].ops.quote_name
+    cursor.execute("CREATE TABLE %s (LIKE %s"\
+        " INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % (
+        quote_name(name), quote_name(table)))
+    cursor.execute("WITH moved AS (DELETE FROM %(default)s"\
+        " WHERE created_at >= %%s AND created_at < %%s RETURNING *)"\
+        " INSERT INTO %(name)s SELECT * FROM moved" % {
+        'default': quote_name('%s_default' % table),
+        'name': quote_name(name)}, [start_at, ends_at])
+    cursor.execute("ALTER TABLE %s ATTACH PARTITION %s"\
+        " FOR VALUES FROM ('%s') TO ('%s')" % (quote_name(table),
+        quote_name(name), start_at.isoformat(), ends_at.isoformat()))
+
+
+def create_partitions(until=None, months_ahead=3, using=None):
+    """
+    Creates the monthly partitions of the ``Transaction`` table
+    from the current month up to *months_ahead* after *until*.
+
+    Returns the number of partitions created.
+    """
+    using = _get_using(using)
+    if not is_partitioned(using=using):
+        return 0
+    until = datetime_or_now(until)
+    partitions = get_partitions(using=using)
+    nb_created = 0
+    for name, start_at, ends_at in month_partitions(datetime_or_now(),
+            until + relativedelta(months=months_ahead)):
+        if name in partitions:
+            continue
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                _create_month_partition(cursor, name, start_at, ends_at,
+                    using=using)
+        LOGGER.info("created partition %s", name)
+        nb_created += 1
+    return nb_created
+
+
+def partition_transactions(months_ahead=3, using=None):
+    """
+    Converts the ``Transaction`` table of an existing install into a table
+    partitioned by month of ``created_at``.
+
+    The rows are copied into the partitioned table in a single database
+    transaction, which holds an exclusive lock on the ledger until it
+    completes.
+
+    Returns the number of partitions created.
+    """
+    #pylint:disable=too-many-locals
+    using = _get_using(using)
+    if is_partitioned(using=using):
+        return 0
+    table = _get_table()
+    unpartitioned = '%s_unpartitioned' % table
+    sequence = '%s_partitioned_id_seq' % table
+    quote_name = connections[using].ops.quote_name
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" %
+                quote_name(table))
+            # Deferred foreign key checks on rows written earlier
+            # in the db transaction would prevent dropping the table.
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute("SELECT conrelid::regclass::text, conname"\
+                " FROM pg_constraint WHERE confrelid = %s::regclass"\
+                " AND contype = 'f'", [table])
+            referencing = cursor.fetchall()
+            if referencing:
+                raise NotImplementedError("%s is referenced by foreign keys"\
+                    " (%s). Foreign keys referencing a partitioned table"\
+                    " must include the partition key." % (table, ', '.join(
+                    ['%s.%s' % row for row in referencing])))
+            cursor.execute("SELECT conname, pg_get_constraintdef(oid)"\
+                " FROM pg_constraint WHERE conrelid = %s::regclass"\
+                " AND contype = 'f'", [table])
+            foreign_keys = cursor.fetchall()
+            cursor.execute("SELECT conname FROM pg_constraint"\
+                " WHERE conrelid = %s::regclass AND contype = 'p'", [table])
+            primary_key = cursor.fetchone()[0]
+            cursor.execute("SELECT indexname, indexdef FROM pg_indexes"\
+                " WHERE tablename = %s AND indexname <> %s",
+                [table, primary_key])
+            indexes = cursor.fetchall()
+            # Triggers (ex: setting ``Transaction.xid``) are not copied
+            # by `CREATE TABLE ... LIKE`. Row triggers on a partitioned
+            # table are cloned onto its partitions.
+            cursor.execute("SELECT pg_get_triggerdef(oid) FROM pg_trigger"\
+                " WHERE tgrelid = %s::regclass AND NOT tgisinternal", [table])
+            triggers = [row[0] for row in cursor.fetchall()]
+            # Index names are unique in a schema, so we drop them
+            # before they are re-created on the partitioned table.
+            for index_name, _ in indexes:
+                cursor.execute("DROP INDEX %s" % quote_name(index_name))
+            cursor.execute("ALTER TABLE %s RENAME CONSTRAINT %s TO %s" % (
+                quote_name(table), quote_name(primary_key),
+                quote_name('%s_pkey' % unpartitioned)))
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (
+                quote_name(table), quote_name(unpartitioned)))
+
+            cursor.execute("CREATE TABLE %s (LIKE %s"\
+                " INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"\
+                " PARTITION BY RANGE (created_at)" % (
+                quote_name(table), quote_name(unpartitioned)))
+            # Identity columns are not supported on partitioned tables
+            # before PostgreSQL 17.
+            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1,"\
+                " COALESCE(MIN(created_at), NOW()) FROM %s" %
+                quote_name(unpartitioned))
+            next_id, first_created_at = cursor.fetchone()
+            cursor.execute("CREATE SEQUENCE %s AS bigint" %
+                quote_name(sequence))
+            cursor.execute("ALTER TABLE %s ALTER COLUMN id"\
+                " SET DEFAULT nextval('%s')" % (quote_name(table), sequence))
+            cursor.execute("ALTER SEQUENCE %s OWNED BY %s.id" % (
+                quote_name(sequence), quote_name(table)))
+            cursor.execute("SELECT setval(%s, %s, false)", [sequence, next_id])
+            # The primary key of a partitioned table must include
+            # the partition key.
+            cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, created_at)" %
+                quote_name(table))
+            for constraint_name, definition in foreign_keys:
+                cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (
+                    quote_name(table), quote_name(constraint_name),
+                    definition))
+            for _, definition in indexes:
+                cursor.execute(definition)
+
+            cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" % (
+                quote_name('%s_default' % table), quote_name(table)))
+            partitions = month_partitions(first_created_at,
+                datetime_or_now() + relativedelta(months=months_ahead))
+            for name, start_at, ends_at in partitions:
+                cursor.execute("CREATE TABLE %s PARTITION OF %s"\
+                    " FOR VALUES FROM ('%s') TO ('%s')" % (
+                    quote_name(name), quote_name(table),
+                    start_at.isoformat(), ends_at.isoformat()))
+            cursor.execute("INSERT INTO %s SELECT * FROM %s" % (
+                quote_name(table), quote_name(unpartitioned)))
+            cursor.execute("DROP TABLE %s" % quote_name(unpartitioned))
+            # The trigger definitions refer to the table by name,
+            # which is now the partitioned table.
+            for definition in triggers:
+                cursor.execute(definition)
+    LOGGER.info("partitioned %s in %d monthly partitions",
+        table, len(partitions))
+    return len(partitions)
+
+
+def _split_amounts(orig_amount, dest_amount):
+    """
+    Splits *orig_amount* and *dest_amount* into pairs of amounts
+    which fit in a ``Transaction``.
+    """
+    nb_rows = max(1, -(-max(orig_amount, dest_amount) // MAX_AMOUNT))
+    orig_part, orig_remain = divmod(orig_amount, nb_rows)
+    dest_part, dest_remain = divmod(dest_amount, nb_rows)
+    return [(orig_part + (1 if idx < orig_remain else 0),
+             dest_part + (1 if idx < dest_remain else 0))
+        for idx in range(nb_rows)]
+
+
+def _get_referenced_ids_sql(quote_name):
+    """
+    Returns a SQL query for the ids of ``Transaction`` referenced
+    by foreign keys, or ``None`` if there are no such foreign keys.
+    """
+    queries = []
+    #pylint:disable=protected-access
+    for relation in Transaction._meta.related_objects:
+        if not (relation.one_to_many or relation.one_to_one):
+            continue
+        column = quote_name(relation.field.column)
+        queries += ["SELECT %s FROM %s WHERE %s IS NOT NULL" % (column,
+            quote_name(relation.related_model._meta.db_table), column)]
+    return " UNION ".join(queries) if queries else None
+
+
+def archive_transactions(before, detach_only=False, using=None):
+    """
+    Detaches the monthly partitions of the ``Transaction`` table that end
+    at or before *before*, and replaces their transactions by opening
+    balance rows created just before the first month kept.
+
+    The opening balance rows sum the transactions per event and
+    (source, target) accounts such that account balances, event balances
+    and statements are unchanged. Transactions referenced by foreign keys
+    are kept in the opening partition instead.
+
+    The detached transactions are moved into an archive table, unless
+    *detach_only* is ``True``, in which case the detached partitions
+    are left in the database as stand-alone tables.
+
+    Closing balances for periods ending before *before* are deleted since
+    the opening balances would be counted twice otherwise. The metrics
+    rollups of the archived days are kept (see `refresh_transaction_rollups`).
+
+    Returns the number of partitions detached.
+    """
+    #pylint:disable=too-many-locals,too-many-statements
+    using = _get_using(using)
+    if not is_partitioned(using=using):
+        return 0
+    table = _get_table()
+    opening = '%s_opening' % table
+    archive = '%s_archive' % table
+    kept = '%s_kept' % table
+    quote_name = connections[using].ops.quote_name
+    before = _month_start(before)
+    partitions = get_partitions(using=using)
+    detached = []
+    for name in partitions:
+        look = re.search(MONTH_PARTITION_SUFFIX_RE, name)
+        if look and datetime.datetime(int(look.group('year')),
+                int(look.group('month')), 1, tzinfo=datetime.timezone.utc) \
+                + relativedelta(months=1) <= before:
+            detached += [name]
+    if not detached:
+        return 0
+    sources = detached + ([opening] if opening in partitions else [])
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" %
+                quote_name(table))
+            # The metrics rollups must include the detached transactions
+            # before they are replaced by opening balances.
+            refresh_transaction_rollups(using=using)
+            for name in sources:
+                cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (
+                    quote_name(table), quote_name(name)))
+            detached_sql = " UNION ALL ".join(["SELECT * FROM %s" %
+                quote_name(name) for name in sources])
+            referenced_sql = _get_referenced_ids_sql(quote_name)
+            if referenced_sql:
+                is_referenced = "id IN (%s)" % referenced_sql
+            else:
+                is_referenced = "FALSE"
+            cursor.execute("CREATE TEMPORARY TABLE %s AS"\
+                " SELECT * FROM (%s) AS detached WHERE %s" % (
+                quote_name(kept), detached_sql, is_referenced))
+            cursor.execute("SELECT event_id,"\
+                " orig_organization_id, orig_account, orig_unit,"\
+                " SUM(orig_amount),"\
+                " dest_organization_id, dest_account, dest_unit,"\
+                " SUM(dest_amount) FROM (%s) AS detached WHERE NOT %s"\
+                " GROUP BY event_id,"\
+                " orig_organization_id, orig_account, orig_unit,"\
+                " dest_organization_id, dest_account, dest_unit" % (
+                detached_sql, is_referenced))
+            rows = cursor.fetchall()
+            if opening in partitions:
+                # The previous opening balances are included in the new ones.
+                cursor.execute("DROP TABLE %s" % quote_name(opening))
+            cursor.execute("CREATE TABLE %s PARTITION OF %s"\
+                " FOR VALUES FROM (MINVALUE) TO ('%s')" % (
+                quote_name(opening), quote_name(table), before.isoformat()))
+            cursor.execute("INSERT INTO %s SELECT * FROM %s" % (
+                quote_name(table), quote_name(kept)))
+            cursor.execute("DROP TABLE %s" % quote_name(kept))
+
+            created_at = before - datetime.timedelta(microseconds=1)
+            descr = humanize.DESCRIBE_OPENING_BALANCE % {
+                'date': before.date().isoformat()}
+            opening_balances = []
+            for (event_id, orig_organization_id, orig_account, orig_unit,
+                 orig_total, dest_organization_id, dest_account, dest_unit,
+                 dest_total) in rows:
+                for orig_amount, dest_amount in _split_amounts(
+                        orig_total, dest_total):
+                    if not orig_amount and not dest_amount:
+                        continue
+                    # The opening balances were rolled up as
+                    # the transactions they replace.
+                    entry = Transaction(event_id=event_id,
+                        created_at=created_at, descr=descr, xid=0,
+                        orig_organization_id=orig_organization_id,
+                        orig_account=orig_account, orig_unit=orig_unit,
+                        orig_amount=orig_amount,
+                        dest_organization_id=dest_organization_id,
+                        dest_account=dest_account, dest_unit=dest_unit,
+                        dest_amount=dest_amount)
+                    entry.populate_event_refs()
+                    opening_balances += [entry]
+            # Running balances are unchanged, so we do not go through
+            # `Transaction.objects.bulk_record` here.
+            Transaction.objects.using(using).bulk_create(opening_balances,
+                batch_size=1000)
+
+            if not detach_only:
+                cursor.execute("CREATE TABLE IF NOT EXISTS %s (LIKE %s)" % (
+                    quote_name(archive), quote_name(table)))
+                for name in detached:
+                    cursor.execute("INSERT INTO %s SELECT * FROM %s"\
+                        " WHERE NOT %s" % (quote_name(archive),
+                        quote_name(name), is_referenced))
+                    cursor.execute("DROP TABLE %s" % quote_name(name))
+            ClosingBalance.objects.using(using).filter(
+                period_end__lt=before).delete()
+
+            RollupWatermark.objects.using(using).update_or_create(
+                name=RollupWatermark.ARCHIVE, defaults={'last_at': before})
+            # The number of transactions per account changed, so the next
+            # `verify_ledger` rescans the whole ledger.
+            LedgerChecksum.objects.using(using).all().delete()
+            RollupWatermark.objects.using(using).filter(
+                name=RollupWatermark.LEDGER).update(last_id=0)
+    LOGGER.info("archived %d partitions of %s into %d opening balances",
+        len(detached), table, len(opening_balances))
+    return len(detached)
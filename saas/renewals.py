@@ -27,19 +27,22 @@ The functions defined in the module are meant to be run regularly
 in batch mode.
 """
 
-import logging
-
+import heapq, logging, threading, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import (DateTimeField, Exists, F, OuterRef, Q,
+    Subquery, Sum, Value)
+from django.db.models.functions import Cast, Coalesce, Mod
 
 from . import humanize, settings, signals
 from .backends import CardError, ProcessorError
 from .compat import gettext_lazy as _, six
 from .helpers import datetime_or_now
 from .humanize import describe_period_name
-from .models import (Charge, Plan, Price, Subscription, Transaction,
-    sum_dest_amount, get_period_usage, get_sub_event_id)
+from .models import (Charge, DueEvent, Plan, Price, Subscription,
+    SubscriptionUse, Transaction, sum_dest_amount, get_sub_event_id)
 from .utils import get_organization_model
 
 LOGGER = logging.getLogger(__name__)
@@ -50,25 +53,145 @@ class DryRun(RuntimeError):
     pass
 
 
-def _recognize_subscription_income(subscription, until=None):
-    #pylint:disable=too-many-locals,too-many-statements
+def filter_shard(queryset, shard=None, field='organization_id'):
+    """
+    Restricts *queryset* to the organizations in *shard*, a tuple
+    (index, nb_shards) partitioning organizations by id.
+    """
+    if not shard:
+        return queryset
+    index, nb_shards = shard
+    return queryset.annotate(shard_index=Mod(field, Value(nb_shards))).filter(
+        shard_index=index)
+
+
+def lock_organization(organization_id):
+    """
+    Locks the row of organization *organization_id* until the end
+    of the current db transaction, such that concurrent renewals runners
+    do not process the same organization at the same time.
+
+    Returns ``False`` when another runner holds the lock.
+    """
+    return organization_id in lock_organizations([organization_id])
+
+
+def lock_organizations(organization_ids):
+    """
+    Locks the rows of organizations in *organization_ids* until the end
+    of the current db transaction.
+
+    Returns the set of organization ids that were locked, i.e. excluding
+    the ones held by another runner.
+    """
+    return set(get_organization_model().objects.select_for_update(
+        skip_locked=True).filter(pk__in=organization_ids).values_list(
+        'pk', flat=True))
+
+
+class _IncomeLedger(object):
+    """
+    In-memory slice of the ledger for the events on a subscription
+    (and its use charges) such that the income recognition schedule
+    can be computed without querying the database for each period.
+    """
+
+    def __init__(self, subscription, until, entries=None):
+        if entries is None:
+            entries = Transaction.objects.filter(
+                event_subscription=subscription,
+                created_at__lt=until).values_list('created_at', 'event_id',
+                'orig_account', 'orig_amount', 'dest_account', 'dest_amount')
+        self.entries = list(entries)
+
+    def add(self, entry):
+        self.entries += [(entry.created_at, entry.event_id,
+            entry.orig_account, entry.orig_amount,
+            entry.dest_account, entry.dest_amount)]
+
+    def _filter(self, event_id, starts_at=None, ends_at=None):
+        for entry in self.entries:
+            if (entry[1] == event_id and
+                (starts_at is None or entry[0] >= starts_at) and
+                (ends_at is None or entry[0] < ends_at)):
+                yield entry
+
+    def get_balance(self, event_id, account, starts_at=None, ends_at=None):
+        """
+        Same as ``Transaction.objects.get_event_balance`` (amount only).
+        """
+        amount = 0
+        for _created_at, _event_id, orig_account, orig_amount, \
+            dest_account, dest_amount in self._filter(
+                event_id, starts_at=starts_at, ends_at=ends_at):
+            if dest_account == account:
+                amount += dest_amount
+            if orig_account == account:
+                amount -= orig_amount
+        return amount
+
+    def get_period_usage(self, event_id, starts_at, ends_at):
+        """
+        Same as ``get_period_usage`` (amount only).
+        """
+        amount = 0
+        for _created_at, _event_id, orig_account, _orig_amount, \
+            dest_account, dest_amount in self._filter(
+                event_id, starts_at=starts_at, ends_at=ends_at):
+            if (orig_account == Transaction.RECEIVABLE and
+                dest_account == Transaction.PAYABLE):
+                amount += dest_amount
+        return amount
+
+
+def _recognize_subscription_income(subscription, until=None,
+                                   ledger=None, orders=None, dry_run=False):
+    """
+    Recognizes the income on *subscription* for all periods until *until*.
+
+    The receivable orders, the transactions on the subscription events
+    and the use charges are loaded in a few queries (unless *ledger*
+    and *orders* are specified). The recognition schedule is then computed
+    in memory and the ``Transaction`` inserted with a single ``bulk_create``.
+
+    Returns the list of ``Transaction`` recognizing income. With *dry_run*,
+    they are added to *ledger* but not saved.
+    """
+    #pylint:disable=too-many-locals,too-many-statements,too-many-branches
     until = datetime_or_now(until)
+    if ledger is None:
+        ledger = _IncomeLedger(subscription, until)
+    use_charges = list(subscription.plan.use_charges.all())
+    event_id = get_sub_event_id(subscription)
+    recognized = []
     # [``recognize_start``, ``recognize_end``[ is one period over which
     # revenue is recognized. It will slide over the subscription
     # lifetime from ``created_at`` to ``until``.
     order_subscribe_beg = subscription.created_at
     recognize_period_idx = 0
-    recognize_start = subscription.created_at
+    if (subscription.income_recognized_until and
+        subscription.income_recognized_until > subscription.created_at):
+        # We resume from the period the high-water mark falls in.
+        recognize_period_idx = int(subscription.nb_periods(
+            until=subscription.income_recognized_until,
+            period_type=Plan.MONTHLY))
+    recognize_start = (subscription.created_at
+        + relativedelta(months=recognize_period_idx))
     recognize_end = (subscription.created_at
         + relativedelta(months=recognize_period_idx + 1))
-    LOGGER.debug('process subscription %d %s', subscription.id, subscription)
-    for order in Transaction.objects.get_subscription_receivable(
-            subscription, until=until):
+    covered_until = subscription.created_at
+    LOGGER.debug('process subscription %d %s from %s', subscription.id,
+        subscription, recognize_start)
+    if orders is None:
+        orders = list(Transaction.objects.get_subscription_receivable(
+            subscription, until=until))
+    nb_processed_orders = 0
+    for order in orders:
         # [``order_subscribe_beg``, ``order_subscribe_end``[ is
         # the subset of the subscription lifetime the order paid for.
         # It covers ``order_periods`` plan periods.
         order_amount = order.dest_amount
-        order_periods = order.subscription.plan.period_number(order.descr)
+        order_periods = subscription.plan.period_number(order.descr)
 
         if order.created_at > subscription.created_at:
             candidate_recognize_period_idx = int(subscription.nb_periods(
@@ -102,9 +225,9 @@ def _recognize_subscription_income(subscription, until=None):
             to_recognize_amount = int(
                 (nb_periods * order_amount) // order_periods)
             assert isinstance(to_recognize_amount, six.integer_types)
-            balance = Transaction.objects.get_subscription_income_balance(
-                subscription, starts_at=recognize_start, ends_at=recognize_end)
-            recognized_amount = balance['amount']
+            recognized_amount = ledger.get_balance(event_id,
+                Transaction.INCOME, starts_at=recognize_start,
+                ends_at=recognize_end)
             # We are not computing a balance sheet here but looking for
             # a positive amount to compare with the revenue that should
             # have been recognized.
@@ -128,34 +251,39 @@ def _recognize_subscription_income(subscription, until=None):
                             recognize_end - relativedelta(days=1)).date()
                 else:
                     descr = humanize.DESCRIBE_RECOGNIZE_INCOME_DETAILED
-                Transaction.objects.create_income_recognized(
+                for entry in Transaction.objects.create_income_recognized(
                     subscription, amount=amount,
                     starts_at=recognize_start, ends_at=recognize_end,
                     descr=descr % {
                         'subscription': subscription,
                         'nb_periods': nb_periods,
                         'period_start': descr_period_start,
-                        'period_end': descr_period_end})
+                        'period_end': descr_period_end},
+                    backlog_amount=-ledger.get_balance(event_id,
+                        Transaction.BACKLOG, ends_at=recognize_end),
+                    receivable_amount=-ledger.get_balance(event_id,
+                        Transaction.RECEIVABLE, ends_at=recognize_end),
+                    dry_run=True):
+                    ledger.add(entry)
+                    recognized += [entry]
 
             # recognizing use charges for subscription
-            use_charges = subscription.plan.use_charges.all()
             for use_charge in use_charges:
-                to_recognize = get_period_usage(subscription, use_charge,
+                use_event_id = get_sub_event_id(subscription, use_charge)
+                to_recognize_amount = ledger.get_period_usage(use_event_id,
                     recognize_start, recognize_end)
-                to_recognize_amount = to_recognize[0]['amount']
 
-                balance = Transaction.objects.get_use_charge_balance(
-                    subscription, use_charge, recognize_start, recognize_end)
-                recognized_amount = balance['amount']
+                recognized_amount = ledger.get_balance(use_event_id,
+                    Transaction.INCOME, starts_at=recognize_start,
+                    ends_at=recognize_end)
                 recognized_amount = abs(recognized_amount)
 
                 if to_recognize_amount > recognized_amount:
                     amount = to_recognize_amount - recognized_amount
-                    event_id = get_sub_event_id(subscription, use_charge)
 
                     # creating a liability for a customer
-                    Transaction.objects.create(
-                        event_id=event_id,
+                    liability = Transaction(
+                        event_id=use_event_id,
                         created_at=recognize_end - relativedelta(seconds=1),
                         descr=humanize.DESCRIBE_DOUBLE_ENTRY_MATCH,
                         dest_unit=subscription.plan.unit,
@@ -166,6 +294,8 @@ def _recognize_subscription_income(subscription, until=None):
                         orig_amount=amount,
                         orig_account=Transaction.PAYABLE,
                         orig_organization=subscription.organization)
+                    ledger.add(liability)
+                    recognized += [liability]
 
                     # recognizing an income for a provider
                     descr = humanize.DESCRIBE_RECOGNIZE_INCOME % {
@@ -173,10 +303,17 @@ def _recognize_subscription_income(subscription, until=None):
                         'period_start': recognize_start,
                         'period_end': recognize_end
                     }
-                    Transaction.objects.create_income_recognized(
-                        subscription, amount=amount, event_id=event_id,
+                    for entry in Transaction.objects.create_income_recognized(
+                        subscription, amount=amount, event_id=use_event_id,
                         starts_at=recognize_start, ends_at=recognize_end,
-                        descr=descr)
+                        descr=descr,
+                        backlog_amount=-ledger.get_balance(use_event_id,
+                            Transaction.BACKLOG, ends_at=recognize_end),
+                        receivable_amount=-ledger.get_balance(use_event_id,
+                            Transaction.RECEIVABLE, ends_at=recognize_end),
+                        dry_run=True):
+                        ledger.add(entry)
+                        recognized += [entry]
 
             recognize_period_idx += 1
             recognize_start = (subscription.created_at
@@ -185,36 +322,125 @@ def _recognize_subscription_income(subscription, until=None):
                 + relativedelta(months=recognize_period_idx + 1))
 
         order_subscribe_beg = order_subscribe_end
+        covered_until = max(covered_until, order_subscribe_end)
+        nb_processed_orders += 1
         if recognize_end >= until:
             break
+    if dry_run:
+        return recognized
+    Transaction.objects.bulk_record(recognized)
+    if nb_processed_orders == len(orders) and recognize_end > covered_until:
+        # All the periods paid for by orders have been recognized.
+        # The subscription will be skipped until it is extended.
+        _update_income_recognized_until(subscription,
+            max(recognize_start, subscription.ends_at))
+        return recognized
+    income_recognized_until = recognize_start
+    if income_recognized_until >= subscription.ends_at:
+        # The subscription was cancelled before the end of the periods
+        # paid for. We pick a high-water mark before ``ends_at`` so it
+        # is not skipped.
+        income_recognized_until = None
+        if subscription.ends_at > subscription.created_at:
+            period_idx = int(subscription.nb_periods(
+                until=subscription.ends_at, period_type=Plan.MONTHLY))
+            income_recognized_until = (subscription.created_at
+                + relativedelta(months=period_idx))
+            if period_idx > 0 and \
+                income_recognized_until >= subscription.ends_at:
+                income_recognized_until = (subscription.created_at
+                    + relativedelta(months=period_idx - 1))
+            if income_recognized_until >= subscription.ends_at:
+                income_recognized_until = None
+    _update_income_recognized_until(subscription, income_recognized_until)
+    return recognized
+
+
+def _update_income_recognized_until(subscription, income_recognized_until):
+    if subscription.income_recognized_until != income_recognized_until:
+        subscription.income_recognized_until = income_recognized_until
+        # We do not want to override concurrent updates to the subscription.
+        Subscription.objects.filter(pk=subscription.pk).update(
+            income_recognized_until=income_recognized_until)
 
 
-def recognize_income(until=None, dry_run=False):
+def _get_income_candidates(until, shard=None):
+    return filter_shard(Subscription.objects.valid_for(
+        created_at__lte=until).filter(
+        Q(income_recognized_until__isnull=True) |
+        Q(income_recognized_until__lt=F('ends_at'))), shard).select_related(
+        'organization', 'plan')
+
+
+def recognize_income(until=None, dry_run=False, shard=None, journal=None):
     """
     Create all ``Transaction`` necessary to recognize revenue
     on each ``Subscription`` until date specified.
+
+    Subscriptions whose income was recognized for all the periods paid for
+    (i.e. ``income_recognized_until`` is past ``ends_at``) are skipped,
+    and the others resume from their ``income_recognized_until``.
+
+    When *shard* is specified, only subscriptions of organizations
+    in that shard are processed (see ``filter_shard``).
+
+    When *journal* is specified, subscriptions are processed
+    by organization, resuming after the last organization checkpointed
+    in the ``RenewalsJournal``. The checkpoint stops moving forward
+    at the first organization that could not be fully processed.
+
+    Returns the number of subscriptions processed.
     """
+    nb_subscriptions = 0
     until = datetime_or_now(until)
     LOGGER.info("recognize income until %s ...", until)
-    for subscription in Subscription.objects.valid_for(created_at__lte=until):
+    subscriptions = _get_income_candidates(until, shard=shard)
+    if journal:
+        if journal.last_organization_id:
+            subscriptions = subscriptions.filter(
+                organization_id__gt=journal.last_organization_id)
+        subscriptions = subscriptions.order_by('organization_id', 'pk')
+    prev_organization_id = None
+    nb_organization_subscriptions = 0
+    # A checkpoint records that all organizations up to it were fully
+    # processed, so none can be recorded after an organization was
+    # skipped (ex: locked by another runner) or failed.
+    checkpointable = bool(journal)
+    for subscription in subscriptions:
+        if (checkpointable and prev_organization_id and
+            prev_organization_id != subscription.organization_id):
+            journal.checkpoint(prev_organization_id,
+                nb_processed=nb_organization_subscriptions)
+            nb_organization_subscriptions = 0
+        prev_organization_id = subscription.organization_id
         # We need to pass through subscriptions otherwise we won't recognize
         # income on subscription that were just cancelled.
         try:
             with transaction.atomic():
+                if not lock_organization(subscription.organization_id):
+                    LOGGER.info("SKIP   %s (locked by another runner)",
+                        subscription)
+                    checkpointable = False
+                    continue
                 _recognize_subscription_income(subscription, until=until)
+                nb_subscriptions += 1
+                nb_organization_subscriptions += 1
                 if dry_run:
                     raise DryRun()
         except AssertionError as err:
             # We log the exception and moves on to the next subscription,
             # giving a chance to others to complete.
             LOGGER.exception(err)
+            checkpointable = False
         except DryRun:
             pass
+    if checkpointable and prev_organization_id:
+        journal.checkpoint(prev_organization_id,
+            nb_processed=nb_organization_subscriptions)
+    return nb_subscriptions
 
 
-def extend_subscription(subscription, at_time=None, dry_run=False):
-    nb_renewals = 0
-    at_time = datetime_or_now(at_time)
+def _is_renewal_due(subscription, at_time):
     lower, upper = subscription.clipped_period_for(at_time)
     # `relativedelta` will compute number of years, months, days, etc.
     # `days` represents the difference in days after years and months have
@@ -232,95 +458,184 @@ def extend_subscription(subscription, at_time=None, dry_run=False):
             subscription.plan.period_length, describe_period_name(
                 subscription.plan.period_type,
                 subscription.plan.period_length))
-        nb_renewals += 1
-        if not dry_run:
-            try:
-                with transaction.atomic():
-                    # We need to create the order before extending
-                    # the `Subscription` otherwise, the order will show
-                    # an extra period in the `Transaction` description.
-                    invoiced_item = Transaction.objects.new_subscription_order(
-                            subscription, created_at=at_time)
-                    invoiced_item.save()
-                    subscription.extends()
-                    for use in subscription.uses.all():
-                        use.extends()
-            except Exception as err: #pylint:disable=broad-except
-                # logs any kind of errors
-                # and move on to the next subscription.
-                LOGGER.exception(
-                    "error: extending subscription for %s ending at %s: %s",
-                    subscription, subscription.ends_at, err)
+        return True
+    return False
+
+
+def _extend_subscriptions_batch(subscriptions, at_time):
+    """
+    Extends *subscriptions* and records their orders in a single
+    db transaction.
+
+    Returns the number of subscriptions extended.
+    """
+    with transaction.atomic():
+        locked = lock_organizations(
+            set([subscription.organization_id
+                 for subscription in subscriptions]))
+        # Another runner might have extended some of the subscriptions
+        # since we loaded them.
+        current = dict(Subscription.objects.filter(
+            pk__in=[subscription.pk for subscription in subscriptions]
+        ).values_list('pk', 'ends_at'))
+        extended = []
+        for subscription in subscriptions:
+            if subscription.organization_id not in locked:
+                LOGGER.info("SKIP   %s (locked by another runner)",
+                    subscription)
+            elif current.get(subscription.pk) == subscription.ends_at:
+                extended += [subscription]
+        # We need to create the orders before extending
+        # the `Subscription` otherwise, the orders will show
+        # an extra period in the `Transaction` description.
+        Transaction.objects.bulk_record([
+            Transaction.objects.new_subscription_order(
+                subscription, created_at=at_time)
+            for subscription in extended])
+        # Same as `Subscription.extends` and `SubscriptionUse.extends`
+        # without saving (and sending signals for) each row one at a time.
+        for subscription in extended:
+            subscription.ends_at = subscription.plan.end_of_period(
+                subscription.ends_at)
+            LOGGER.info(
+                "extends subscription of %s to %s until %s",
+                subscription.organization, subscription.plan,
+                subscription.ends_at, extra={
+                    'event': 'upsert-subscription',
+                    'organization': subscription.organization.slug,
+                    'plan': subscription.plan.slug,
+                    'ends_at': subscription.ends_at})
+        Subscription.objects.bulk_update(extended, ['ends_at'])
+        uses = list(SubscriptionUse.objects.filter(
+            subscription__in=extended).select_related('use'))
+        for use in uses:
+            use.expiring_quota = use.use.quota
+        SubscriptionUse.objects.bulk_update(uses, ['expiring_quota'])
+        # `bulk_update` does not send the `post_save` signals
+        # which reschedule the due events.
+        DueEvent.objects.schedule_subscriptions(extended)
+    return len(extended)
+
+
+def _extend_subscriptions(subscriptions, at_time, dry_run=False,
+                          batch_size=100):
+    nb_renewals = 0
+    batch = []
+    for subscription in subscriptions:
+        if not _is_renewal_due(subscription, at_time):
+            continue
+        if dry_run:
+            nb_renewals += 1
+            continue
+        batch += [subscription]
+        if len(batch) >= batch_size:
+            nb_renewals += _extend_subscriptions_with_fallback(batch, at_time)
+            batch = []
+    if batch:
+        nb_renewals += _extend_subscriptions_with_fallback(batch, at_time)
     return nb_renewals
 
 
+def _extend_subscriptions_with_fallback(subscriptions, at_time):
+    # `_extend_subscriptions_batch` moves `ends_at` forward in memory.
+    # We restore the value loaded when the db transaction is rolled back,
+    # otherwise the retry would think another runner extended
+    # the subscription.
+    ends_ats = [subscription.ends_at for subscription in subscriptions]
+    try:
+        return _extend_subscriptions_batch(subscriptions, at_time)
+    except Exception as err: #pylint:disable=broad-except
+        for subscription, ends_at in zip(subscriptions, ends_ats):
+            subscription.ends_at = ends_at
+        if len(subscriptions) == 1:
+            # logs any kind of errors
+            # and move on to the next subscription.
+            LOGGER.exception(
+                "error: extending subscription for %s ending at %s: %s",
+                subscriptions[0], subscriptions[0].ends_at, err)
+            return 0
+    # One subscription in the batch failed. Retry one subscription
+    # at a time such that the others still get extended.
+    nb_renewals = 0
+    for subscription in subscriptions:
+        nb_renewals += _extend_subscriptions_with_fallback(
+            [subscription], at_time)
+    return nb_renewals
+
+
+def extend_subscription(subscription, at_time=None, dry_run=False):
+    at_time = datetime_or_now(at_time)
+    return _extend_subscriptions([subscription], at_time, dry_run=dry_run)
+
+
+def get_renewal_candidates(at_time):
+    """
+    Returns the auto-renewed subscriptions which end within a day
+    of *at_time*.
+
+    The range on ``ends_at`` is backed by the ``(auto_renew, ends_at)``
+    index such that the query does not scan all active subscriptions.
+    """
+    return Subscription.objects.valid_for(auto_renew=True,
+        created_at__lte=at_time, ends_at__gt=at_time,
+        ends_at__lt=at_time + relativedelta(days=1)).select_related(
+        'organization', 'plan').order_by('pk')
+
+
 def extend_subscriptions_organization(organization,
                                       at_time=None, dry_run=False):
     """
     Extend active subscriptions
     """
-    nb_renewals = 0
     at_time = datetime_or_now(at_time)
     LOGGER.info("extend subscriptions for %s at %s ...", organization, at_time)
-    for subscription in Subscription.objects.filter(
-            organization=organization).valid_for(auto_renew=True,
-            created_at__lte=at_time, ends_at__gt=at_time).select_related(
-            'organization', 'plan'):
-        nb_renewals += extend_subscription(
-            subscription, at_time=at_time, dry_run=dry_run)
-
-    return nb_renewals
+    return _extend_subscriptions(get_renewal_candidates(at_time).filter(
+        organization=organization), at_time, dry_run=dry_run)
 
 
-def extend_subscriptions(at_time=None, dry_run=False):
+def extend_subscriptions(at_time=None, dry_run=False, shard=None,
+                         batch_size=100):
     """
     Extend active subscriptions
+
+    Orders for the subscriptions renewed are recorded *batch_size*
+    at a time.
     """
-    nb_renewals = 0
     at_time = datetime_or_now(at_time)
     LOGGER.info("extend subscriptions at %s ...", at_time)
-    for subscription in Subscription.objects.valid_for(auto_renew=True,
-            created_at__lte=at_time, ends_at__gt=at_time).select_related(
-            'organization', 'plan'):
-        nb_renewals += extend_subscription(
-            subscription, at_time=at_time, dry_run=dry_run)
-
-    return nb_renewals
+    return _extend_subscriptions(
+        filter_shard(get_renewal_candidates(at_time), shard).iterator(),
+        at_time, dry_run=dry_run, batch_size=batch_size)
 
 
-def trigger_expiration_notices(at_time=None, nb_days=15, dry_run=False):
+def _cache_missing_cards(organizations, dry_run=False):
     """
-    Trigger a signal for all subscriptions which are near the expiration date.
+    Retrieves once from the processor the card of *organizations*
+    which were attached before card details were kept locally.
     """
+    for organization in organizations:
+        if dry_run:
+            LOGGER.info("would retrieve card for %s", organization)
+            continue
+        try:
+            organization.cache_card(organization.retrieve_card())
+            organization.save(update_fields=[
+                'card_brand', 'card_last4', 'card_exp_date'])
+        except Exception as err: #pylint:disable=broad-except
+            LOGGER.exception("error: retrieving card for %s: %s",
+                organization, err)
 
-    def _handle_organization_notices(organization):
-        nb_notices = 0
-        if organization.processor_card_key:
-            card = organization.retrieve_card()
-            try:
-                exp_month, exp_year = card['exp_date'].split('/')
-                exp_date = datetime(year=int(exp_year),
-                    month=int(exp_month), day=1, tzinfo=at_time.tzinfo)
-                if lower >= exp_date:
-                    LOGGER.info("payment method expires soon for %s",
-                        organization)
-                    nb_notices += 1
-                    if not dry_run:
-                        signals.card_expires_soon.send(
-                            sender=__name__, organization=organization,
-                            nb_days=nb_days)
-            except (KeyError, ValueError):
-                # exp info is missing or the format is incorrect
-                pass
-        else:
-            LOGGER.info("%s doesn't have a payment method attached",
-                organization)
-            nb_notices += 1
-            if not dry_run:
-                signals.payment_method_absent.send(sender=__name__,
-                    organization=organization)
-        return nb_notices
 
+def trigger_expiration_notices(at_time=None, nb_days=15, dry_run=False,
+                               shard=None):
+    """
+    Trigger a signal for all subscriptions which are near the expiration date.
+
+    The expiration date of the card on file is read from the local copy
+    kept on the organization (see ``AbstractOrganization.cache_card``)
+    such that no calls to the processor are necessary.
+    """
+    #pylint:disable=too-many-branches
     nb_notices = 0
     at_time = datetime_or_now(at_time)
     lower = at_time + relativedelta(days=nb_days)
@@ -328,58 +643,75 @@ def trigger_expiration_notices(at_time=None, nb_days=15, dry_run=False):
     LOGGER.info(
         "trigger notifications for subscription expiring within [%s,%s[ ...",
         lower, upper)
-    prev_organization = None
-    subscription = None
-    for subscription in Subscription.objects.valid_for(ends_at__gte=lower,
-            ends_at__lt=upper).order_by('organization'):
-        org = subscription.organization
-        plan = subscription.plan
+    subscriptions = filter_shard(Subscription.objects.valid_for(
+        ends_at__gte=lower, ends_at__lt=upper), shard)
 
+    # Subscriptions that will auto-renew: notify the organization once
+    # when its payment method is absent or expires before the renewal.
+    organizations = get_organization_model().objects.filter(
+        pk__in=subscriptions.filter(auto_renew=True,
+            plan__renewal_type=Plan.AUTO_RENEW).values('organization_id'))
+    _cache_missing_cards(organizations.filter(
+        processor_card_key__isnull=False, card_exp_date__isnull=True),
+        dry_run=dry_run)
+    for organization in organizations.filter(
+            processor_card_key__isnull=True).order_by('pk'):
+        LOGGER.info("%s doesn't have a payment method attached",
+            organization)
+        nb_notices += 1
+        if not dry_run:
+            try:
+                signals.payment_method_absent.send(sender=__name__,
+                    organization=organization)
+            except Exception as err: #pylint:disable=broad-except
+                # We use `Exception` because the email server might be
+                # unavailable but ConnectionRefusedError is not a subclass
+                # of RuntimeError.
+                LOGGER.exception("error: %s", err)
+    for organization in organizations.filter(
+            processor_card_key__isnull=False,
+            card_exp_date__lte=lower.date()).order_by('pk'):
+        LOGGER.info("payment method expires soon for %s", organization)
+        nb_notices += 1
+        if not dry_run:
+            try:
+                signals.card_expires_soon.send(
+                    sender=__name__, organization=organization,
+                    nb_days=nb_days)
+            except Exception as err: #pylint:disable=broad-except
+                LOGGER.exception("error: %s", err)
+
+    # Subscriptions that will not auto-renew.
+    for subscription in subscriptions.filter(auto_renew=False,
+            plan__renewal_type__in=[Plan.ONE_TIME, Plan.REPEAT]
+            ).select_related('organization', 'plan').order_by(
+            'organization', 'pk'):
+        plan = subscription.plan
         try:
-            if subscription.auto_renew:
-                if plan.renewal_type == plan.AUTO_RENEW:
-                    if org.id != prev_organization:
-                        nb_notices += _handle_organization_notices(org)
-
-                    prev_organization = org.id
-            else:
-                if plan.renewal_type == plan.ONE_TIME:
-                    LOGGER.info("trigger upgrade soon for %s", subscription)
-                    nb_notices += 1
-                    if not dry_run:
-                        signals.subscription_upgrade.send(sender=__name__,
-                            subscription=subscription, nb_days=nb_days)
+            if plan.renewal_type == plan.ONE_TIME:
+                LOGGER.info("trigger upgrade soon for %s", subscription)
+                nb_notices += 1
+                if not dry_run:
+                    signals.subscription_upgrade.send(sender=__name__,
+                        subscription=subscription, nb_days=nb_days)
 
-                elif plan.renewal_type == plan.REPEAT:
-                    LOGGER.info("trigger expires soon for %s", subscription)
-                    nb_notices += 1
-                    if not dry_run:
-                        signals.expires_soon.send(sender=__name__,
-                            subscription=subscription, nb_days=nb_days)
+            elif plan.renewal_type == plan.REPEAT:
+                LOGGER.info("trigger expires soon for %s", subscription)
+                nb_notices += 1
+                if not dry_run:
+                    signals.expires_soon.send(sender=__name__,
+                        subscription=subscription, nb_days=nb_days)
 
         except Exception as err: #pylint:disable=broad-except
-            # We use `Exception` because the email server might be
-            # unavailable but ConnectionRefusedError is not a subclass
-            # of RuntimeError.
             LOGGER.exception("error: %s", err)
 
-    # flushing the last organization
-    if subscription and subscription.organization.id != prev_organization:
-        if subscription.auto_renew:
-            if subscription.plan.renewal_type == subscription.plan.AUTO_RENEW:
-                nb_notices += _handle_organization_notices(
-                    subscription.organization)
     return nb_notices
 
 
-def create_charge_for_balance_organization(organization,
-                                           until=None, dry_run=False):
-    #pylint:disable=too-many-locals
-    nb_charges = 0
-
+def _is_billing_due(organization, until):
     if not organization.billing_start:
         LOGGER.info('SKIP   %s (no automated billing date)', organization)
-        return nb_charges
+        return False
 
     automatic_billing_at = datetime_or_now(organization.billing_start)
     nb_days = relativedelta(automatic_billing_at, until).days
@@ -388,6 +720,16 @@ def create_charge_for_balance_organization(organization,
             ' not within %d days prior to %s - %d days)', organization,
             automatic_billing_at, settings.MAX_RENEWAL_ATTEMPTS, until,
             nb_days)
+        return False
+    return True
+
+
+def create_charge_for_balance_organization(organization,
+                                           until=None, dry_run=False):
+    #pylint:disable=too-many-locals
+    nb_charges = 0
+
+    if not _is_billing_due(organization, until):
         return nb_charges
 
     # We will create charges only when we have no charges
@@ -491,23 +833,516 @@ def create_charge_for_balance_organization(organization,
     return nb_charges
 
 
-def create_charges_for_balance(until=None, dry_run=False):
+def get_billing_candidates(until=None, min_amount=50):
+    """
+    Returns the organizations with an automated billing date within
+    the renewal window of *until*, no charge in flight, and a payable
+    balance larger than *min_amount* in at least one currency unit
+    (all when *min_amount* is ``None``).
+
+    Each organization is annotated with its ``invoiceable_amount``
+    and ``invoiceable_unit``, the largest of the balances per unit
+    ``sum_dest_amount(Transaction.objects.get_invoiceables(
+    organization, until=organization.billing_start))`` would return.
+    """
+    until = datetime_or_now(until)
+    billing_start_at = Cast(OuterRef('billing_start'), DateTimeField())
+    last_payment_at = Transaction.objects.filter(
+        Q(orig_account=Transaction.PAYABLE)
+        | Q(orig_account=Transaction.LIABILITY),
+        Q(dest_account=Transaction.FUNDS)
+        | Q(dest_account=Transaction.WRITEOFF),
+        orig_organization=OuterRef('pk'),
+        created_at__lt=billing_start_at).order_by(
+        '-created_at').values('created_at')[:1]
+    invoiceables = Transaction.objects.filter(
+        Q(dest_account=Transaction.PAYABLE)
+        | Q(dest_account=Transaction.LIABILITY),
+        dest_organization=OuterRef('pk'),
+        created_at__lte=billing_start_at,
+        created_at__gt=OuterRef('last_payment_at')).order_by().values(
+        'dest_organization', 'dest_unit').annotate(amount=Sum('dest_amount'))
+    if min_amount is not None:
+        # Stripe will not processed charges less than 50 cents.
+        invoiceables = invoiceables.filter(amount__gt=min_amount)
+    invoiceables = invoiceables.order_by('-amount', 'dest_unit')[:1]
+    in_flight = Charge.objects.filter(customer=OuterRef('pk'),
+        state=Charge.CREATED, processor_key__isnull=False)
+    # The window is slightly larger than the one checked
+    # in `create_charge_for_balance_organization` because `billing_start`
+    # is a date while *until* is a datetime.
+    queryset = get_organization_model().objects.filter(
+        nb_renewal_attempts__lt=settings.MAX_RENEWAL_ATTEMPTS,
+        billing_start__gte=(until - relativedelta(days=1)).date(),
+        billing_start__lte=(until + relativedelta(
+            days=settings.MAX_RENEWAL_ATTEMPTS + 1)).date()).exclude(
+        Exists(in_flight)).annotate(
+        last_payment_at=Coalesce(Subquery(last_payment_at),
+            Value(datetime_or_now(datetime(1970, 1, 1)),
+                output_field=DateTimeField()))).annotate(
+        invoiceable_amount=Subquery(invoiceables.values('amount')),
+        invoiceable_unit=Subquery(invoiceables.values('dest_unit')))
+    if min_amount is not None:
+        queryset = queryset.filter(invoiceable_amount__isnull=False)
+    return queryset.order_by('pk')
+
+
+def create_charges_for_balance(until=None, dry_run=False, shard=None,
+                               journal=None):
     """
     Create charges for all accounts payable.
+
+    When *journal* is specified, organizations are processed
+    after the last organization checkpointed in the ``RenewalsJournal``,
+    and the checkpoint is recorded along with the charges until
+    an organization is skipped because another runner locked it.
     """
     nb_charges = 0
     until = datetime_or_now(until)
     LOGGER.info("create charges for balance at %s ...", until)
-    for organization in get_organization_model().objects.filter(
-            nb_renewal_attempts__lt=settings.MAX_RENEWAL_ATTEMPTS):
-        nb_charges += create_charge_for_balance_organization(
-            organization, until=until, dry_run=dry_run)
+    candidates = get_billing_candidates(until)
+    if journal and journal.last_organization_id:
+        candidates = candidates.filter(pk__gt=journal.last_organization_id)
+    # The organizations after one that was skipped are processed but not
+    # checkpointed, else the skipped one would never be charged on resume.
+    checkpointable = bool(journal)
+    for organization in filter_shard(candidates, shard, field='pk'):
+        LOGGER.debug("billing candidate %s with %d %s invoiceable",
+            organization, organization.invoiceable_amount,
+            organization.invoiceable_unit)
+        with transaction.atomic():
+            if not lock_organization(organization.pk):
+                LOGGER.info("SKIP   %s (locked by another runner)",
+                    organization)
+                checkpointable = False
+                continue
+            # Another runner might have charged the organization
+            # since we loaded it.
+            organization.refresh_from_db()
+            nb_organization_charges = create_charge_for_balance_organization(
+                organization, until=until, dry_run=dry_run)
+            nb_charges += nb_organization_charges
+            if checkpointable:
+                journal.checkpoint(organization.pk,
+                    nb_processed=nb_organization_charges)
     return nb_charges
 
 
-def complete_charges():
+def _retrieve_in_flight_charge(charge_id, semaphore):
+    """
+    Retrieves the state of charge *charge_id* from its processor
+    unless it was already settled (ex: through a webhook).
+
+    Returns ``True`` once the charge is no longer in progress.
     """
-    Update the state of all charges in progress.
+    try:
+        with semaphore:
+            charge = Charge.objects.filter(
+                pk=charge_id, state=Charge.CREATED).first()
+            if charge is None:
+                LOGGER.debug("charge %s already settled", charge_id)
+                return True
+            charge.retrieve()
+            return not charge.is_progress
+    finally:
+        # Each thread uses its own database connection.
+        connections.close_all()
+
+
+def complete_charges(shard=None, timeout=600, initial_delay=5, max_delay=60,
+                     max_workers=8, max_per_processor=4, charges=None):
     """
-    for charge in Charge.objects.filter(state=Charge.CREATED):
-        charge.retrieve()
+    Update the state of all charges in progress, or only *charges*
+    (a ``Charge`` queryset) when specified.
+
+    In-flight charges are polled concurrently by at most *max_workers*
+    threads, and no more than *max_per_processor* requests at a time
+    for the same processor. A charge is first polled after *initial_delay*
+    seconds, then with an exponential backoff up to *max_delay* seconds
+    until it settles or *timeout* seconds have elapsed.
+
+    Returns a tuple (number of charges settled, number of charges still
+    in progress).
+    """
+    #pylint:disable=too-many-arguments,too-many-locals
+    if charges is None:
+        charges = Charge.objects.all()
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    semaphores = {}
+    queue = []
+    for charge_id, processor_id in filter_shard(charges.filter(
+            state=Charge.CREATED, processor_key__isnull=False), shard,
+            field='customer_id').values_list('pk', 'processor_id'):
+        if processor_id not in semaphores:
+            semaphores[processor_id] = threading.BoundedSemaphore(
+                max_per_processor)
+        heapq.heappush(queue, (started_at + initial_delay, charge_id,
+            initial_delay, processor_id))
+    nb_charges = len(queue)
+    nb_in_progress = nb_charges
+    LOGGER.info("complete %d charges in progress ...", nb_in_progress)
+    futures = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while queue or futures:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            while queue and queue[0][0] <= now:
+                _, charge_id, delay, processor_id = heapq.heappop(queue)
+                futures[executor.submit(_retrieve_in_flight_charge,
+                    charge_id, semaphores[processor_id])] = (
+                    charge_id, delay, processor_id)
+            wait_until = deadline
+            if queue:
+                wait_until = min(queue[0][0], deadline)
+            if not futures:
+                time.sleep(max(0, wait_until - now))
+                continue
+            done, _ = wait(list(futures.keys()),
+                timeout=max(0, wait_until - now),
+                return_when=FIRST_COMPLETED)
+            for future in done:
+                charge_id, delay, processor_id = futures.pop(future)
+                try:
+                    settled = future.result()
+                except Exception as err: #pylint:disable=broad-except
+                    LOGGER.exception(
+                        "error: retrieving charge %s: %s", charge_id, err)
+                    settled = False
+                if settled:
+                    nb_in_progress -= 1
+                else:
+                    delay = min(2 * delay, max_delay)
+                    heapq.heappush(queue, (time.monotonic() + delay,
+                        charge_id, delay, processor_id))
+    finally:
+        # Polls not started yet are cancelled. We return without waiting
+        # on the polls still in flight past the deadline; their threads
+        # exit as soon as the processor responds.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    if nb_in_progress:
+        LOGGER.warning("%d charges still in progress after %d seconds",
+            nb_in_progress, timeout)
+    return nb_charges - nb_in_progress, nb_in_progress
+
+
+class DryRunLedger(object):
+    """
+    In-memory slice of the ledger touched by a renewals run. It is loaded
+    once such that income recognition, renewals and charges can be
+    simulated without querying the database for each subscription,
+    nor writing to it.
+    """
+
+    def __init__(self, subscriptions, until):
+        self.entries = {}
+        self.projected = []
+        for entry in Transaction.objects.filter(
+                event_subscription__in=subscriptions,
+                created_at__lt=until).order_by('created_at'):
+            self.entries.setdefault(entry.event_subscription_id, []).append(
+                entry)
+
+    def add(self, entries):
+        """
+        Adds the projected *entries* to the ledger.
+        """
+        for entry in entries:
+            entry.populate_event_refs()
+            self.entries.setdefault(entry.event_subscription_id, []).append(
+                entry)
+            self.projected += [entry]
+
+    def get_income_ledger(self, subscription, until):
+        return _IncomeLedger(subscription, until, entries=[
+            (entry.created_at, entry.event_id,
+             entry.orig_account, entry.orig_amount,
+             entry.dest_account, entry.dest_amount)
+            for entry in self.entries.get(subscription.pk, [])
+            if entry.created_at < until])
+
+    def get_subscription_receivable(self, subscription, until):
+        """
+        Same as ``Transaction.objects.get_subscription_receivable``.
+        """
+        return sorted([entry for entry in self.entries.get(subscription.pk, [])
+            if (entry.orig_account == Transaction.RECEIVABLE and
+                not entry.event_use_charge_id and entry.created_at < until)],
+            key=lambda entry: entry.created_at)
+
+    def get_projected_invoiceable(self, organization, until):
+        """
+        Returns the amount payable by *organization* until *until*
+        in the projected transactions.
+        """
+        amount = 0
+        unit = None
+        for entry in self.projected:
+            if (entry.dest_organization_id == organization.pk and
+                entry.dest_account in (
+                    Transaction.PAYABLE, Transaction.LIABILITY) and
+                entry.created_at <= until):
+                amount += entry.dest_amount
+                unit = entry.dest_unit
+        return amount, unit
+
+
+def simulate_renewals(at_time=None, shard=None):
+    """
+    Simulates recognizing income, extending subscriptions and creating
+    charges at *at_time* against an in-memory ``DryRunLedger``,
+    without writing to the database.
+
+    Returns a projected report of the ``Transaction`` that would be recorded,
+    the subscriptions that would be renewed (with their new ``ends_at``),
+    the charges that would be created and the number of expiration
+    notices that would be sent for each period of ``EXPIRE_NOTICE_DAYS``.
+    """
+    at_time = datetime_or_now(at_time)
+    LOGGER.info("simulate renewals at %s ...", at_time)
+    subscriptions = list(_get_income_candidates(at_time, shard=shard))
+    ledger = DryRunLedger([subscription.pk for subscription in subscriptions],
+        at_time)
+    report = {'transactions': ledger.projected, 'renewals': [], 'charges': [],
+        'notices': {}}
+
+    for subscription in subscriptions:
+        try:
+            ledger.add(_recognize_subscription_income(subscription,
+                until=at_time,
+                ledger=ledger.get_income_ledger(subscription, at_time),
+                orders=ledger.get_subscription_receivable(
+                    subscription, at_time),
+                dry_run=True))
+        except AssertionError as err:
+            LOGGER.exception(err)
+
+    for subscription in filter_shard(get_renewal_candidates(at_time), shard):
+        if _is_renewal_due(subscription, at_time):
+            ledger.add([Transaction.objects.new_subscription_order(
+                subscription, created_at=at_time)])
+            report['renewals'] += [(subscription,
+                subscription.plan.end_of_period(subscription.ends_at))]
+
+    for organization in filter_shard(get_billing_candidates(
+            at_time, min_amount=None), shard, field='pk'):
+        if not _is_billing_due(organization, at_time):
+            continue
+        amount, unit = ledger.get_projected_invoiceable(organization,
+            datetime_or_now(organization.billing_start))
+        amount += organization.invoiceable_amount or 0
+        if amount > 50:
+            report['charges'] += [{
+                'organization': organization,
+                'amount': amount,
+                'unit': unit or settings.DEFAULT_UNIT,
+                'card_absent': not organization.processor_card_key}]
+            LOGGER.info("(dry-run) CHARGE %d %s to %s", amount,
+                unit or settings.DEFAULT_UNIT, organization)
+
+    if settings.EXPIRE_NOTICE_DAYS and not settings.DUE_EVENTS_NOTICES:
+        # The subscriptions expiring in all notice periods are loaded once.
+        expiring = list(filter_shard(Subscription.objects.valid_for(
+            ends_at__gte=at_time + relativedelta(
+                days=min(settings.EXPIRE_NOTICE_DAYS)),
+            ends_at__lt=at_time + relativedelta(
+                days=max(settings.EXPIRE_NOTICE_DAYS) + 1)), shard
+            ).select_related('organization', 'plan').order_by('pk'))
+        for nb_days in settings.EXPIRE_NOTICE_DAYS:
+            report['notices'][nb_days] = _simulate_expiration_notices(
+                expiring, at_time, nb_days)
+    return report
+
+
+def _simulate_expiration_notices(subscriptions, at_time, nb_days):
+    """
+    Returns the number of notices ``trigger_expiration_notices`` would send
+    for *subscriptions* expiring *nb_days* after *at_time*.
+
+    Cards attached before card details were kept locally are not retrieved
+    from the processor; they are reported in the logs instead.
+    """
+    nb_notices = 0
+    lower = at_time + relativedelta(days=nb_days)
+    upper = at_time + relativedelta(days=nb_days + 1)
+    organizations = {}
+    for subscription in subscriptions:
+        if not lower <= subscription.ends_at < upper:
+            continue
+        plan = subscription.plan
+        if subscription.auto_renew:
+            if plan.renewal_type == plan.AUTO_RENEW:
+                organizations[subscription.organization_id] = \
+                    subscription.organization
+        elif plan.renewal_type in (plan.ONE_TIME, plan.REPEAT):
+            LOGGER.info("(dry-run) trigger %s soon for %s",
+                "upgrade" if plan.renewal_type == plan.ONE_TIME
+                else "expires", subscription)
+            nb_notices += 1
+    for organization in organizations.values():
+        if not organization.processor_card_key:
+            LOGGER.info("(dry-run) %s doesn't have a payment method attached",
+                organization)
+            nb_notices += 1
+        elif not organization.card_exp_date:
+            LOGGER.info("(dry-run) card details of %s are not kept locally",
+                organization)
+        elif organization.card_exp_date <= lower.date():
+            LOGGER.info("(dry-run) payment method expires soon for %s",
+                organization)
+            nb_notices += 1
+    return nb_notices
+
+
+def _trigger_subscription_expiration_notice(subscription, nb_days, at_time):
+    """
+    Same as ``trigger_expiration_notices`` for a single *subscription*.
+    """
+    lower = at_time + relativedelta(days=nb_days)
+    upper = at_time + relativedelta(days=nb_days + 1)
+    if not lower <= subscription.ends_at < upper:
+        # The subscription was extended or cancelled since the notice
+        # was scheduled.
+        return 0
+    organization = subscription.organization
+    plan = subscription.plan
+    if subscription.auto_renew:
+        if plan.renewal_type != plan.AUTO_RENEW:
+            return 0
+        if not organization.processor_card_key:
+            LOGGER.info("%s doesn't have a payment method attached",
+                organization)
+            signals.payment_method_absent.send(sender=__name__,
+                organization=organization)
+            return 1
+        if not organization.card_exp_date:
+            _cache_missing_cards([organization])
+        if (organization.card_exp_date and
+            organization.card_exp_date <= lower.date()):
+            LOGGER.info("payment method expires soon for %s", organization)
+            signals.card_expires_soon.send(sender=__name__,
+                organization=organization, nb_days=nb_days)
+            return 1
+    elif plan.renewal_type == plan.ONE_TIME:
+        LOGGER.info("trigger upgrade soon for %s", subscription)
+        signals.subscription_upgrade.send(sender=__name__,
+            subscription=subscription, nb_days=nb_days)
+        return 1
+    elif plan.renewal_type == plan.REPEAT:
+        LOGGER.info("trigger expires soon for %s", subscription)
+        signals.expires_soon.send(sender=__name__,
+            subscription=subscription, nb_days=nb_days)
+        return 1
+    return 0
+
+
+def _process_due_event(event, at_time):
+    if event.kind == DueEvent.RENEWAL:
+        # ``due_at`` is in the last day of the last period so the renewal
+        # is recorded as such even when the worker runs late.
+        extend_subscription(event.subscription, at_time=event.due_at)
+    elif event.kind == DueEvent.EXPIRATION_NOTICE:
+        if not settings.DUE_EVENTS_NOTICES:
+            # The notices are sent by the renewals command.
+            return
+        _trigger_subscription_expiration_notice(
+            event.subscription, event.nb_days, at_time=event.due_at)
+    elif event.kind == DueEvent.CHARGE:
+        organization = event.organization
+        if not lock_organization(organization.pk):
+            LOGGER.info("SKIP   %s (locked by another runner)", organization)
+            DueEvent.objects.schedule_charge(organization,
+                due_at=at_time + relativedelta(minutes=1))
+            return
+        organization.refresh_from_db()
+        billing_start = organization.billing_start
+        nb_renewal_attempts = organization.nb_renewal_attempts
+        create_charge_for_balance_organization(organization, until=at_time)
+        if (nb_renewal_attempts < organization.nb_renewal_attempts <
+            settings.MAX_RENEWAL_ATTEMPTS):
+            # The charge failed. We will retry the next day.
+            DueEvent.objects.schedule_charge(organization,
+                due_at=at_time + relativedelta(days=1))
+        elif (billing_start and organization.billing_start == billing_start
+              and datetime_or_now(billing_start) > at_time):
+            # ``billing_start`` did not move forward (ex: nothing to charge
+            # yet) so nothing replaced the charge this event stood for.
+            # We reschedule it from ``billing_start``, at most once a day.
+            due_at = datetime_or_now(billing_start) - relativedelta(
+                days=settings.MAX_RENEWAL_ATTEMPTS)
+            DueEvent.objects.schedule_charge(organization,
+                due_at=max(due_at, at_time + relativedelta(days=1)))
+
+
+def _retry_due_event(event, at_time):
+    """
+    Reschedules *event* after it failed, with an exponential backoff,
+    or drops it after ``DueEvent.MAX_ATTEMPTS``.
+    """
+    nb_attempts = event.nb_attempts + 1
+    if nb_attempts >= DueEvent.MAX_ATTEMPTS:
+        LOGGER.error("error: dropping %s after %d attempts",
+            event, nb_attempts)
+        DueEvent.objects.filter(pk=event.pk).delete()
+        return
+    # Retries in 2, 4, 8, ... minutes.
+    DueEvent.objects.filter(pk=event.pk).update(nb_attempts=nb_attempts,
+        due_at=at_time + relativedelta(minutes=2 ** nb_attempts))
+
+
+def process_due_events(at_time=None, batch_size=100):
+    """
+    Processes up to *batch_size* events due at *at_time*, in order.
+
+    Events are claimed one at a time with ``SELECT ... FOR UPDATE
+    SKIP LOCKED`` such that multiple workers can process the queue
+    concurrently. Each event is processed in its own db transaction
+    so that the work done for an event (ex: a charge created
+    at the processor) is committed before the next event is claimed.
+    An event that fails is retried later (see ``_retry_due_event``).
+
+    Returns the number of events processed.
+    """
+    at_time = datetime_or_now(at_time)
+    nb_events = 0
+    while nb_events < batch_size:
+        with transaction.atomic():
+            event = DueEvent.objects.select_for_update(
+                skip_locked=True, of=('self',)).filter(
+                due_at__lte=at_time).select_related(
+                'subscription__organization', 'subscription__plan',
+                'organization').order_by('due_at', 'pk').first()
+            if event is None:
+                break
+            LOGGER.debug("process %s", event)
+            try:
+                with transaction.atomic():
+                    _process_due_event(event, at_time)
+                # Processing the event might have rescheduled others
+                # (ex: the next renewal) so we only remove this one.
+                DueEvent.objects.filter(pk=event.pk).delete()
+            except Exception as err: #pylint:disable=broad-except
+                # logs any kind of errors
+                # and move on to the next event.
+                LOGGER.exception("error: processing %s: %s", event, err)
+                _retry_due_event(event, at_time)
+        nb_events += 1
+    return nb_events
+
+
+def schedule_due_events(at_time=None):
+    """
+    Rebuilds the queue of due events from the active subscriptions
+    and the organizations with an automated billing date.
+    """
+    at_time = datetime_or_now(at_time)
+    for subscription in Subscription.objects.valid_for(
+            ends_at__gt=at_time).select_related('plan').iterator():
+        DueEvent.objects.schedule_subscription(subscription, at_time=at_time)
+    for organization in get_organization_model().objects.filter(
+            billing_start__isnull=False).iterator():
+        DueEvent.objects.schedule_charge(organization)
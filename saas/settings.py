@@ -48,6 +48,10 @@ BYPASS_PROCESSOR_AUTH      False            Do not check the auth token against
                                             (useful to test StripeConnect).
 DISABLE_UPDATES           False             When `True`, modifications are not
                                             allowed.
+DUE_EVENTS_NOTICES        False             When `True`, expiration notices are
+                                            sent by the ``process_due_events``
+                                            workers instead of the ``renewals``
+                                            command.
 EXTRA_MIXIN               object            Class to to inject into the parents
                                             of the Mixin hierarchy.
                                             (useful for composition of Django
@@ -68,6 +72,9 @@ PROVIDER_SITE_CALLABLE   None               Optional function that returns
                                             apps)
 TERMS_OF_USE             'terms-of-use'     slug for the ``Agreement`` stating
                                             ther Terms of Use of the site.
+TRANSACTION_PARTITIONS   False              Partition the ``Transaction`` table
+                                            by month on PostgreSQL when
+                                            the migrations are applied.
 ========================  ================= ===========
 """
 import os
@@ -100,6 +107,7 @@ _SETTINGS = {
     'DEFAULT_UNIT': 'usd',
     'DISABLE_UPDATES': False,
     'DISPLAY_BULK_BUYER_TOGGLE': True,
+    'DUE_EVENTS_NOTICES': False,
     'EXPIRE_NOTICE_DAYS': [15],
     'EXTRA_MIXIN': object,
     'EXTRA_FIELD': None,
@@ -138,6 +146,7 @@ _SETTINGS = {
     'USER_DETAIL_SERIALIZER': 'saas.api.serializers_overrides.UserSerializer',
     'SEARCH_FIELDS_PARAM': 'q_f',
     'TERMS_OF_USE': 'terms-of-use',
+    'TRANSACTION_PARTITIONS': False,
     'MANAGER': 'manager',
     'CONTRIBUTOR': 'contributor',
     'PROFILE_URL_KWARG': 'profile' #Also modify organization_url_kwarg in extras
@@ -193,6 +202,7 @@ CSV_CUSTOMER_CONTACTS_INCLUDED = _SETTINGS.get('CSV_CUSTOMER_CONTACTS_INCLUDED')
 DEFAULT_UNIT = _SETTINGS.get('DEFAULT_UNIT')
 DISABLE_UPDATES = _SETTINGS.get('DISABLE_UPDATES')
 DISPLAY_BULK_BUYER_TOGGLE = _SETTINGS.get('DISPLAY_BULK_BUYER_TOGGLE')
+DUE_EVENTS_NOTICES = _SETTINGS.get('DUE_EVENTS_NOTICES')
 EXPIRE_NOTICE_DAYS = _SETTINGS.get('EXPIRE_NOTICE_DAYS')
 EXTRA_MIXIN = _SETTINGS.get('EXTRA_MIXIN')
 FORCE_PERSONAL_PROFILE = _SETTINGS.get('FORCE_PERSONAL_PROFILE')
@@ -227,6 +237,7 @@ USER_SERIALIZER = _SETTINGS.get('USER_SERIALIZER')
 USER_DETAIL_SERIALIZER = _SETTINGS.get('USER_DETAIL_SERIALIZER')
 SEARCH_FIELDS_PARAM = _SETTINGS.get('SEARCH_FIELDS_PARAM')
 TERMS_OF_USE = _SETTINGS.get('TERMS_OF_USE')
+TRANSACTION_PARTITIONS = _SETTINGS.get('TRANSACTION_PARTITIONS')
 
 # BE EXTRA CAREFUL! This variable is used to bypass PermissionDenied
 # exceptions. It is solely intended as a debug flexibility nob.
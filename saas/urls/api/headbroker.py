@@ -32,6 +32,7 @@ from ...api.balances import (BalanceLineListAPIView, BrokerBalancesAPIView,
 from ...api.billing import (UserCartItemListView, ActiveCartItemListCreateView,
                             ActiveCartItemRetrieveUpdateDestroyView)
 from ...api.charges import ChargeListAPIView
+from ...api.renewals import RenewalsJournalListAPIView
 from ...api.transactions import TransactionListAPIView
 from ...api.users import RegisteredAPIView
 from ...compat import path
@@ -48,6 +49,8 @@ urlpatterns = [
         TransactionListAPIView.as_view(), name='saas_api_transactions'),
     path('billing/charges', ChargeListAPIView.as_view(),
         name='saas_api_charges'),
+    path('billing/renewals', RenewalsJournalListAPIView.as_view(),
+        name='saas_api_renewals_journal'),
     path('billing/cartitems/user/<slug:user>',
         UserCartItemListView.as_view(), name='saas_api_user_cartitems'),
     path('billing/cartitems/<int:cartitem_id>',
@@ -908,6 +908,8 @@ djaodjin-saas/tree/master/saas/templates/saas/billing/receipt.html>`__).
             pass
         update_context_urls(context, urls)
 
+        Transaction.objects.resolve_events([
+            line.invoiced for line in context['charge_items']])
         for rank, line in enumerate(context['charge_items']):
             event = line.invoiced.get_event() # Subscription,
                                               # or Coupon (i.e. Group buy)